@@ -47,7 +47,13 @@ typedef struct {
     ti_iter_t iter;
 } TabixIteratorObject;
 
-static PyTypeObject Tabix_Type, TabixIterator_Type;
+typedef struct {
+    PyObject_HEAD
+    BGZF *fp;
+    char *fn;
+} BGZFObject;
+
+static PyTypeObject Tabix_Type, TabixIterator_Type, BGZF_Type;
 
 /* --- TabixIterator --------------------------------------------------- */
 
@@ -397,9 +403,201 @@ static PyTypeObject Tabix_Type = {
     0,                          /*tp_free*/
     0,                          /*tp_is_gc*/
 };
+/* --- BGZF ------------------------------------------------------------ */
+
+static PyObject *
+bgzfobj_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    BGZFObject *self;
+    const char *fn;
+    int cache_size = 0;
+    static char *kwnames[]={"fn", "cache_size", NULL};
+    BGZF *fp;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "s|i:bgzf",
+                                     kwnames, &fn, &cache_size))
+        return NULL;
+
+    fp = bgzf_open(fn, "r");
+    if (fp == NULL) {
+        PyErr_Format(TabixError, "Can't open %s.", fn);
+        return NULL;
+    }
+    bgzf_set_cache_size(fp, cache_size);
+
+    self = (BGZFObject *)type->tp_alloc(type, 0);
+    if (self == NULL) {
+        bgzf_close(fp);
+        return NULL;
+    }
+
+    self->fp = fp;
+    self->fn = strdup(fn);
+
+    return (PyObject *)self;
+}
+
+static void
+bgzfobj_dealloc(BGZFObject *self)
+{
+    free(self->fn);
+    bgzf_close(self->fp);
+    PyObject_Del(self);
+}
+
+static PyObject *
+bgzfobj_read(BGZFObject *self, PyObject *args)
+{
+    long long voffset;
+    Py_ssize_t length, n;
+    PyObject *ret;
+
+    if (!PyArg_ParseTuple(args, "Ln:read", &voffset, &length))
+        return NULL;
+    if (length < 0) {
+        PyErr_SetString(TabixError, "negative length");
+        return NULL;
+    }
+
+    ret = PyBytes_FromStringAndSize(NULL, length);
+    if (ret == NULL)
+        return NULL;
+
+    if (bgzf_seek(self->fp, (int64_t)voffset, SEEK_SET) < 0) {
+        Py_DECREF(ret);
+        PyErr_Format(TabixError, "failed to seek in %s", self->fn);
+        return NULL;
+    }
+    n = bgzf_read(self->fp, PyBytes_AS_STRING(ret), length);
+    if (n < 0) {
+        Py_DECREF(ret);
+        PyErr_Format(TabixError, "failed to read %s", self->fn);
+        return NULL;
+    }
+    if (n < length && _PyBytes_Resize(&ret, n) < 0)
+        return NULL;
+
+    return ret;
+}
+
+static PyMethodDef bgzfobj_methods[] = {
+    {
+        "read",
+        (PyCFunction)bgzfobj_read,
+        METH_VARARGS,
+        PyDoc_STR("Read uncompressed bytes from a virtual offset.\n\n"
+                  "    >>> f.read((block_offset << 16) | within_block, 100)\n\n"
+                  "Parameters\n"
+                  "----------\n"
+                  "voffset : int\n"
+                  "    Compressed offset of the block shifted by 16 bits, plus\n"
+                  "    the offset within the uncompressed block.\n"
+                  "length : int\n"
+                  "    Number of bytes, fewer are returned at the end of file.\n")
+    },
+    {NULL, NULL}           /* sentinel */
+};
+
+static PyTypeObject BGZF_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "tabix.bgzf",               /*tp_name*/
+    sizeof(BGZFObject),         /*tp_basicsize*/
+    0,                          /*tp_itemsize*/
+    /* methods */
+    (destructor)bgzfobj_dealloc, /*tp_dealloc*/
+    0,                          /*tp_print*/
+    0,                          /*tp_getattr*/
+    0,                          /*tp_setattr*/
+    0,                          /*tp_compare*/
+    0,                          /*tp_repr*/
+    0,                          /*tp_as_number*/
+    0,                          /*tp_as_sequence*/
+    0,                          /*tp_as_mapping*/
+    0,                          /*tp_hash*/
+    0,                          /*tp_call*/
+    0,                          /*tp_str*/
+    0,                          /*tp_getattro*/
+    0,                          /*tp_setattro*/
+    0,                          /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT,         /*tp_flags*/
+    "Open a file compressed with bgzip for reading at virtual offsets,\n"
+    "cache_size bytes of decompressed blocks are kept.\n\n"
+    "    >>> f = tabix.bgzf(\"ref.fa.gz\", 1 << 22)\n"
+    "    >>> f.read(0, 100)",      /*tp_doc*/
+    0,                          /*tp_traverse*/
+    0,                          /*tp_clear*/
+    0,                          /*tp_richcompare*/
+    0,                          /*tp_weaklistoffset*/
+    0,                          /*tp_iter*/
+    0,                          /*tp_iternext*/
+    bgzfobj_methods,            /*tp_methods*/
+    0,                          /*tp_members*/
+    0,                          /*tp_getset*/
+    0,                          /*tp_base*/
+    0,                          /*tp_dict*/
+    0,                          /*tp_descr_get*/
+    0,                          /*tp_descr_set*/
+    0,                          /*tp_dictoffset*/
+    0,                          /*tp_init*/
+    0,                          /*tp_alloc*/
+    (newfunc)bgzfobj_new,       /*tp_new*/
+    0,                          /*tp_free*/
+    0,                          /*tp_is_gc*/
+};
+
 /* --------------------------------------------------------------------- */
 
+static PyObject *
+tabix_index(PyObject *self, PyObject *args)
+{
+    const char *fn;
+    const char *preset = "bed";
+    const ti_conf_t *conf;
+    int ret;
+
+    if (!PyArg_ParseTuple(args, "s|s:index", &fn, &preset))
+        return NULL;
+
+    if (strcmp(preset, "bed") == 0)
+        conf = &ti_conf_bed;
+    else if (strcmp(preset, "vcf") == 0)
+        conf = &ti_conf_vcf;
+    else if (strcmp(preset, "gff") == 0)
+        conf = &ti_conf_gff;
+    else if (strcmp(preset, "sam") == 0)
+        conf = &ti_conf_sam;
+    else if (strcmp(preset, "psltbl") == 0)
+        conf = &ti_conf_psltbl;
+    else {
+        PyErr_Format(TabixError, "unknown preset: %s", preset);
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    ret = ti_index_build(fn, conf);
+    Py_END_ALLOW_THREADS
+
+    if (ret != 0) {
+        PyErr_Format(TabixError, "failed to index %s", fn);
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
 static PyMethodDef tabix_functions[] = {
+    {
+        "index",
+        (PyCFunction)tabix_index,
+        METH_VARARGS,
+        PyDoc_STR("Build the .tbi index of a bgzip-compressed file sorted by position.\n\n"
+                  "    >>> tabix.index(\"example.bed.gz\", \"bed\")\n\n"
+                  "Parameters\n"
+                  "----------\n"
+                  "fn : str\n"
+                  "    Path to the file, the index is written to fn.tbi.\n"
+                  "preset : str\n"
+                  "    File format, one of bed (default), vcf, gff, sam and psltbl.\n")
+    },
     {NULL, NULL} /* sentinel */
 };
 
@@ -472,6 +670,8 @@ PyMODINIT_FUNC PyInit_tabix(void)
         goto fail;
     if (PyType_Ready(&TabixIterator_Type) < 0)
         goto fail;
+    if (PyType_Ready(&BGZF_Type) < 0)
+        goto fail;
 
 #if PY_MAJOR_VERSION < 3
     m = Py_InitModule3("tabix", tabix_functions, module_doc);
@@ -491,6 +691,7 @@ PyMODINIT_FUNC PyInit_tabix(void)
 
     PyModule_AddObject(m, "open", (PyObject *)&Tabix_Type);
     PyModule_AddObject(m, "iter", (PyObject *)&TabixIterator_Type);
+    PyModule_AddObject(m, "bgzf", (PyObject *)&BGZF_Type);
 
 #if PY_MAJOR_VERSION >= 3
     return m;
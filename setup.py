@@ -59,8 +59,9 @@ class TransVarInstall(install):
     def run(self):
 
         install.run(self)
-        ## now samtools, tabix and bgzips are dependencies, they are needed only when
-        ## there is need to build one's own transcripts.
+        ## now samtools is a dependency, needed only when there is need to
+        ## build one's own transcripts, bgzip and tabix indexing are done
+        ## in-process by transvar.tabix.
         #  import shutil
         #  shutil.copy2('external/samtools/samtools',
         #               os.path.join(self.install_lib, 'transvar'))
@@ -94,7 +95,7 @@ def main():
                   ],
                   include_dirs=["external/pytabix"],
                   libraries=["z"],
-                  define_macros=[("_FILE_OFFSET_BITS", 64), ("_USE_KNETFILE", 1)],
+                  define_macros=[("_FILE_OFFSET_BITS", 64), ("_USE_KNETFILE", 1), ("BGZF_CACHE", 1)],
                   extra_compile_args=["-w"],
               ),
         Extension("transvar.ssw._sswlib",
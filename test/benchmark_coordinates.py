@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+microbenchmark of the cDNA <-> gDNA coordinate conversion on long genes
+
+usage: python test/benchmark_coordinates.py [number of exons] [number of queries]
+
+the exon-offset engine (CDSPositions) is compared against the per-base
+position list that transvar used to build for every transcript
+"""
+import sys, time, random
+sys.path.insert(0, '.')
+from transvar.transcripts import Transcript, CDSPositions
+
+def per_base_positions(t):
+
+    np = []
+    if t.strand == '+':
+        for beg, end in t.exons:
+            np += list(range(max(beg, t.cds_beg), min(t.cds_end, end)+1))
+    else:
+        for beg, end in reversed(t.exons):
+            np += list(range(min(t.cds_end, end), max(beg, t.cds_beg)-1, -1))
+    return np
+
+def long_transcript(nexons, strand):
+
+    """ a TTN-like transcript, exons of 50-500bp separated by 1-10kb introns """
+    rand = random.Random(nexons)
+    t = Transcript()
+    t.chrm = 'chr2'
+    t.strand = strand
+    pos = 1000000
+    for i in range(nexons):
+        beg = pos + rand.randint(1000, 10000)
+        end = beg + rand.randint(50, 500)
+        t.exons.append((beg, end))
+        pos = end
+    t.beg = t.exons[0][0]
+    t.end = t.exons[-1][1]
+    t.cds_beg = t.exons[0][0] + 20
+    t.cds_end = t.exons[-1][1] - 20
+    t.seq = 'A'*len(CDSPositions(t))
+    return t
+
+def bench(name, f, n):
+
+    t0 = time.time()
+    f()
+    el = time.time() - t0
+    print('%-32s %10.3f ms  %8.2f us/query' % (name, el*1000, el*1e6/n))
+
+def main():
+
+    nexons = int(sys.argv[1]) if len(sys.argv) > 1 else 363
+    nq = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    for strand in '+-':
+        t = long_transcript(nexons, strand)
+        rand = random.Random(1)
+        print('== strand %s, %d exons, %d bp genomic, %d bp CDS, %d queries' %
+              (strand, nexons, t.end-t.beg+1, len(t.seq), nq))
+
+        np = per_base_positions(t)
+        cp = CDSPositions(t)
+        assert list(cp) == np
+        tposs = [rand.randint(1, len(np)) for i in range(nq)]
+        gposs = [rand.randint(t.cds_beg, t.cds_end) for i in range(nq)]
+
+        bench('build per-base list', lambda: per_base_positions(t), 1)
+        bench('build exon offsets', lambda: CDSPositions(t), 1)
+        bench('tnuc2gnuc per-base list', lambda: [np[p-1] for p in tposs], nq)
+        bench('tnuc2gnuc exon offsets', lambda: [cp[p-1] for p in tposs], nq)
+
+        nq_scan = min(nq, 1000)
+        if strand == '+':
+            scan = lambda: [next(i for i, p in enumerate(np) if p >= g) for g in gposs[:nq_scan]]
+        else:
+            scan = lambda: [next(i for i, p in enumerate(np) if p <= g) for g in gposs[:nq_scan]]
+        assert scan() == [cp.search(g) for g in gposs[:nq_scan]]
+        bench('gpos2tnuc linear scan', scan, nq_scan)
+        bench('gpos2tnuc exon offsets', lambda: [cp.search(g) for g in gposs], nq)
+
+        t.np = cp
+        bench('gpos2codon', lambda: [t.gpos2codon(g) for g in gposs], nq)
+        bench('gpos2codon_many', lambda: t.gpos2codon_many(gposs), nq)
+        bench('tnuc2gnuc_many', lambda: t.tnuc2gnuc_many(tposs), nq)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+microbenchmark of the reference sequence fetch
+
+usage: python test/benchmark_faidx.py [reference fasta (with .fai)] [number of queries]
+
+without a reference, a random 10 Mb fasta of 60 bp lines is made in a
+temporary directory. The exact-span fetch (RefGenome.fetch_bytes) is
+compared against the line by line readline loop transvar used before,
+on 1 bp, 1 kb and 2 Mb windows, and the block cache (fetch_sequence)
+on windows clustered around a few loci as in annotating one variant.
+The same windows are fetched from the .2bit packed from the fasta and
+from the fasta compressed by bgzip
+"""
+import sys, os, time, random, tempfile, shutil
+sys.path.insert(0, '.')
+from transvar.faidx import RefGenome, TwoBitGenome, BGZFGenome, write_twobit
+from transvar.utils import BGZFWriter
+
+def readline_fetch(ref, chrom, start, end):
+
+    """ the former fetch_sequence """
+    seq = []
+    seq_len = 0
+    chrom = ref.resolve_chrm(chrom)
+    slen, offset, blen, bytelen = ref.faidx[chrom]
+    start, end = ref._window(chrom, start, end)
+    ref.fasta_handle.seek(offset+start//blen*bytelen+start%blen)
+    while seq_len < end-start:
+        line = ref.fasta_handle.readline().decode()
+        line = line[:-1]
+        seq_len = seq_len+len(line)
+        seq.append(line)
+    seq = ''.join(seq)
+    return seq[:end-start].upper()
+
+def make_fasta(dirname, chrlen=10000000, width=60):
+
+    """ random bases with soft-masked repeats of 300 bp to 3 kb
+    and a 10 kb gap of N every 1 Mb """
+    rand = random.Random(1)
+    pieces = []
+    n = 0
+    while n < chrlen:
+        if n % 1000000 < 10000:
+            piece = 'N'*(10000 - n % 1000000)
+        else:
+            piece = ''.join(rand.choice('ACGT') for j in range(rand.randint(300, 3000)))
+            if rand.random() < 0.3:
+                piece = piece.lower()
+        pieces.append(piece)
+        n += len(piece)
+    seq = ''.join(pieces)[:chrlen]
+
+    fn = os.path.join(dirname, 'ref.fa')
+    with open(fn, 'w') as fh:
+        fh.write('>chr1\n')
+        offset = fh.tell()
+        for i in range(0, chrlen, width):
+            fh.write(seq[i:i+width]+'\n')
+    with open(fn+'.fai', 'w') as fh:
+        fh.write('chr1\t%d\t%d\t%d\t%d\n' % (chrlen, offset, width, width+1))
+    return fn
+
+def bench(name, f, n):
+
+    t0 = time.time()
+    f()
+    el = time.time() - t0
+    print('%-32s %10.3f ms  %10.2f us/query' % (name, el*1000, el*1e6/n))
+
+def main():
+
+    tmpdir = tempfile.mkdtemp()
+    if len(sys.argv) > 1:
+        fn = sys.argv[1]
+    else:
+        fn = make_fasta(tmpdir)
+    nq = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+    ref = RefGenome(fn)
+    t0 = time.time()
+    write_twobit(fn, os.path.join(tmpdir, 'ref.2bit'))
+    print('packed into .2bit in %.3f s' % (time.time()-t0))
+    ref2 = TwoBitGenome(os.path.join(tmpdir, 'ref.2bit'))
+    gzfn = os.path.join(tmpdir, 'ref.fa.gz')
+    w = BGZFWriter(open(gzfn, 'wb'))
+    with open(fn, 'rb') as fh:
+        w.write(fh.read())
+    w.close()
+    shutil.copy(fn+'.fai', gzfn+'.fai')
+    ref3 = BGZFGenome(gzfn)
+    chrom = max(ref.faidx, key=lambda c: ref.faidx[c][0])
+    slen = ref.faidx[chrom][0]
+    rand = random.Random(1)
+    for width in [1, 1000, 2000000]:
+        n = max(1, min(nq, nq*1000//width))
+        if width > slen:
+            continue
+        qs = [rand.randint(1, slen-width+1) for i in range(n)]
+        print('== %d bp windows, %d queries' % (width, n))
+        for p in qs[:100]:
+            assert ref.fetch_sequence(chrom, p, p+width-1) == readline_fetch(ref, chrom, p, p+width-1)
+        bench('readline loop', lambda: [readline_fetch(ref, chrom, p, p+width-1) for p in qs], n)
+        bench('exact span', lambda: [ref.fetch_bytes(chrom, p, p+width-1).decode() for p in qs], n)
+        bench('exact span (bytes)', lambda: [ref.fetch_bytes(chrom, p, p+width-1) for p in qs], n)
+        bench('2bit', lambda: [ref2.fetch_bytes(chrom, p, p+width-1) for p in qs], n)
+        bench('bgzip', lambda: [ref3.fetch_bytes(chrom, p, p+width-1) for p in qs], n)
+
+    ## 1 bp to 2 kb windows within 5 kb of 100 loci
+    loci = [rand.randint(5001, slen-7000) for i in range(100)]
+    qs = [(p+rand.randint(-5000, 5000), rand.choice([1, 3, 100, 2001])) for p in loci for i in range(nq//100)]
+    print('== clustered windows, %d queries' % len(qs))
+    bench('exact span', lambda: [ref.fetch_bytes(chrom, p, p+w-1).decode() for p, w in qs], len(qs))
+    bench('block cache', lambda: [ref.fetch_sequence(chrom, p, p+w-1) for p, w in qs], len(qs))
+    print(ref.format_cache_stats())
+    bench('2bit block cache', lambda: [ref2.fetch_sequence(chrom, p, p+w-1) for p, w in qs], len(qs))
+    bench('bgzip block cache', lambda: [ref3.fetch_sequence(chrom, p, p+w-1) for p, w in qs], len(qs))
+
+    shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
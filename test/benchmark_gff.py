@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+microbenchmark of parsing a GTF into transcript models (transvar index)
+
+usage: python test/benchmark_gff.py [number of transcripts] [jobs ...]
+
+a random Ensembl-like GTF (5 exons per transcript, attributes as in the
+Ensembl release GTF) is made in a temporary directory and parsed by
+EnsemblDB.parse_raw with 1 and more worker processes. Besides the wall
+time, the CPU time of the parent process is shown, this is the part
+that does not get faster with more workers (reading, receiving the
+records and building the models). The models are checked to be the same
+"""
+import sys, os, time, random, tempfile, shutil
+sys.path.insert(0, '.')
+from transvar.localdb import EnsemblDB
+
+def make_gtf(dirname, ntpts):
+
+    rand = random.Random(1)
+    fn = os.path.join(dirname, 'ens.gtf')
+    with open(fn, 'w') as fh:
+        pos = 10000
+        for i in range(ntpts):
+            gid = 'ENSG%011d' % i
+            tid = 'ENST%011d' % i
+            gattr = ('gene_id "%s"; gene_version "5"; gene_name "G%d"; gene_source "ensembl_havana"; '
+                     'gene_biotype "protein_coding";' % (gid, i))
+            tattr = gattr+(' transcript_id "%s"; transcript_version "3"; transcript_name "G%d-201"; '
+                           'transcript_source "ensembl_havana"; transcript_biotype "protein_coding"; '
+                           'tag "CCDS"; ccds_id "CCDS%d.1"; tag "basic"; transcript_support_level "1";'
+                           % (tid, i, i))
+            exons = []
+            p = pos
+            for j in range(5):
+                exons.append((p, p+rand.randint(100, 300)))
+                p = exons[-1][1]+rand.randint(500, 5000)
+            beg, end = exons[0][0], exons[-1][1]
+            fh.write('1\tensembl_havana\tgene\t%d\t%d\t.\t+\t.\t%s\n' % (beg, end, gattr))
+            fh.write('1\tensembl_havana\ttranscript\t%d\t%d\t.\t+\t.\t%s\n' % (beg, end, tattr))
+            for j, (b, e) in enumerate(exons):
+                fh.write('1\tensembl_havana\texon\t%d\t%d\t.\t+\t.\t%s exon_number "%d"; '
+                         'exon_id "ENSE%011d"; exon_version "1";\n' % (b, e, tattr, j+1, i*5+j))
+                fh.write('1\tensembl_havana\tCDS\t%d\t%d\t.\t+\t0\t%s exon_number "%d"; '
+                         'protein_id "ENSP%011d"; protein_version "1";\n' % (b, e, tattr, j+1, i))
+            pos = end+rand.randint(1000, 10000)
+    return fn
+
+def models(db):
+    return [(t.name, t.chrm, t.beg, t.end, t.exons, t.cds, t.aliases, t.transcript_type, g.name)
+            for name in sorted(db.name2gene) for g in [db.name2gene[name]] for t in g.tpts]
+
+def main():
+
+    ntpts = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    jobss = [int(_) for _ in sys.argv[2:]] or [1, 2, 4]
+    tmpdir = tempfile.mkdtemp()
+    fn = make_gtf(tmpdir, ntpts)
+    print('== %d transcripts, %d lines' % (ntpts, ntpts*12))
+    ref = None
+    for jobs in jobss:
+        db = EnsemblDB()
+        db.jobs = jobs
+        t0 = time.time()
+        c0 = time.process_time()
+        db.parse_raw(fn)
+        print('jobs %-3d wall %8.3f s  parent cpu %8.3f s' % (
+            jobs, time.time()-t0, time.process_time()-c0))
+        if ref is None:
+            ref = models(db)
+        else:
+            assert models(db) == ref
+
+    shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
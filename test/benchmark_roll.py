@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+microbenchmark of the left/right normalization (rolling) of indels
+
+usage: python test/benchmark_roll.py [number of indels]
+
+a random fasta with satellite repeats of 1-10 kb (periods 1-40 bp) is
+made in a temporary directory, the chunked rolling (gnuc_roll_*) is
+compared against the base by base rolling through SeqBuf that transvar
+used before, on indels in unique sequence and inside the repeats. The
+chromosome starts with a poly-T and ends with a poly-A run, indels at
+both ends are checked against a plain base by base rolling over the
+whole chromosome (SeqBuf cannot fetch within 1 kb of the ends)
+"""
+import sys, os, time, random, tempfile, shutil
+from collections import deque
+sys.path.insert(0, '.')
+from transvar import faidx
+from transvar.transcripts import gnuc_roll_left_del, gnuc_roll_right_del, \
+    gnuc_roll_left_ins, gnuc_roll_right_ins
+
+## the former rolling
+def seqbuf_roll_left_del(chrm, beg, end):
+    sb = faidx.SeqBuf(chrm, beg)
+    while beg > 1:
+        left_base = sb.get_base(chrm, beg-1)
+        rightmost = sb.get_base(chrm, end)
+        if left_base == 'N' or rightmost == 'N' or left_base != rightmost:
+            break
+        beg -= 1
+        end -= 1
+    return beg, end
+
+def seqbuf_roll_right_del(chrm, beg, end):
+    sb = faidx.SeqBuf(chrm, end)
+    chrmlen = faidx.refgenome.chrm2len(chrm)
+    while end + 1 < chrmlen:
+        right_base = sb.get_base(chrm, end+1)
+        leftmost = sb.get_base(chrm, beg)
+        if right_base == 'N' or leftmost == 'N' or right_base != leftmost:
+            break
+        beg += 1
+        end += 1
+    return beg, end
+
+def seqbuf_roll_left_ins(chrm, pos, insseq):
+    sb = faidx.SeqBuf(chrm, pos)
+    q = deque(insseq)
+    while pos > 1:
+        left_base = sb.get_base(chrm, pos)
+        if left_base == 'N' or q[-1] == 'N' or left_base != q[-1]:
+            break
+        q.pop()
+        q.appendleft(left_base)
+        pos -= 1
+    return pos, ''.join(q)
+
+def seqbuf_roll_right_ins(chrm, pos, insseq):
+    sb = faidx.SeqBuf(chrm, pos)
+    chrmlen = faidx.refgenome.chrm2len(chrm)
+    q = deque(insseq)
+    while pos + 1 < chrmlen:
+        right_base = sb.get_base(chrm, pos+1)
+        if right_base == 'N' or q[0] == 'N' or right_base != q[0]:
+            break
+        q.popleft()
+        q.append(right_base)
+        pos += 1
+    return pos, ''.join(q)
+
+## rolling over the whole chromosome sequence (1-based positions)
+def naive_roll_left_del(seq, beg, end):
+    while beg > 1 and seq[beg-2] == seq[end-1] and seq[end-1] != 'N':
+        beg -= 1
+        end -= 1
+    return beg, end
+
+def naive_roll_right_del(seq, beg, end):
+    while end < len(seq) and seq[end] == seq[beg-1] and seq[end] != 'N':
+        beg += 1
+        end += 1
+    return beg, end
+
+def naive_roll_left_ins(seq, pos, insseq):
+    while pos > 1 and seq[pos-1] == insseq[-1] and insseq[-1] != 'N':
+        insseq = seq[pos-1] + insseq[:-1]
+        pos -= 1
+    return pos, insseq
+
+def naive_roll_right_ins(seq, pos, insseq):
+    while pos < len(seq) and seq[pos] == insseq[0] and insseq[0] != 'N':
+        insseq = insseq[1:] + seq[pos]
+        pos += 1
+    return pos, insseq
+
+def make_fasta(dirname, chrlen=2000000, width=60):
+
+    """ random bases with a satellite repeat every 20 kb, returns the
+    fasta and the repeats as (beg, end, period) """
+    rand = random.Random(1)
+    pieces = []
+    repeats = []
+    n = 0
+    while n < chrlen:
+        piece = ''.join(rand.choice('ACGT') for j in range(20000))
+        unit = ''.join(rand.choice('ACGT') for j in range(rand.randint(1, 40)))
+        rep = (unit*(rand.randint(1000, 10000)//len(unit)+1))
+        if rand.random() < 0.1:     # a gap inside the repeat
+            i = rand.randint(0, len(rep)-100)
+            rep = rep[:i]+'N'*100+rep[i+100:]
+        pieces.append(piece)
+        pieces.append(rep)
+        repeats.append((n+len(piece)+1, n+len(piece)+len(rep), len(unit)))
+        n += len(piece)+len(rep)
+    seq = 'T'*300 + ''.join(pieces)[:chrlen-600] + 'A'*300
+    repeats = [r for r in repeats if r[1] < chrlen-1000]
+
+    fn = os.path.join(dirname, 'ref.fa')
+    with open(fn, 'w') as fh:
+        fh.write('>chr1\n')
+        offset = fh.tell()
+        for i in range(0, chrlen, width):
+            fh.write(seq[i:i+width]+'\n')
+    with open(fn+'.fai', 'w') as fh:
+        fh.write('chr1\t%d\t%d\t%d\t%d\n' % (chrlen, offset, width, width+1))
+    return fn, seq, repeats
+
+def bench(name, f, n):
+
+    t0 = time.time()
+    f()
+    el = time.time() - t0
+    print('%-32s %10.3f ms  %10.2f us/indel' % (name, el*1000, el*1e6/n))
+
+def main():
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    tmpdir = tempfile.mkdtemp()
+    fn, seq, repeats = make_fasta(tmpdir)
+    faidx.init_refgenome(fn)
+    chrmlen = faidx.refgenome.chrm2len('chr1')
+    rand = random.Random(2)
+
+    unique = [rand.randint(2000, chrmlen-2000) for i in range(n)]
+    inrepeat = []
+    for i in range(n):
+        beg, end, period = rand.choice(repeats)
+        inrepeat.append((rand.randint(beg+1000, end-1000) if end-beg > 2500 else (beg+end)//2, period))
+
+    for name, sites in [('unique sequence', [(p, rand.randint(1, 5)) for p in unique]),
+                        ('inside repeats', inrepeat)]:
+        dels = [(p, p+rand.choice([1, 2, 3])*l-1) for p, l in sites]
+        inss = [(p, faidx.getseq('chr1', p-l+1, p)) for p, l in sites]
+        print('== %s, %d deletions and insertions' % (name, len(sites)))
+        for old, new, qs in [(seqbuf_roll_left_del, gnuc_roll_left_del, dels),
+                             (seqbuf_roll_right_del, gnuc_roll_right_del, dels),
+                             (seqbuf_roll_left_ins, gnuc_roll_left_ins, inss),
+                             (seqbuf_roll_right_ins, gnuc_roll_right_ins, inss)]:
+            assert [old('chr1', a, b) for a, b in qs] == [new('chr1', a, b) for a, b in qs]
+            bench('%s base by base' % new.__name__, lambda: [old('chr1', a, b) for a, b in qs], len(qs))
+            bench('%s chunked' % new.__name__, lambda: [new('chr1', a, b) for a, b in qs], len(qs))
+
+    ## indels at the chromosome ends
+    ends = list(range(1, 400)) + list(range(chrmlen-400, chrmlen+1))
+    for l in [1, 2, 3, 4]:
+        dels = [(p, p+l-1) for p in ends if p+l-1 <= chrmlen]
+        inss = [(p, s) for p in ends for s in ['A'*l, 'T'*l, 'C'*l, ('AT'*l)[:l]]]
+        for naive, new, qs in [(naive_roll_left_del, gnuc_roll_left_del, dels),
+                               (naive_roll_right_del, gnuc_roll_right_del, dels),
+                               (naive_roll_left_ins, gnuc_roll_left_ins, inss),
+                               (naive_roll_right_ins, gnuc_roll_right_ins, inss)]:
+            for a, b in qs:
+                assert naive(seq, a, b) == new('chr1', a, b), (new.__name__, a, b)
+    assert gnuc_roll_right_del('chr1', chrmlen-196, chrmlen-193) == (chrmlen-3, chrmlen)
+    assert gnuc_roll_right_ins('chr1', chrmlen-100, 'AA') == (chrmlen, 'AA')
+    print('== rolling at the chromosome ends agrees with the whole chromosome rolling')
+
+    shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -27,11 +27,14 @@ SOFTWARE.
 
 """
 
-import sys, argparse, re
+import sys, argparse, re, io
+from collections import OrderedDict
 from .annodb import AnnoDB
+from . import faidx
 # from transcripts import *
 # import parser
 from .record import *
+from . import record
 from .err import *
 from .config import read_config
 from .mutation import parse_tok_mutation_str, list_parse_mutation, vcf_parse_mutation
@@ -137,38 +140,259 @@ def _main_(args, q, db, at):
 
     return
 
+## the options that change the output of a query
+MEMO_FLAGS = ['longest', 'longestcoding', 'strictversion', 'aa3', 'oneline', 'gseq',
+              'haplotype', 'pp', 'ppp', 'seqmax', 'nc', 'aacontext',
+              'prombeg', 'promend', 'ignore']
+
+class QueryMemo():
+
+    """ bounded LRU of the output of queries that have been annotated,
+    the output lines are kept without the leading input column (q.op)
+    and replayed for repeated queries. Misses are looked up in the
+    optional persistent store (annocache.AnnoCache) """
+
+    def __init__(self, args, at, size, store=None):
+
+        self.size = size
+        self.cache = OrderedDict()
+        self.flags = (at,)+tuple(getattr(args, k, None) for k in MEMO_FLAGS)
+        self.hits = 0
+        self.misses = 0
+        self.store = store
+        self.persistent = store is not None
+        self.store_hits = 0
+        self.store_misses = 0
+
+    def key(self, q):
+        return (type(q).__name__, self.flags,
+                tuple(sorted((k, repr(v)) for k, v in q.__dict__.items()
+                             if k not in ('op', 'gene', 'msg'))))
+
+    def get(self, key):
+        lines = self.cache.get(key)
+        if lines is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return lines
+
+        self.misses += 1
+        if self.store is not None:
+            lines = self.store.get(key)
+            if lines is None:
+                self.store_misses += 1
+            else:
+                self.store_hits += 1
+                self._put(key, lines)
+        return lines
+
+    def _put(self, key, lines):
+        self.cache[key] = lines
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    def put(self, key, op, text):
+
+        prefix = op+'\t' if op else ''
+        lines = text.split('\n')[:-1]
+        if not all(line.startswith(prefix) for line in lines):
+            return
+        lines = [line[len(prefix):] for line in lines]
+        self._put(key, lines)
+        if self.store is not None:
+            self.store.put(key, lines)
+
+    def counts(self):
+        return (self.hits, self.misses, self.store_hits, self.store_misses)
+
+    def add_counts(self, counts):
+        self.hits += counts[0]
+        self.misses += counts[1]
+        self.store_hits += counts[2]
+        self.store_misses += counts[3]
+
+    def replay(self, op, lines):
+        prefix = op+'\t' if op else ''
+        for line in lines:
+            record.output.write(prefix+line)
+
+    def report(self):
+        if self.hits + self.misses > 0:
+            err_print('query cache: %d hits, %d misses' % (self.hits, self.misses))
+        if self.persistent:
+            err_print('persistent cache: %d hits, %d misses' % (self.store_hits, self.store_misses))
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+def open_query_memo(args, at, db):
+
+    """ the QueryMemo of a run, None when both the in-run
+    memo (--memo) and the persistent cache (--cache) are disabled """
+    store = None
+    if args.cache:
+        from .annocache import AnnoCache
+        store = AnnoCache(args.cache, db.fingerprint(), args.cache_size, args.cache_age)
+    if args.memo > 0 or store is not None:
+        return QueryMemo(args, at, max(args.memo, 0), store)
+    return None
+
+def _main_list_one_(args, db, at, q, memo=None):
+    """ process one parsed input of a list """
+
+    if q.tok is None:           # parsing error
+        r = Record()
+        r.append_info(q.msg)
+        r.format(q.op)
+        return
+
+    if at == 'g':
+        q.tok = normalize_chrm(q.tok)
+    else:
+        q.tok = q.tok.upper()
+
+    if memo is None:
+        _main_list_annotate_(args, db, at, q)
+        return
+
+    key = memo.key(q)
+    lines = memo.get(key)
+    if lines is not None:
+        memo.replay(q.op, lines)
+        return
+
+    buf = io.StringIO()
+    out = record.set_output(OutputSink(buf, bufsize=1<<30))
+    try:
+        _main_list_annotate_(args, db, at, q)
+        record.output.flush_lines()
+    finally:
+        record.set_output(out)
+    text = buf.getvalue()
+    record.output.write_block(text)
+    memo.put(key, q.op, text)
+
+def _main_list_annotate_(args, db, at, q):
+
+    if at == 'g':
+        _main_(args, q, db, at)
+    else:
+        genefound = False
+        for q.gene in db.get_gene(q.tok, args.strictversion):
+            _main_(args, q, db, at)
+            genefound = True
+
+        if not genefound:
+            wrap_exception(Exception('invalid_gene_%s' % q.tok), q.op, args)
+            # r = Record()
+            # r.append_info('gene_not_recognized_(%s)' % q.tok)
+            # err_warn('gene %s not recognized. make sure the right (if any) transcript database is used.' % q.tok)
+            # r.format(q.op)
+            # continue
+
 def main_list(args, db, at, mutation_parser):
     """ process a list of inputs """
-    for q, line in mutation_parser:
-        if q.tok is None:           # parsing error
-            r = Record()
-            r.append_info(q.msg)
-            r.format(q.op)
-            continue
-
-        if at == 'g':
-            q.tok = normalize_chrm(q.tok)
-            _main_(args, q, db, at)
-        else:
-            q.tok = q.tok.upper()
-            genefound = False
-            for q.gene in db.get_gene(q.tok, args.strictversion):
-                _main_(args, q, db, at)
-                genefound = True
-
-            if not genefound:
-                wrap_exception(Exception('invalid_gene_%s' % q.tok), q.op, args)
-                # r = Record()
-                # r.append_info('gene_not_recognized_(%s)' % q.tok)
-                # err_warn('gene %s not recognized. make sure the right (if any) transcript database is used.' % q.tok)
-                # r.format(q.op)
-                # continue
-            
+    memo = open_query_memo(args, at, db)
+    try:
+        for q, line in mutation_parser:
+            _main_list_one_(args, db, at, q, memo)
+    finally:
+        if memo is not None:
+            memo.close()
+
+    if memo is not None:
+        memo.report()
+    if args.verbose > 0 and faidx.refgenome is not None:
+        err_print(faidx.refgenome.format_cache_stats())
+
         # try:
         # except:
         # err_print('exception %s' % line)
         # raise Exception()
 
+## number of queries handed to a worker at a time in --jobs mode
+JOB_CHUNK_SIZE = 500
+
+## per-worker state, set up once by _init_worker_
+_worker_ = {}
+
+def _init_worker_(args, at):
+
+    config = read_config()
+    _worker_['args'] = args
+    _worker_['at'] = at
+    _worker_['db'] = AnnoDB(args, config)
+    if at == 'g':
+        _worker_['db'].enable_sweep()
+    _worker_['memo'] = open_query_memo(args, at, _worker_['db'])
+
+def _annotate_chunk_(qs):
+    """ annotate a chunk of queries in a worker, return the output
+    as one string and the query cache hits and misses of the chunk """
+
+    args = _worker_['args']
+    memo = _worker_['memo']
+    counts = memo.counts() if memo else None
+    buf = io.StringIO()
+    out = record.set_output(OutputSink(buf, bufsize=1<<16))
+    try:
+        for q in qs:
+            _main_list_one_(args, _worker_['db'], _worker_['at'], q, memo)
+        record.output.flush_lines()
+        if memo:
+            if memo.store is not None:
+                memo.store.commit()
+            counts = [b-a for a, b in zip(counts, memo.counts())]
+        return buf.getvalue(), counts
+    finally:
+        record.set_output(out)
+
+def _chunk_queries_(mutation_parser, chunk_size):
+
+    qs = []
+    for q, line in mutation_parser:
+        qs.append(q)
+        if len(qs) >= chunk_size:
+            yield qs
+            qs = []
+    if qs:
+        yield qs
+
+def main_list_jobs(args, at, mutation_parser):
+    """ process a list of inputs with args.jobs worker processes
+    each worker holds its own AnnoDB, chunks of queries are dispatched
+    to the workers and the output is written back in input order
+    """
+    import copy
+    import multiprocessing
+
+    # open file handles are not passed to the workers
+    wargs = copy.copy(args)
+    wargs.l = None
+
+    pool = multiprocessing.Pool(args.jobs, _init_worker_, (wargs, at))
+    # only counts the hits and misses of the workers
+    memo = QueryMemo(args, at, 0) if args.memo > 0 or args.cache else None
+    try:
+        for s, counts in pool.imap(_annotate_chunk_, _chunk_queries_(mutation_parser, JOB_CHUNK_SIZE)):
+            record.output.write_block(s)
+            if counts is not None:
+                memo.add_counts(counts)
+        pool.close()
+        if args.cache:
+            from .annocache import AnnoCache
+            AnnoCache(args.cache, None, args.cache_size, args.cache_age).close()
+        if memo is not None:
+            memo.persistent = bool(args.cache)
+            memo.report()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
 def main_one(args, db, at):
 
     try:
@@ -186,7 +410,13 @@ def main_one(args, db, at):
     #     return
 
     q.op = args.i
-    if at == 'g':               # genomic input
+    if args.cache:
+        memo = open_query_memo(args, at, db)
+        try:
+            _main_list_one_(args, db, at, q, memo)
+        finally:
+            memo.close()
+    elif at == 'g':             # genomic input
         q.tok = normalize_chrm(q.tok)
         _main_(args, q, db, at)
     else:                       # cDNA or protein
@@ -203,20 +433,40 @@ def main_one(args, db, at):
 def main_anno(args, at):
 
     config = read_config()
-    db = AnnoDB(args, config)
+    if args.jobs > 1 and not args.i:
+        # the workers set up their own AnnoDB
+        db = None
+    else:
+        db = AnnoDB(args, config)
+
+    # genomic input lists are mostly sorted (e.g., VCF)
+    if db is not None and at == 'g' and (args.l or args.vcf):
+        db.enable_sweep()
+
+    out = open_output(args)
+    try:
+        _main_anno_(args, db, at)
+    finally:
+        out.close()
+
+def _main_anno_(args, db, at):
 
     if (not args.vcf) and (not args.noheader):
-        print(print_header(args))
+        record.output.write(print_header(args))
 
     if args.l:
-        main_list(args, db, at, list_parse_mutation(args, at))
+        if db is None:
+            main_list_jobs(args, at, list_parse_mutation(args, at))
+        else:
+            main_list(args, db, at, list_parse_mutation(args, at))
 
     if args.vcf:
         if at != 'g':
             err_raise("can apply on ganno to VCF input")
-        main_list(args, db, at, vcf_parse_mutation(args, 'g'))
+        if db is None:
+            main_list_jobs(args, at, vcf_parse_mutation(args, 'g'))
+        else:
+            main_list(args, db, at, vcf_parse_mutation(args, 'g'))
 
     if args.i:
         main_one(args, db, at)
-
-
@@ -0,0 +1,160 @@
+"""
+The MIT License
+
+Copyright (c) 2015
+The University of Texas MD Anderson Cancer Center
+Wanding Zhou, Tenghui Chen, Ken Chen (kchen3@mdanderson.org)
+
+Permission is hereby granted, free of charge, to any person obtaining
+a copy of this software and associated documentation files (the
+"Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish,
+distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+
+import os, time, hashlib, sqlite3
+from .err import *
+
+## the output lines of a query, keyed by the digest of the database
+## fingerprint (context) and the query key (see anno.QueryMemo),
+## atime is the last time the entry was written or read
+ANNOCACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS anno (
+    key TEXT PRIMARY KEY,
+    context TEXT NOT NULL,
+    lines TEXT NOT NULL,
+    atime REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS anno_atime ON anno (atime);
+CREATE INDEX IF NOT EXISTS anno_context ON anno (context);
+'''
+
+## writes are committed in batches
+ANNOCACHE_COMMIT_EVERY = 1000
+
+class AnnoCache():
+
+    """ persistent cache of annotation output shared across runs (SQLite)
+    context is the AnnoDB fingerprint, entries of other contexts are
+    never returned, i.e., rebuilding an index invalidates its entries.
+    maxsize (number of entries) and maxage (days) are enforced by evict
+    """
+
+    def __init__(self, fn, context=None, maxsize=1000000, maxage=90):
+
+        self.fn = fn
+        self.context = context
+        self.maxsize = maxsize
+        self.maxage = maxage
+        self.conn = sqlite3.connect(fn, timeout=600)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(ANNOCACHE_SCHEMA)
+        self.pending = 0
+
+    def _key(self, qkey):
+        return hashlib.sha1(repr((self.context, qkey)).encode('utf-8')).hexdigest()
+
+    def get(self, qkey):
+
+        """ the cached output lines of a query, None if absent """
+        key = self._key(qkey)
+        row = self.conn.execute('SELECT lines FROM anno WHERE key=?', (key,)).fetchone()
+        if row is None:
+            return None
+        self.conn.execute('UPDATE anno SET atime=? WHERE key=?', (time.time(), key))
+        self._written()
+        return row[0].split('\n') if row[0] else []
+
+    def put(self, qkey, lines):
+
+        self.conn.execute('INSERT OR REPLACE INTO anno (key, context, lines, atime) VALUES (?,?,?,?)',
+                          (self._key(qkey), self.context, '\n'.join(lines), time.time()))
+        self._written()
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= ANNOCACHE_COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def evict(self):
+
+        """ remove the entries older than maxage days and the least
+        recently used entries beyond maxsize, return the number removed """
+        n = 0
+        if self.maxage is not None and self.maxage > 0:
+            n += self.conn.execute('DELETE FROM anno WHERE atime<?',
+                                   (time.time()-self.maxage*86400,)).rowcount
+        if self.maxsize is not None and self.maxsize >= 0:
+            cnt = self.conn.execute('SELECT COUNT(*) FROM anno').fetchone()[0]
+            if cnt > self.maxsize:
+                n += self.conn.execute(
+                    'DELETE FROM anno WHERE key IN (SELECT key FROM anno ORDER BY atime LIMIT ?)',
+                    (cnt-self.maxsize,)).rowcount
+        self.commit()
+        return n
+
+    def invalidate(self, keep_context=None):
+
+        """ remove all the entries, except those of keep_context """
+        if keep_context is None:
+            n = self.conn.execute('DELETE FROM anno').rowcount
+        else:
+            n = self.conn.execute('DELETE FROM anno WHERE context!=?', (keep_context,)).rowcount
+        self.commit()
+        return n
+
+    def contexts(self):
+        return self.conn.execute(
+            'SELECT context, COUNT(*), MIN(atime), MAX(atime) FROM anno GROUP BY context').fetchall()
+
+    def close(self, evict=True):
+        if evict:
+            self.evict()
+        self.commit()
+        self.conn.close()
+
+def main_cache(args):
+
+    """ transvar cache: show, evict or invalidate the entries of a
+    persistent annotation cache (--cache) """
+    if not args.cache:
+        err_die('please specify the annotation cache with --cache')
+    if not os.path.exists(args.cache):
+        err_die('annotation cache %s does not exist' % args.cache)
+
+    cache = AnnoCache(args.cache, None, args.cache_size, args.cache_age)
+    if args.clear:
+        err_print('removed %d entries' % cache.invalidate())
+    elif args.invalidate:
+        # keep only the entries of the databases as they are now
+        from .annodb import AnnoDB
+        from .config import read_config
+        args.mem = False
+        db = AnnoDB(args, read_config())
+        err_print('removed %d entries' % cache.invalidate(db.fingerprint()))
+    err_print('evicted %d entries' % cache.evict())
+
+    print('context\tentries\toldest\tnewest')
+    for context, cnt, amin, amax in cache.contexts():
+        print('%s\t%d\t%s\t%s' % (context, cnt,
+                                  time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(amin)),
+                                  time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(amax))))
+    cache.close(evict=False)
@@ -29,9 +29,17 @@ SOFTWARE.
 
 import os
 from .transcripts import *
-from .localdb import TransVarDB, recheck_resource
+from .localdb import TransVarDB, TransVarSQLDB, recheck_resource, file_fingerprint, open_dbsnp_index
+from .localdb import TabixCursor, vcf_interval
 from . import parser
 from pickle import load
+from collections import OrderedDict
+
+## dbSNP records looked up for a codon are fetched in blocks of
+## DBSNP_BLOCK bp, the DBSNP_CACHE most recent blocks are kept
+## for the neighbouring codons
+DBSNP_BLOCK = 1000
+DBSNP_CACHE = 64
 
 class AnnoDB():
 
@@ -49,66 +57,73 @@ class AnnoDB():
         
         replace_defaults(args, config)
         
-        faidx.init_refgenome(args.reference if args.reference else None)
+        faidx.init_refgenome(args.reference if args.reference else None,
+                             getattr(args, 'refblock', 16)*1024,
+                             getattr(args, 'refcache', faidx.REFCACHE_BLOCKS))
         self.session = None
-        self.name2gene = {}
-        self.name2trnx = {}
-        self.thash = None
+
+        if args.sql:
+            newdb = lambda dbfn, source: TransVarSQLDB(dbfn+'.sqlite', source=source)
+        else:
+            newdb = TransVarDB
 
         self.dbs = []
         if args.ensembl:
-            self.dbs.append(TransVarDB(args.ensembl, source='Ensembl'))
+            self.dbs.append(newdb(args.ensembl, source='Ensembl'))
         if args.gencode:
-            self.dbs.append(TransVarDB(args.gencode, source='GENCODE'))
+            self.dbs.append(newdb(args.gencode, source='GENCODE'))
         if args.kg:
-            self.dbs.append(TransVarDB(args.kg, source='KnownGene'))
+            self.dbs.append(newdb(args.kg, source='KnownGene'))
         if args.ucsc:
-            self.dbs.append(TransVarDB(args.ucsc, source='UCSCRefGene'))
+            self.dbs.append(newdb(args.ucsc, source='UCSCRefGene'))
         if args.refseq:
-            self.dbs.append(TransVarDB(args.refseq, source='RefSeq'))
+            self.dbs.append(newdb(args.refseq, source='RefSeq'))
         if args.ccds:
-            self.dbs.append(TransVarDB(args.ccds, source='CCDS'))
+            self.dbs.append(newdb(args.ccds, source='CCDS'))
         if args.aceview:
-            self.dbs.append(TransVarDB(args.aceview, source='AceView'))
+            self.dbs.append(newdb(args.aceview, source='AceView'))
         if args.kg:
-            self.dbs.append(TransVarDB(args.kg, source='KnownGene'))
+            self.dbs.append(newdb(args.kg, source='KnownGene'))
 
         ## TODO: fix uniprot
         # if args.uniprot:
         #     idmap = load(open(args.uniprot, 'rb'))
         #     for db in self.dbs:
         #         db.idmap = idmap
+        ## idmap files outside the databases, for the fingerprint
+        self.idmap_fns = []
         if args.idmap:
             for db in self.dbs:
                 # import pdb; pdb.set_trace()
                 inferred_path = db.dbfn+'.'+args.idmap+'.idmap_idx'
                 if os.path.isfile(args.idmap):
                     db.idmap = load(open(args.idmap, 'rb'))
+                    self.idmap_fns.append(args.idmap)
+                elif args.sql and db.load_idmap(args.idmap) is not None:
+                    db.idmap = db.load_idmap(args.idmap)
                 elif os.path.isfile(inferred_path):
                     db.idmap = load(open(inferred_path, 'rb'))
                 elif get_config(config, args.idmap, rv='idmap'):
                     # try database-independent idmapping
                     # import pdb; pdb.set_trace()
-                    db.idmap = load(open(recheck_resource(get_config(config, args.idmap, rv='idmap')), 'rb'))
+                    idmap_fn = recheck_resource(get_config(config, args.idmap, rv='idmap'))
+                    db.idmap = load(open(idmap_fn, 'rb'))
+                    self.idmap_fns.append(idmap_fn)
                 
         self.config = config
         self.args = args
         self.resources = {}
+        self.resource_fns = {}
+        self.dbsnp_blocks = OrderedDict()
+        self.dbsnp_index = None
+        self.dbsnp_cursor = None
         self.init_resource()
 
-        # The following in-memory processing is unfinished
-        # One needs to handle integratively transcript ID
-        # input and gene ID input. NOT necessary.
-        # The speed-up may not worth the effort.
+        # in-memory processing, each TransVarDB loads all its
+        # transcripts and answers queries without the file indices
         if args.mem:
             for db in self.dbs:
-                db.parse_all(self.name2gene, self.name2trnx)
-
-            self.thash = THash()
-            genes = set(self.name2gene.values())
-            for g in genes:
-                for t in g.tpts:
-                    self.thash.insert(t)
+                db.parse_all()
 
     def init_resource(self):
         """ init features and other annotation resources """
@@ -118,12 +133,33 @@ class AnnoDB():
                 dbfn = self.config.get(self.rv, 'dbsnp')
                 dbfn = recheck_resource(dbfn)
                 self.resources['dbsnp'] = tabix.open(dbfn)
+                self.resource_fns['dbsnp'] = dbfn
+                self.dbsnp_index = open_dbsnp_index(dbfn)
 
         self.features = []
         for rname in self.config.options(self.rv):
             featdb =  self.config.get(self.rv, rname)
             if featdb.endswith('.featuredb'):
                 self.features.append((rname,tabix.open(featdb)))
+                self.resource_fns[rname] = featdb
+
+    def fingerprint(self):
+
+        """ identifies the reference, the transcript databases and the
+        resources in use, for the persistent annotation cache """
+        import hashlib
+        from .version import __version__
+        fps = [__version__, self.rv, str(self.args.idmap)]
+        if faidx.refgenome is not None:
+            fps.append('reference='+file_fingerprint(faidx.refgenome.fasta_file))
+        for db in self.dbs:
+            fps.append(db.source+'='+db.fingerprint())
+        for rname in sorted(self.resource_fns):
+            fps.append(rname+'='+file_fingerprint(self.resource_fns[rname]))
+        # idmaps of the databases are among their index files
+        for fn in sorted(set(self.idmap_fns)):
+            fps.append('idmap='+file_fingerprint(fn))
+        return hashlib.sha1('\n'.join(fps).encode('utf-8')).hexdigest()
 
     def query_feature(self, r, chrm, beg, end):
         """ find all the dbsnp in a range """
@@ -132,13 +168,55 @@ class AnnoDB():
                 r.append_info('[feature:%s]=%s|%s:%s_%s' %
                               (rname, fields[3], fields[0], fields[1], fields[2]))
 
-    def _query_dbsnp_(self, chrm, beg, end, ref=None, alt=None):
-
+    def _dbsnp_block_(self, chrm, k):
+
+        """ dbSNP records starting in the k-th block of chrm """
+        key = (chrm, k)
+        if key in self.dbsnp_blocks:
+            self.dbsnp_blocks.move_to_end(key)
+            return self.dbsnp_blocks[key]
+
+        beg = k*DBSNP_BLOCK+1
+        rows = [fields[:5] for fields in tabix_query(
+            self.resources['dbsnp'], chrm, beg, beg+DBSNP_BLOCK-1) if int(fields[1]) >= beg]
+        self.dbsnp_blocks[key] = rows
+        if len(self.dbsnp_blocks) > DBSNP_CACHE:
+            self.dbsnp_blocks.popitem(last=False)
+        return rows
+
+    def _dbsnp_rows_(self, chrm, poss):
+
+        """ dbSNP records starting at any of poss, in file order """
+        chrm = normalize_chrm_dbsnp(chrm)
+        if self.dbsnp_index is not None:
+            rows = []
+            for pos in sorted(poss):
+                rows.extend(self.dbsnp_index.rows_at(chrm, pos))
+            return rows
+
+        rows = []
+        for k in sorted(set((pos-1)//DBSNP_BLOCK for pos in poss)):
+            rows.extend([fields for fields in self._dbsnp_block_(chrm, k)
+                         if int(fields[1]) in poss])
+        return rows
+
+    def _query_dbsnp_(self, chrm, beg, end, ref=None, alt=None, rows=None):
+
+        """ rows, if given, are the dbSNP records to match in place of a
+        tabix query (or a lookup in the allele index), it must include
+        all the records starting at beg (SNV) or beg-1 (indels and mnv) """
         dbsnps = []
         if 'dbsnp' in self.resources:
             if beg == end and (alt is None or len(alt)==1): # SNV
-                ret = tabix_query(
-                    self.resources['dbsnp'], normalize_chrm_dbsnp(chrm), int(beg), int(end))
+                if rows is not None:
+                    ret = rows
+                elif self.dbsnp_index is not None:
+                    ret = self.dbsnp_index.rows_at(normalize_chrm_dbsnp(chrm), int(beg))
+                elif self.dbsnp_cursor is not None:
+                    ret = self.dbsnp_cursor.get(normalize_chrm_dbsnp(chrm), int(beg), int(end))
+                else:
+                    ret = tabix_query(
+                        self.resources['dbsnp'], normalize_chrm_dbsnp(chrm), int(beg), int(end))
                 for fields in ret:
                     if int(fields[1]) != int(beg):
                         continue
@@ -153,8 +231,15 @@ class AnnoDB():
                     else:
                         dbsnps.append('%s(%s:%s%s>%s)' % (fields[2], chrm, fields[1], fields[3], alt))
             else:               # indels and mnv
-                ret = tabix_query(
-                    self.resources['dbsnp'], normalize_chrm_dbsnp(chrm), int(beg)-1, int(end))
+                if rows is not None:
+                    ret = rows
+                elif self.dbsnp_index is not None:
+                    ret = self.dbsnp_index.rows_at(normalize_chrm_dbsnp(chrm), int(beg)-1)
+                elif self.dbsnp_cursor is not None:
+                    ret = self.dbsnp_cursor.get(normalize_chrm_dbsnp(chrm), int(beg)-1, int(end))
+                else:
+                    ret = tabix_query(
+                        self.resources['dbsnp'], normalize_chrm_dbsnp(chrm), int(beg)-1, int(end))
                 for fields in ret:
                     if int(fields[1]) != int(beg)-1:
                         continue
@@ -181,7 +266,14 @@ class AnnoDB():
         
     def query_dbsnp_codon(self, r, codon, taa_alt):
 
-        """ find all the dbsnp in a codon """
+        """ find all the dbsnp in a codon
+        the records at the codon are fetched once and matched
+        against all the candidate alternative codons """
+        if 'dbsnp' not in self.resources:
+            return
+
+        poss = set(codon.locs) | set(loc-1 for loc in codon.locs)
+        rows = self._dbsnp_rows_(r.chrm, poss)
         dbsnps = []
         for tnuc_altseq in reverse_codon_table[taa_alt]:
             subs = []
@@ -193,7 +285,7 @@ class AnnoDB():
                 i, tnuc_altbase = subs[0]
                 gnuc_pos = codon.tloc(i)
                 gnuc_alt = tnuc_altbase if codon.strand == '+' else complement(tnuc_altbase)
-                dbsnps.extend(self._query_dbsnp_(r.chrm, gnuc_pos, gnuc_pos, alt=gnuc_alt))
+                dbsnps.extend(self._query_dbsnp_(r.chrm, gnuc_pos, gnuc_pos, alt=gnuc_alt, rows=rows))
 
             if len(subs) == 2:
                 i1 = subs[0][0]
@@ -203,7 +295,7 @@ class AnnoDB():
                     gnuc_end = max(codon.tloc(i1), codon.tloc(i2))
                     tnuc_alt = subs[0][1]+subs[1][1]
                     gnuc_alt = tnuc_alt if codon.strand == '+' else reverse_complement(tnuc_alt)
-                    dbsnps.extend(self._query_dbsnp_(r.chrm, gnuc_beg, gnuc_end, gnuc_alt))
+                    dbsnps.extend(self._query_dbsnp_(r.chrm, gnuc_beg, gnuc_end, gnuc_alt, rows=rows))
 
             if len(subs) == 3:
                 i1 = subs[0][0]
@@ -213,7 +305,7 @@ class AnnoDB():
                     gnuc_end = max(codon.tloc(i1), codon.tloc(i2))
                     tnuc_alt = codon.seq
                     gnuc_alt = codon.seq if codon.strand == '+' else reverse_complement(codon.seq)
-                    dbsnps.extend(self._query_dbsnp_(r.chrm, gnuc_beg, gnuc_end, gnuc_alt))
+                    dbsnps.extend(self._query_dbsnp_(r.chrm, gnuc_beg, gnuc_end, gnuc_alt, rows=rows))
 
         if dbsnps:
             r.append_info('dbsnp='+','.join(dbsnps))
@@ -231,6 +323,24 @@ class AnnoDB():
             for g in db.get(name, strictversion=strictversion):
                 yield g
 
+    def enable_sweep(self):
+        """ queries by location come sorted by coordinates, dbSNP
+        (unless it has the allele index) is merge-joined with the
+        queries in one pass instead of queried at random """
+        for db in self.dbs:
+            db.enable_sweep()
+        if 'dbsnp' in self.resources and self.dbsnp_index is None:
+            self.dbsnp_cursor = TabixCursor(self.resource_fns['dbsnp'], vcf_interval)
+
+    def codon_indices(self):
+
+        """ (TransVarDB, CodonIndex) of each database, None unless
+        all the databases have a codon table """
+        cidxs = [(db, db.get_codon_index()) for db in self.dbs]
+        if not cidxs or any(cidx is None for db, cidx in cidxs):
+            return None
+        return cidxs
+
     def get_transcripts(self, chrm, beg, end=None, flanking=0):
 
         for db in self.dbs:
@@ -35,9 +35,52 @@ from .utils import *
 from .config import read_config
 from .snv import __core_annotate_codon_snv
 from .record import Query, QueryREG
+from . import record
+from . import faidx
 
 outformat="{altid}\t{chrm}\t{codon1}\t{codon2}\t{tptstr}"
 
+def codon_seq(chrm, locs, strand):
+
+    """ sequence of a codon (ascending locations) from the reference,
+    in the transcript sense """
+    seq = ''.join(faidx.refgenome.fetch_sequence(chrm, loc, loc) for loc in locs)
+    if strand == '-':
+        seq = reverse_complement(seq)
+    return seq
+
+def codon_aa(chrm, locs, strand):
+
+    """ amino acid of a codon from the reference, X when the codon is
+    not translatable (e.g., N in the reference) """
+    try:
+        return codon2aa(codon_seq(chrm, locs, strand))
+    except IncompatibleTranscriptError:
+        return 'X'
+
+def _codons_at_(db, cidxs, t1, gpos, need_seq):
+
+    """ (transcript name, source, codon index, codon locations, codon
+    sequence) of the other transcripts with a coding base at gpos.
+    With the codon tables of transvar index the transcripts are not
+    loaded, the sequence is only fetched when need_seq is set """
+    if cidxs is None:
+        for t2 in db.get_transcripts(t1.chrm, gpos):
+            c2, p = t2.gpos2codon(gpos)
+            if t1 == t2: continue
+            if p.tpos != 0: continue
+            # if c2.region != 'coding': continue
+            if len(c2.seq) != 3: continue # often due to last incomplete codon
+            yield t2.name, t2.source, c2.index, c2.locs, c2.seq
+        return
+
+    for db2, cidx in cidxs:
+        for k, index, locs in cidx.codons_at(t1.chrm, gpos):
+            if len(locs) != 3: continue # last incomplete codon
+            strand = '+' if cidx.tstrands[k] > 0 else '-'
+            seq = codon_seq(t1.chrm, locs, strand) if need_seq else None
+            yield cidx.name(k)[0], db2.source, index, locs, seq
+
 def _main_core_(args, q, db):
 
     k2transcripts = {}
@@ -46,23 +89,19 @@ def _main_core_(args, q, db):
         q.ref = q.refseq
         q.alt = ''
 
+    cidxs = db.codon_indices()
     for t1, c1 in __core_annotate_codon_snv(args, q, db):
         # search any of the 3 positions
         for cind in range(3):
             gpos = c1.locs[cind]
-            for t2 in db.get_transcripts(t1.chrm, gpos):
-                c2, p = t2.gpos2codon(gpos)
-                if t1 == t2: continue
-                if p.tpos != 0: continue
-                # if c2.region != 'coding': continue
-                if c1.index == c2.index: continue
-                if len(c2.seq) != 3: continue # often due to last incomplete codon
-                if q.ref and q.ref != codon2aa(c2.seq): continue
+            for t2name, t2source, c2index, c2locs, c2seq in _codons_at_(db, cidxs, t1, gpos, bool(q.ref)):
+                if c1.index == c2index: continue
+                if q.ref and q.ref != codon2aa(c2seq): continue
                 altid = t1.gene.name+'.p.'
                 if q.ref: altid += q.ref
-                altid += str(c2.index)
-                k = (altid, c1.chrm, tuple(c1.locs), tuple(c2.locs))
-                tpair = '%s[%s]/%s[%s]' % (t1.name, t1.source, t2.name, t2.source)
+                altid += str(c2index)
+                k = (altid, c1.chrm, tuple(c1.locs), tuple(c2locs))
+                tpair = '%s[%s]/%s[%s]' % (t1.name, t1.source, t2name, t2source)
                 if k in k2transcripts:
                     if tpair not in k2transcripts[k]:
                         k2transcripts[k].append(tpair)
@@ -75,12 +114,12 @@ def _main_core_(args, q, db):
         else: s = ''
         s += outformat.format(altid=altid, tptstr=','.join(tpairs), chrm=chrm,
                               codon1='-'.join(map(str,c1)), codon2='-'.join(map(str,c2)))
-        print(s)
+        record.output.write(s)
 
 def main_list(args, db): #name2gene, thash):
 
     if not args.noheader:
-        print('origin_id\talt_id\tchrm\tcodon1\tcodon2\ttranscripts_choice')
+        record.output.write('origin_id\talt_id\tchrm\tcodon1\tcodon2\ttranscripts_choice')
     for q, line in list_parse_mutation(args, 'p'):
 
         genefound = False
@@ -99,7 +138,7 @@ def main_list(args, db): #name2gene, thash):
 def main_one(args, db): #name2gene, thash):
 
     if not args.noheader:
-        print('origin_id\talt_id\tchrm\tcodon1\tcodon2\ttranscripts_choice')
+        record.output.write('origin_id\talt_id\tchrm\tcodon1\tcodon2\ttranscripts_choice')
     q = parse_tok_mutation_str(args.i, 'p')
     q.op = args.i
     genefound = False
@@ -112,14 +151,83 @@ def main_one(args, db): #name2gene, thash):
         err_die('gene %s is not recognized.' % q.tok)
         return
 
+def _dump_gene_(args, cidx, source, chrm, gene, ks):
+
+    """ codonsearch of every codon of the transcripts ks of a gene """
+    k2transcripts = {}
+    for k1 in ks:
+        name1 = cidx.name(k1)[0]
+        for s1 in range(cidx.tsegs[k1], cidx.tsegs[k1+1]):
+            beg1, end1 = cidx.segment_range(s1)
+            for s2, beg2, end2 in cidx.segments(chrm, beg1, end1):
+                k2 = cidx.strnxs[s2]
+                beg, end = max(beg1, beg2), min(end1, end2)
+                # same frame on the same strand, the codon indices agree
+                if (cidx.tstrands[k1] == cidx.tstrands[k2] and
+                    cidx.cds_index(s1, beg) == cidx.cds_index(s2, beg)):
+                    continue
+                for gpos in range(beg, end+1):
+                    index1, locs1 = cidx.codon(k1, cidx.cds_index(s1, gpos))
+                    index2, locs2 = cidx.codon(k2, cidx.cds_index(s2, gpos))
+                    if index1 == index2 or len(locs1) != 3 or len(locs2) != 3:
+                        continue
+                    k = (index1, locs1, index2, locs2, cidx.tstrands[k1], cidx.tstrands[k2])
+                    tpair = '%s[%s]/%s[%s]' % (name1, source, cidx.name(k2)[0], source)
+                    if k in k2transcripts:
+                        if tpair not in k2transcripts[k]:
+                            k2transcripts[k].append(tpair)
+                    else:
+                        k2transcripts[k] = [tpair]
+
+    for k in sorted(k2transcripts):
+        index1, locs1, index2, locs2, strand1, strand2 = k
+        aa1 = aa2 = ''
+        if faidx.refgenome:
+            aa1 = codon_aa(chrm, locs1, '+' if strand1 > 0 else '-')
+            aa2 = codon_aa(chrm, locs2, '+' if strand2 > 0 else '-')
+        s = '%s:p.%s%d\t' % (gene, aa1, index1)
+        s += outformat.format(altid='%s.p.%s%d' % (gene, aa2, index2),
+                              tptstr=','.join(k2transcripts[k]), chrm=chrm,
+                              codon1='-'.join(map(str,locs1)), codon2='-'.join(map(str,locs2)))
+        record.output.write(s)
+
+def main_dump(args, db):
+
+    """ all the codons with more than one protein identifier across the
+    transcripts, from the codon tables (.codon_idx) of transvar index """
+    cidxs = db.codon_indices()
+    if cidxs is None:
+        err_die('no codon table, please rerun transvar index on the databases.')
+
+    if not args.noheader:
+        record.output.write('origin_id\talt_id\tchrm\tcodon1\tcodon2\ttranscripts_choice')
+    for _db, cidx in cidxs:
+        for chrm in sorted(cidx.chrm2arrays):
+            gene2ks = {}
+            genes = []
+            for k in cidx.transcripts_on(chrm):
+                gene = cidx.name(k)[1]
+                if gene not in gene2ks:
+                    gene2ks[gene] = []
+                    genes.append(gene)
+                gene2ks[gene].append(k)
+            for gene in genes:
+                _dump_gene_(args, cidx, _db.source, chrm, gene, gene2ks[gene])
+
 def main_codonsearch(args):
 
     config = read_config()
     db = AnnoDB(args, config)
     # name2gene, thash = parse_annotation(args)
 
-    if args.l:
-        main_list(args, db) #name2gene, thash)
-    if args.i:
-        main_one(args, db) #name2gene, thash)
+    out = record.open_output(args)
+    try:
+        if args.dump:
+            main_dump(args, db)
+        if args.l:
+            main_list(args, db) #name2gene, thash)
+        if args.i:
+            main_one(args, db) #name2gene, thash)
+    finally:
+        out.close()
 
@@ -1,18 +1,41 @@
 """ faidx python code adapted from Allen Yu
 http://www.allenyu.info/item/24-quickly-fetch-sequence-from-samtools-faidx-indexed-fasta-sequences.html """
-import sys
-import mmap
+import sys, os, re
+import mmap, struct
+from bisect import bisect_right
+from collections import OrderedDict
 
 from .err import *
 from .utils import *
+from . import tabix
+
+## upper-cases the bytes of a sequence through bytes.translate
+_upper_table = bytes(bytearray(range(256))).upper()
+
+## the reference is cached in aligned blocks of REFCACHE_BLOCK bases,
+## at most REFCACHE_BLOCKS blocks are kept (--refblock, --refcache)
+REFCACHE_BLOCK = 16384
+REFCACHE_BLOCKS = 256
 
 class RefGenome:
 
-    def __init__(self, fasta_file):
+    def __init__(self, fasta_file, block_size=REFCACHE_BLOCK, cache_blocks=REFCACHE_BLOCKS):
         self.faidx = {}
 
         self.fasta_file=fasta_file
 
+        ## LRU of decoded, upper-cased blocks keyed by (chrom, block index)
+        self.block_size = max(block_size, 1)
+        self.cache_blocks = max(cache_blocks, 0)
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_index()
+
+    def load_index(self):
+
+        fasta_file = self.fasta_file
         try:
             self.fasta_fd = open(fasta_file)
             self.fasta_handle = mmap.mmap(self.fasta_fd.fileno(), 0, access=mmap.ACCESS_READ)
@@ -42,27 +65,22 @@ class RefGenome:
             slen,offset,blen,bytelen=[int(i) for i in cols[1:]]
             self.faidx[chrom]=(slen,offset,blen,bytelen)
 
-    # Function to fetch sequence from an indexed fasta
-    # *chrom--Chromosome name (str)
-    # *start--Start position (1-based) (int)
-    # *end--End position (1-based) (int)
-    # *keepN--Keep ambiguous bases in sequence (boolean)
-    def fetch_sequence(self, chrom, start, end):
+    def resolve_chrm(self, chrom):
 
-        # Fetch a sequence from start to end in 1-based coordinates
-        seq=[]
-        seq_len=0
+        """ the name of chrom in the index, with or without the chr prefix """
+        if chrom in self.faidx:
+            return chrom
+        if chrom.startswith('chr') and chrom[3:] in self.faidx:
+            return chrom[3:]
+        if 'chr'+chrom in self.faidx:
+            return 'chr'+chrom
+        # sys.stderr.write('Chromosome %s not found in reference\n' % chrom)
+        raise SequenceRetrievalError('chromosome %s not found in reference' % chrom)
 
-        if chrom not in self.faidx:
-            if chrom.startswith('chr') and chrom[3:] in self.faidx:
-                chrom = chrom[3:]
-            elif 'chr'+chrom in self.faidx:
-                chrom = 'chr'+chrom
-            else:
-                # sys.stderr.write('Chromosome %s not found in reference\n' % chrom)
-                raise SequenceRetrievalError('chromosome %s not found in reference' % chrom)
+    def _window(self, chrom, start, end):
 
-        slen,offset,blen,bytelen=self.faidx[chrom]
+        """ the checked 0-based [start, end) window of chrom """
+        slen = self.faidx[chrom][0]
         start = start-1 #To 0-base
         # Sanity check of start and end position
         if start<0:
@@ -76,18 +94,71 @@ class RefGenome:
         if start>=end:
             raise SequenceRetrievalError('Start position %d is larger than end position %d' % (start+1,end))
 
-        self.fasta_handle.seek(offset+start//blen*bytelen+start%blen)
+        return start, end
+
+    # Function to fetch sequence from an indexed fasta
+    # *chrom--Chromosome name (str)
+    # *start--Start position (1-based) (int)
+    # *end--End position (1-based) (int)
+    def fetch_bytes(self, chrom, start, end):
+
+        """ the upper-cased sequence from start to end (1-based) as bytes,
+        the byte span is computed from the line geometry in .fai, sliced
+        from the mmap once and the line ends are dropped in the same
+        pass that upper-cases """
+        chrom = self.resolve_chrm(chrom)
+        slen,offset,blen,bytelen=self.faidx[chrom]
+        start, end = self._window(chrom, start, end)
+        b = offset + start//blen*bytelen + start%blen
+        e = offset + (end-1)//blen*bytelen + (end-1)%blen + 1
+        return self._read(b, e).translate(_upper_table, b'\r\n')
+
+    def _read(self, b, e):
+        return self.fasta_handle[b:e]
+
+    def _block(self, chrom, k):
+
+        key = (chrom, k)
+        seq = self.blocks.pop(key, None)
+        if seq is None:
+            self.misses += 1
+            slen = self.faidx[chrom][0]
+            b = k*self.block_size
+            e = min(b+self.block_size, slen)
+            seq = self.fetch_bytes(chrom, b+1, e).decode('ascii')
+            if len(self.blocks) >= self.cache_blocks:
+                self.blocks.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.hits += 1
+        self.blocks[key] = seq
+        return seq
+
+    def fetch_sequence(self, chrom, start, end):
+
+        """ the upper-cased sequence from start to end (1-based) as str,
+        windows up to half of the cache are served from the block cache """
+        if self.cache_blocks == 0 or end-start >= self.block_size*self.cache_blocks//2:
+            return self.fetch_bytes(chrom, start, end).decode('ascii')
+
+        chrom = self.resolve_chrm(chrom)
+        start, end = self._window(chrom, start, end)
+        kb = start // self.block_size
+        ke = (end-1) // self.block_size
+        b = kb*self.block_size
+        if kb == ke:
+            return self._block(chrom, kb)[start-b:end-b]
+        return ''.join([self._block(chrom, k) for k in range(kb, ke+1)])[start-b:end-b]
+
+    def cache_stats(self):
 
-        while seq_len<end-start:
-            line=self.fasta_handle.readline().decode()
-            line=line[:-1] #Remove newline symbols
-            seq_len=seq_len+len(line)
-            seq.append(line)
+        """ hits, misses and evictions of the block cache """
+        return self.hits, self.misses, self.evictions
 
-        seq=''.join(seq)
+    def format_cache_stats(self):
 
-        #chomp off extra bases
-        return seq[:end-start].upper()
+        return 'reference cache: %d hits, %d misses, %d evictions (%d blocks of %d bp)' % (
+            self.hits, self.misses, self.evictions, self.cache_blocks, self.block_size)
 
     def __exit__(self, type, value, traceback):
         self.fasta_handle.close()
@@ -95,12 +166,313 @@ class RefGenome:
         self.faidx_handle.close()
 
     def chrm2len(self, chrm):
-        slen,offset,blen,bytelen=self.faidx[chrm]
-        return slen
+        return self.faidx[chrm][0]
+
+## UCSC .2bit, 4 bases a byte (T, C, A, G from the high bits) with
+## tables of N blocks and soft-masked blocks for each sequence
+TWOBIT_MAGIC = 0x1A412743
+TWOBIT_BASES = b'TCAG'
+TWOBIT_CHUNK = 1<<22
+
+## byte -> base at each of its 4 positions, for bytes.translate
+_twobit_phases = [bytes(bytearray(TWOBIT_BASES[(x>>(6-2*i))&3] for x in range(256)))
+                  for i in range(4)]
+
+## base -> its 2-bit code shifted to each of the 4 positions,
+## N and other letters are packed as T (0) and covered by the N blocks
+_twobit_codes = []
+for _i in range(4):
+    _t = bytearray(256)
+    for _c, _x in zip(b'TCAGtcag', [0, 1, 2, 3, 0, 1, 2, 3]):
+        _t[_c] = _x<<(6-2*_i)
+    _twobit_codes.append(bytes(_t))
+
+_twobit_nre = re.compile(b'[^ACGTacgt]+')
+_twobit_mre = re.compile(b'[a-z]+')
+
+class TwoBitGenome(RefGenome):
+
+    """ reference in the .2bit format, faidx maps each sequence to
+    (length, offset of its record), the N blocks are read on the first
+    fetch of the sequence. Sequences are upper-cased as from the fasta,
+    so the soft-masked blocks are not used """
+
+    def load_index(self):
+
+        try:
+            self.fasta_fd = open(self.fasta_file, 'rb')
+            self.fasta_handle = mmap.mmap(self.fasta_fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except IOError:
+            raise SequenceRetrievalError('cannot open 2bit reference %s' % self.fasta_file)
+
+        mm = self.fasta_handle
+        self.endian = '<'
+        magic, version, nseqs, reserved = struct.unpack_from('<IIII', mm, 0)
+        if magic != TWOBIT_MAGIC:
+            self.endian = '>'
+            magic, version, nseqs, reserved = struct.unpack_from('>IIII', mm, 0)
+        if magic != TWOBIT_MAGIC or version not in (0, 1):
+            raise SequenceRetrievalError('%s is not a 2bit file' % self.fasta_file)
+
+        ## version 1 has 64-bit record offsets
+        ofmt = self.endian + ('Q' if version == 1 else 'I')
+        osize = struct.calcsize(ofmt)
+        p = 16
+        for i in range(nseqs):
+            n = mm[p]
+            name = mm[p+1:p+1+n].decode('ascii')
+            offset, = struct.unpack_from(ofmt, mm, p+1+n)
+            p += 1+n+osize
+            slen, = struct.unpack_from(self.endian+'I', mm, offset)
+            self.faidx[normalize_chrm(name)] = (slen, offset)
+        self.nblocks = {}
+
+    def _nblocks(self, chrom):
+
+        """ N block starts and ends, and the offset of the packed bases """
+        if chrom in self.nblocks:
+            return self.nblocks[chrom]
+
+        mm = self.fasta_handle
+        slen, offset = self.faidx[chrom]
+        p = offset+4
+        n, = struct.unpack_from(self.endian+'I', mm, p)
+        starts = struct.unpack_from('%s%dI' % (self.endian, n), mm, p+4)
+        sizes = struct.unpack_from('%s%dI' % (self.endian, n), mm, p+4+4*n)
+        p += 4+8*n
+        m, = struct.unpack_from(self.endian+'I', mm, p)
+        p += 4+8*m+4            # skip mask blocks and the reserved word
+        blocks = (starts, [b+z for b, z in zip(starts, sizes)], p)
+        self.nblocks[chrom] = blocks
+        return blocks
+
+    def fetch_bytes(self, chrom, start, end):
+
+        """ the upper-cased sequence from start to end (1-based) as bytes,
+        the packed bytes are expanded by one bytes.translate for each of
+        the 4 positions in a byte, then the N blocks are filled in """
+        chrom = self.resolve_chrm(chrom)
+        start, end = self._window(chrom, start, end)
+        nstarts, nends, dna = self._nblocks(chrom)
+        packed = self.fasta_handle[dna+start//4:dna+(end-1)//4+1]
+        seq = bytearray(4*len(packed))
+        for i in range(4):
+            seq[i::4] = packed.translate(_twobit_phases[i])
+        b = start - start%4
+        del seq[end-b:]
+        del seq[:start-b]
+
+        i = max(bisect_right(nstarts, start)-1, 0)
+        while i < len(nstarts) and nstarts[i] < end:
+            nb = max(nstarts[i], start)
+            ne = min(nends[i], end)
+            if nb < ne:
+                seq[nb-start:ne-start] = b'N'*(ne-nb)
+            i += 1
+
+        return bytes(seq)
+
+    def __exit__(self, type, value, traceback):
+        self.fasta_handle.close()
+        self.fasta_fd.close()
+
+def _twobit_runs(seq, pattern, offset, runs):
+
+    """ append the runs of pattern in seq to the (start, size) runs,
+    a run continuing the last one is merged """
+    for m in pattern.finditer(seq):
+        b = offset+m.start()
+        z = m.end()-m.start()
+        if runs and runs[-1][0]+runs[-1][1] == b:
+            runs[-1][1] += z
+        else:
+            runs.append([b, z])
+
+def _twobit_pack(seq):
+
+    """ pack bases, of a length multiple of 4, into bytes, the bases
+    of each of the 4 positions are shifted in place by translate and
+    combined as big integers """
+    n = len(seq)//4
+    packed = 0
+    for i in range(4):
+        codes = seq[i::4].translate(_twobit_codes[i])
+        packed |= int.from_bytes(codes, 'big')
+    return packed.to_bytes(n, 'big')
+
+class TwoBitRecord():
+
+    """ packs the bases of one sequence as they are read,
+    with its N and mask blocks """
+
+    def __init__(self, name):
+        self.name = name
+        self.packed = []
+        self.slen = 0
+        self.nruns = []
+        self.mruns = []
+        self.rest = b''
+
+    def add(self, seq, last=False):
+
+        seq = self.rest + seq
+        k = len(seq) if last else len(seq)//4*4
+        self.rest = seq[k:]
+        seq = seq[:k]
+        _twobit_runs(seq, _twobit_nre, self.slen, self.nruns)
+        _twobit_runs(seq, _twobit_mre, self.slen, self.mruns)
+        self.slen += k
+        if k % 4:
+            seq += b'T'*(4-k%4)
+        self.packed.append(_twobit_pack(seq))
+
+    def write(self, out):
+
+        out.write(struct.pack('<I', self.slen))
+        for runs in (self.nruns, self.mruns):
+            out.write(struct.pack('<I', len(runs)))
+            out.write(struct.pack('<%dI' % len(runs), *[b for b, z in runs]))
+            out.write(struct.pack('<%dI' % len(runs), *[z for b, z in runs]))
+        out.write(struct.pack('<I', 0))
+        for p in self.packed:
+            out.write(p)
+
+def write_twobit(fasta_fn, twobit_fn):
+
+    """ pack a fasta into the UCSC .2bit format, N and lower-case
+    runs are kept as the N and mask blocks """
+
+    ## sequence names first, the index precedes the records
+    names = []
+    fh = opengz(fasta_fn)
+    for line in fh:
+        if line.startswith('>'):
+            names.append(line[1:].split()[0])
+    fh.close()
+
+    out = open(twobit_fn, 'wb')
+    out.write(struct.pack('<IIII', TWOBIT_MAGIC, 0, len(names), 0))
+    out.write(b'\0'*sum(1+len(name)+4 for name in names))
+
+    offsets = []
+    def write_record(r):
+        r.add(b'', True)
+        offsets.append(out.tell())
+        if offsets[-1] >= 1<<32:
+            err_die('%s exceeds 4GB, the limit of the 2bit format' % twobit_fn)
+        r.write(out)
+
+    r = None
+    lines = []
+    nbases = 0
+    fh = opengz(fasta_fn)
+    for line in fh:
+        if line.startswith('>'):
+            if r is not None:
+                r.add(b''.join(lines))
+                write_record(r)
+            r = TwoBitRecord(line[1:].split()[0])
+            lines = []
+            nbases = 0
+        else:
+            line = line.strip().encode('ascii')
+            lines.append(line)
+            nbases += len(line)
+            if nbases >= TWOBIT_CHUNK:
+                r.add(b''.join(lines))
+                lines = []
+                nbases = 0
+    if r is not None:
+        r.add(b''.join(lines))
+        write_record(r)
+    fh.close()
+
+    out.seek(16)
+    for name, offset in zip(names, offsets):
+        out.write(struct.pack('<B', len(name))+name.encode('ascii')+struct.pack('<I', offset))
+    out.close()
+
+## decompressed blocks (64kb each) kept for a bgzip compressed reference
+BGZF_CACHE_BLOCKS = 64
+
+def read_gzi(fn):
+
+    """ the compressed and the uncompressed offsets of the BGZF blocks
+    of fn, from the fn.gzi of samtools faidx, or by walking the block
+    headers when there is no .gzi """
+    coffsets = [0]
+    uoffsets = [0]
+    if os.path.exists(fn+'.gzi'):
+        with open(fn+'.gzi', 'rb') as fh:
+            n, = struct.unpack('<Q', fh.read(8))
+            offsets = struct.unpack('<%dQ' % (2*n), fh.read(16*n))
+        coffsets.extend(offsets[0::2])
+        uoffsets.extend(offsets[1::2])
+        return coffsets, uoffsets
+
+    with open(fn, 'rb') as fh:
+        c = 0
+        while True:
+            header = fh.read(18)
+            if len(header) < 18:
+                break
+            if header[:4] != b'\x1f\x8b\x08\x04' or header[12:14] != b'BC':
+                raise SequenceRetrievalError('%s is not compressed by bgzip' % fn)
+            bsize, = struct.unpack_from('<H', header, 16)
+            fh.seek(c+bsize-3)
+            isize, = struct.unpack('<I', fh.read(4))
+            c += bsize+1
+            coffsets.append(c)
+            uoffsets.append(uoffsets[-1]+isize)
+            fh.seek(c)
+    return coffsets, uoffsets
+
+class BGZFGenome(RefGenome):
+
+    """ bgzip compressed fasta with the .fai (and optionally the .gzi)
+    of samtools faidx, read through the BGZF reader of the tabix
+    extension, which keeps BGZF_CACHE_BLOCKS decompressed blocks """
+
+    def load_index(self):
+
+        fasta_file = self.fasta_file
+        try:
+            self.fasta_handle = tabix.bgzf(fasta_file, BGZF_CACHE_BLOCKS<<16)
+        except tabix.TabixError:
+            raise SequenceRetrievalError('cannot open reference %s' % fasta_file)
+        try:
+            self.faidx_handle = open(fasta_file+".fai")
+        except IOError:
+            raise SequenceRetrievalError('samtools faidx file doesn\'t exist for reference %s' % fasta_file)
+        self.load_faidx()
+        self.faidx_handle.close()
+        self.coffsets, self.uoffsets = read_gzi(fasta_file)
+
+    def _read(self, b, e):
+
+        """ uncompressed bytes [b, e) from the virtual offset of b """
+        i = bisect_right(self.uoffsets, b)-1
+        return self.fasta_handle.read((self.coffsets[i]<<16) | (b-self.uoffsets[i]), e-b)
+
+    def __exit__(self, type, value, traceback):
+        self.fasta_handle = None
+
+def open_refgenome(fn, block_size=REFCACHE_BLOCK, cache_blocks=REFCACHE_BLOCKS):
+
+    """ a RefGenome of fn, a .2bit, a bgzip compressed or a plain fasta
+    indexed by samtools faidx """
+    if fn.endswith('.2bit'):
+        return TwoBitGenome(fn, block_size, cache_blocks)
+    if fn.endswith('.gz'):
+        return BGZFGenome(fn, block_size, cache_blocks)
+    return RefGenome(fn, block_size, cache_blocks)
+
+## the reference in use, set by init_refgenome
+refgenome = None
 
-def init_refgenome(r=None):
+def init_refgenome(r=None, block_size=REFCACHE_BLOCK, cache_blocks=REFCACHE_BLOCKS):
     global refgenome
-    refgenome = RefGenome(r) if r else None
+    refgenome = open_refgenome(r, block_size, cache_blocks) if r else None
 
 def getseq(chrm, beg, end):
 
@@ -31,18 +31,14 @@ from . import argparse
 from . import parser
 import sys
 import re, os
+import struct, mmap, zlib
+from array import array
+from bisect import bisect_left, bisect_right
 from .utils import *
 from .transcripts import *
 from pickle import load, dump
 from . import faidx
 from . import tabix
-import subprocess
-
-## tabix and bgzip is now a dependency, but only when featuredb and indexing is used
-# tabix_path = '%s/tabix' % os.path.abspath(os.path.dirname(__file__))
-tabix_path = 'tabix'
-# bgzip_path = '%s/bgzip' % os.path.abspath(os.path.dirname(__file__))
-bgzip_path = 'bgzip'
 
 def recheck_resource(dbfn):
 
@@ -52,12 +48,934 @@ def recheck_resource(dbfn):
         
     return dbfn
 
+def file_fingerprint(fn, chunk=1<<16):
+
+    """ size, modification time, inode and digest of the head and
+    the tail of a file, changes when the file is rebuilt or replaced
+    (even by one of the same size) """
+    import hashlib
+    h = hashlib.sha1()
+    st = os.stat(fn)
+    with open(fn, 'rb') as fh:
+        h.update(fh.read(chunk))
+        if st.st_size > chunk:
+            fh.seek(max(chunk, st.st_size-chunk))
+            h.update(fh.read(chunk))
+    return '%d:%d:%d:%s' % (st.st_size, st.st_mtime_ns, st.st_ino, h.hexdigest())
+
+## binary .transvardb (format version 2)
+## the file starts with the magic and the format version, followed by
+## one record per transcript: a fixed-width header (version, beg, end,
+## cds_beg, cds_end, number of exons, length of the string block), the
+## tab-joined string block (gene name, transcript name, transcript type,
+## chromosome, strand, aliases, gene dbxref) and the exons as int32 pairs
+TRANSVARDB_MAGIC = b'TVDB'
+TRANSVARDB_VERSION = 2
+_db_header = struct.Struct('<4sI')
+_trnx_header = struct.Struct('<iiiiiII')
+
+p_int = re.compile(r'\d+')
+def parse_exons(s):
+
+    """ parse the exon list of the text .transvardb, e.g.,
+    [(5016, 5254), (7560, 7687)] """
+    a = [int(_) for _ in p_int.findall(s)]
+    return list(zip(a[::2], a[1::2]))
+
+class PackedTranscript(Transcript, object):
+
+    """ transcript read from a binary .transvardb
+    the exon array stays packed until first accessed
+    """
+
+    def __init__(self, buf, exon_pos, nexons):
+
+        Transcript.__init__(self)
+        self._buf = buf
+        self._exon_pos = exon_pos
+        self._nexons = nexons
+        self._exons = None
+
+    @property
+    def exons(self):
+        if self._exons is None:
+            a = struct.unpack_from('<%di' % (self._nexons*2), self._buf, self._exon_pos)
+            self._exons = list(zip(a[::2], a[1::2]))
+            self._buf = None
+        return self._exons
+
+    @exons.setter
+    def exons(self, exons):
+        self._exons = exons
+
+## sorted name index (.gene_idx and .trxn_idx)
+## the file starts with the magic, the number of names and whether a
+## name maps to a list of locations, followed by the uint64 offsets
+## of the entries and the entries sorted by name. Each entry holds the
+## name length, the number of locations, the utf-8 name and the
+## locations in .transvardb as uint64
+NAMEIDX_MAGIC = b'TVNI'
+_nameidx_header = struct.Struct('<4sII')
+_nameidx_entry = struct.Struct('<HI')
+
+class NameIndex():
+
+    """ index from gene or transcript names to .transvardb locations
+    the file is mmapped and searched by bisection, nothing is loaded
+    up front and the pages are shared between processes
+    """
+
+    def __init__(self, fn, mm=None, base=0):
+
+        """ the index is either the file fn or embedded in mm from base """
+        if mm is None:
+            self.fh = open(fn, 'rb')
+            mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mm = mm
+        self.base = base
+        _, self.n, self.multi = _nameidx_header.unpack_from(self.mm, base)
+
+    def _entry(self, i):
+
+        """ name, location of the first location and number of locations
+        of the i-th entry """
+        pos, = struct.unpack_from('<Q', self.mm, self.base+_nameidx_header.size+8*i)
+        pos += self.base
+        nlen, nlocs = _nameidx_entry.unpack_from(self.mm, pos)
+        pos += _nameidx_entry.size
+        return self.mm[pos:pos+nlen], pos+nlen, nlocs
+
+    def _find(self, name):
+
+        key = name.encode('utf-8')
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo+hi)//2
+            if self._entry(mid)[0] < key:
+                lo = mid+1
+            else:
+                hi = mid
+
+        if lo < self.n:
+            k, pos, nlocs = self._entry(lo)
+            if k == key:
+                return pos, nlocs
+        return None
+
+    def get(self, name, default=None):
+
+        """ location (or list of locations if multi) of name """
+        e = self._find(name)
+        if e is None:
+            return default
+        pos, nlocs = e
+        locs = list(struct.unpack_from('<%dQ' % nlocs, self.mm, pos))
+        if self.multi:
+            return locs
+        else:
+            return locs[0]
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def __getitem__(self, name):
+        locs = self.get(name)
+        if locs is None:
+            raise KeyError(name)
+        return locs
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self._entry(i)[0].decode('utf-8')
+
+    @staticmethod
+    def write(fn, name2locs, multi):
+
+        """ write a dictionary from name to location (or list of
+        locations if multi) """
+        entries = []
+        for name, locs in name2locs.items():
+            if not multi:
+                locs = [locs]
+            entries.append((name.encode('utf-8'), locs))
+        entries.sort()
+
+        with open(fn, 'wb') as fh:
+            NameIndex.write_entries(fh, entries, multi)
+
+    @staticmethod
+    def write_entries(fh, entries, multi):
+
+        """ write (name in bytes, list of locations) sorted by name
+        from the current position of fh, entry offsets are relative
+        to that position """
+        fh.write(_nameidx_header.pack(NAMEIDX_MAGIC, len(entries), int(multi)))
+        pos = _nameidx_header.size + 8*len(entries)
+        for key, locs in entries:
+            fh.write(struct.pack('<Q', pos))
+            pos += _nameidx_entry.size + len(key) + 8*len(locs)
+        for key, locs in entries:
+            fh.write(_nameidx_entry.pack(len(key), len(locs)))
+            fh.write(key)
+            fh.write(struct.pack('<%dQ' % len(locs), *locs))
+
+def load_name_index(fn):
+
+    """ load .gene_idx or .trxn_idx, which is either a NameIndex
+    or a dictionary pickled by older TransVar """
+    with open(fn, 'rb') as fh:
+        magic = fh.read(len(NAMEIDX_MAGIC))
+    if magic == NAMEIDX_MAGIC:
+        return NameIndex(fn)
+    else:
+        return load(open(fn, 'rb'))
+
+## closest transcript index (.closest_idx)
+## the file starts with the magic and the number of chromosomes,
+## followed by one directory entry per chromosome (name length, name,
+## number of transcripts, offset of the arrays). The arrays of a
+## chromosome are the transcript begins in location order, the
+## .transvardb locations of these transcripts, the transcript ends in
+## ascending order and the .transvardb locations of those transcripts.
+## The arrays are in native byte order.
+CLOSESTIDX_MAGIC = b'TVCI'
+_closestidx_header = struct.Struct('<4sI')
+_closestidx_chrm = struct.Struct('<HIQ')
+
+class ClosestIndex():
+
+    """ per-chromosome sorted arrays of transcript begins and ends
+    mmapped so that the closest transcript upstream or downstream
+    of a position is found by bisection """
+
+    def __init__(self, fn):
+
+        self.fh = open(fn, 'rb')
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        mv = memoryview(self.mm)
+        _, nchrm = _closestidx_header.unpack_from(self.mm, 0)
+        pos = _closestidx_header.size
+        self.chrm2arrays = {}
+        for i in range(nchrm):
+            nlen, n, off = _closestidx_chrm.unpack_from(self.mm, pos)
+            pos += _closestidx_chrm.size
+            chrm = self.mm[pos:pos+nlen].decode('utf-8')
+            pos += nlen
+            begs = mv[off:off+4*n].cast('i')
+            off += 4*n
+            beg_locs = mv[off:off+8*n].cast('q')
+            off += 8*n
+            ends = mv[off:off+4*n].cast('i')
+            off += 4*n
+            end_locs = mv[off:off+8*n].cast('q')
+            self.chrm2arrays[chrm] = (begs, beg_locs, ends, end_locs)
+
+    def upstream(self, chrm, pos):
+
+        """ .transvardb location of the transcript with
+        the greatest end before pos, None if not found """
+        if chrm not in self.chrm2arrays:
+            return None
+        begs, beg_locs, ends, end_locs = self.chrm2arrays[chrm]
+        i = bisect_left(ends, pos) - 1
+        if i < 0:
+            return None
+        return end_locs[i]
+
+    def downstream(self, chrm, pos):
+
+        """ .transvardb location of the transcript with
+        the smallest begin after pos, None if not found """
+        if chrm not in self.chrm2arrays:
+            return None
+        begs, beg_locs, ends, end_locs = self.chrm2arrays[chrm]
+        i = bisect_right(begs, pos)
+        if i >= len(begs):
+            return None
+        return beg_locs[i]
+
+    @staticmethod
+    def write(fn, tpts):
+
+        """ tpts is a list of (chrm, beg, end, .transvardb location)
+        in location order """
+        chrm2tpts = {}
+        chrms = []
+        for chrm, beg, end, loc in tpts:
+            if chrm not in chrm2tpts:
+                chrm2tpts[chrm] = []
+                chrms.append(chrm)
+            chrm2tpts[chrm].append((beg, end, loc))
+
+        keys = [chrm.encode('utf-8') for chrm in chrms]
+        off = _closestidx_header.size + sum(_closestidx_chrm.size+len(k) for k in keys)
+        with open(fn, 'wb') as fh:
+            fh.write(_closestidx_header.pack(CLOSESTIDX_MAGIC, len(chrms)))
+            for chrm, key in zip(chrms, keys):
+                n = len(chrm2tpts[chrm])
+                fh.write(_closestidx_chrm.pack(len(key), n, off))
+                fh.write(key)
+                off += 24*n
+            for chrm in chrms:
+                _tpts = chrm2tpts[chrm]
+                # among equal ends, the first in location order comes last
+                endorder = sorted(range(len(_tpts)), key=lambda i: (_tpts[i][1], -i))
+                fh.write(array('i', [t[0] for t in _tpts]).tobytes())
+                fh.write(array('q', [t[2] for t in _tpts]).tobytes())
+                fh.write(array('i', [_tpts[i][1] for i in endorder]).tobytes())
+                fh.write(array('q', [_tpts[i][2] for i in endorder]).tobytes())
+
+## codon table (.codon_idx), the transcripts and codons at every coding
+## position, as found by a location query and gpos2codon.
+## The file starts with the magic, the number of transcripts, segments
+## and chromosomes and one directory entry per chromosome (name length,
+## number of segments, longest segment, offset of the arrays). The
+## transcripts are in location order, each with the range of its CDS
+## segments, its CDS length and strand and the offset of its name and
+## gene name. A CDS segment has the position of its first base and its
+## cDNA index (as CDSPositions). The arrays of a chromosome are the
+## begins, the ends and the segment indices of the CDS segments sorted
+## by begin, clipped to the transcript as in a .loc_idx query.
+CODONIDX_MAGIC = b'TVCT'
+_codonidx_header = struct.Struct('<4sIII')
+_codonidx_chrm = struct.Struct('<HIIQ')
+
+class CodonIndex():
+
+    """ codons at a genomic position without loading the transcripts """
+
+    def __init__(self, fn):
+
+        self.fh = open(fn, 'rb')
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        mv = memoryview(self.mm)
+        _, nt, nseg, nchrm = _codonidx_header.unpack_from(self.mm, 0)
+        pos = _codonidx_header.size
+        self.chrm2arrays = {}
+        for i in range(nchrm):
+            nlen, n, maxlen, off = _codonidx_chrm.unpack_from(self.mm, pos)
+            pos += _codonidx_chrm.size
+            chrm = self.mm[pos:pos+nlen].decode('utf-8')
+            pos += nlen
+            los = mv[off:off+4*n].cast('i')
+            his = mv[off+4*n:off+8*n].cast('i')
+            segs = mv[off+8*n:off+12*n].cast('I')
+            self.chrm2arrays[chrm] = (los, his, segs, maxlen)
+
+        arrays = []
+        for fmt, n in [('I', nt+1), ('i', nt), ('i', nt), ('I', nt+1),
+                       ('i', nseg), ('i', nseg), ('I', nseg)]:
+            arrays.append(mv[pos:pos+4*n].cast(fmt))
+            pos += 4*n
+        (self.tsegs, self.tlens, self.tstrands, self.tnames,
+         self.sfirsts, self.sstarts, self.strnxs) = arrays
+        self.namebeg = pos
+
+    def __len__(self):
+        return len(self.tlens)
+
+    def name(self, k):
+
+        """ transcript name and gene name of the k-th transcript """
+        beg = self.namebeg+self.tnames[k]
+        end = self.namebeg+self.tnames[k+1]
+        return tuple(self.mm[beg:end].decode('utf-8').split('\t'))
+
+    def gpos(self, k, i):
+
+        """ genomic position of the i-th (0-based) CDS base of transcript k """
+        s = bisect_right(self.sstarts, i, self.tsegs[k], self.tsegs[k+1]) - 1
+        if self.tstrands[k] > 0:
+            return self.sfirsts[s] + (i - self.sstarts[s])
+        else:
+            return self.sfirsts[s] - (i - self.sstarts[s])
+
+    def codon(self, k, i):
+
+        """ index and locations of the codon of the i-th CDS base of
+        transcript k, the locations are short for an incomplete codon and
+        ascending on either strand (as gpos2codon) """
+        j = i - i%3
+        locs = tuple(self.gpos(k, _) for _ in range(j, min(j+3, self.tlens[k])))
+        if self.tstrands[k] < 0:
+            locs = locs[::-1]
+        return i//3+1, locs
+
+    def segment_range(self, s):
+
+        """ genomic range of segment s (not clipped) """
+        k = self.strnxs[s]
+        end = self.sstarts[s+1] if s+1 < self.tsegs[k+1] else self.tlens[k]
+        size = end - self.sstarts[s]
+        if self.tstrands[k] > 0:
+            return self.sfirsts[s], self.sfirsts[s]+size-1
+        else:
+            return self.sfirsts[s]-size+1, self.sfirsts[s]
+
+    def segments(self, chrm, beg, end):
+
+        """ (segment, begin, end) of the CDS segments (clipped to their
+        transcript) overlapping [beg, end] """
+        chrm = normalize_chrm(chrm)
+        if chrm not in self.chrm2arrays:
+            return []
+        los, his, segs, maxlen = self.chrm2arrays[chrm]
+        ss = []
+        i = bisect_right(los, end) - 1
+        while i >= 0 and los[i] >= beg - maxlen:
+            if his[i] >= beg:
+                ss.append((segs[i], los[i], his[i]))
+            i -= 1
+        return ss
+
+    def transcripts_on(self, chrm):
+
+        """ the transcripts of chrm, in location order """
+        los, his, segs, maxlen = self.chrm2arrays[chrm]
+        return sorted(set(self.strnxs[s] for s in segs))
+
+    def cds_index(self, s, gpos):
+
+        """ cDNA index (0-based) of gpos in segment s """
+        if self.tstrands[self.strnxs[s]] > 0:
+            return self.sstarts[s] + (gpos - self.sfirsts[s])
+        else:
+            return self.sstarts[s] + (self.sfirsts[s] - gpos)
+
+    def codons_at(self, chrm, gpos):
+
+        """ (transcript, codon index, codon locations) of the transcripts
+        with a coding base at gpos, in location order as get_by_loc """
+        ret = []
+        for s, beg, end in self.segments(chrm, gpos, gpos):
+            k = self.strnxs[s]
+            index, locs = self.codon(k, self.cds_index(s, gpos))
+            ret.append((k, index, locs))
+        ret.sort()
+        return ret
+
+    @staticmethod
+    def write(fn, tpts):
+
+        """ tpts is a list of transcripts in location order """
+        chrm2segs = {}
+        chrms = []
+        tsegs = array('I', [0])
+        tlens = array('i')
+        tstrands = array('i')
+        tnames = array('I', [0])
+        names = []
+        sfirsts = array('i')
+        sstarts = array('i')
+        strnxs = array('I')
+        nameoff = 0
+        for k, t in enumerate(tpts):
+            np = CDSPositions(t)
+            chrm = normalize_chrm(t.chrm)
+            if chrm not in chrm2segs:
+                chrm2segs[chrm] = []
+                chrms.append(chrm)
+            for start, first, bound in zip(np.starts, np.firsts, np.bounds):
+                if t.strand == '+':
+                    beg, end = first, bound
+                else:
+                    beg, end = -bound, first
+                # a .loc_idx query at t.beg misses t
+                beg = max(beg, t.beg+1)
+                end = min(end, t.end)
+                if beg <= end:
+                    chrm2segs[chrm].append((beg, end, len(sfirsts)))
+                sfirsts.append(first)
+                sstarts.append(start)
+                strnxs.append(k)
+            tsegs.append(len(sfirsts))
+            tlens.append(len(np))
+            tstrands.append(1 if t.strand == '+' else -1)
+            name = ('%s\t%s' % (t.name, t.gene_name)).encode('utf-8')
+            names.append(name)
+            nameoff += len(name)
+            tnames.append(nameoff)
+
+        keys = [chrm.encode('utf-8') for chrm in chrms]
+        off = _codonidx_header.size + sum(_codonidx_chrm.size+len(k) for k in keys)
+        off += 4*(len(tsegs)+len(tlens)+len(tstrands)+len(tnames)+3*len(sfirsts)) + nameoff
+        with open(fn, 'wb') as fh:
+            fh.write(_codonidx_header.pack(CODONIDX_MAGIC, len(tpts), len(sfirsts), len(chrms)))
+            for chrm, key in zip(chrms, keys):
+                segs = chrm2segs[chrm]
+                segs.sort()
+                chrm2segs[chrm] = segs
+                maxlen = max([end-beg for beg, end, s in segs] or [0])
+                fh.write(_codonidx_chrm.pack(len(key), len(segs), maxlen, off))
+                fh.write(key)
+                off += 12*len(segs)
+            for a in [tsegs, tlens, tstrands, tnames, sfirsts, sstarts, strnxs]:
+                fh.write(a.tobytes())
+            fh.write(b''.join(names))
+            for chrm in chrms:
+                segs = chrm2segs[chrm]
+                fh.write(array('i', [s[0] for s in segs]).tobytes())
+                fh.write(array('i', [s[1] for s in segs]).tobytes())
+                fh.write(array('I', [s[2] for s in segs]).tobytes())
+
+## spliced CDS sequence cache (.cds_seq), written by transvar index
+## when a reference is given. The file starts with the magic, the
+## location of the embedded NameIndex, and the fingerprint of the
+## reference, followed by the zlib-compressed CDS sequences (each
+## preceded by its length) and a NameIndex from the transcript key
+## (see cds_seq_key) to the location of its sequence.
+## The fingerprint is the stamp of the reference file (see
+## ref_file_stamp) on the first line, then one line of chromosome,
+## length and digest (see ref_chrm_digest) for every chromosome with
+## a cached transcript
+CDSSEQ_MAGIC = b'TVCS'
+_cdsseq_header = struct.Struct('<4sQI')
+
+## bases hashed at a time by ref_chrm_digest
+REF_DIGEST_BLOCK = 1<<22
+
+def cds_seq_key(t):
+    return '%s\t%s\t%d\t%d\t%d\t%d' % (t.name, t.chrm, t.beg, t.end, t.cds_beg, t.cds_end)
+
+def ref_file_stamp(refgenome):
+
+    """ size, modification time and inode of the reference file """
+    st = os.stat(refgenome.fasta_file)
+    return '%d:%d:%d' % (st.st_size, st.st_mtime_ns, st.st_ino)
+
+def ref_chrm_digest(refgenome, chrm):
+
+    """ length and sha1 of the (upper-cased) sequence of chrm,
+    the same for a fasta and the .2bit or bgzip of it """
+    import hashlib
+    h = hashlib.sha1()
+    slen = refgenome.chrm2len(refgenome.resolve_chrm(chrm))
+    for beg in range(1, slen+1, REF_DIGEST_BLOCK):
+        h.update(refgenome.fetch_bytes(chrm, beg, min(beg+REF_DIGEST_BLOCK-1, slen)))
+    return '%d:%s' % (slen, h.hexdigest())
+
+def parse_ref_fingerprint(fp):
+
+    """ the file stamp and the digest of each chromosome,
+    (None, {}) for caches written before the digests """
+    lines = fp.split('\n')
+    if len(lines) < 2:
+        return None, {}
+    chrm2digest = {}
+    for line in lines[1:]:
+        chrm, _, digest = line.partition('\t')
+        chrm2digest[chrm] = digest
+    return lines[0], chrm2digest
+
+class CDSSeqDB():
+
+    """ spliced CDS sequences read by Transcript.ensure_seq
+    instead of splicing from the reference
+    """
+
+    def __init__(self, fn):
+
+        self.fh = open(fn, 'rb')
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        _, idx_pos, fplen = _cdsseq_header.unpack_from(self.mm, 0)
+        self.fingerprint = self.mm[_cdsseq_header.size:_cdsseq_header.size+fplen].decode('utf-8')
+        self.stamp, self.chrm2digest = parse_ref_fingerprint(self.fingerprint)
+        self.idx = NameIndex(fn, self.mm, idx_pos)
+        self.same_file = None
+        self.chrm2valid = {}
+
+    def _check_reference(self, chrm):
+
+        """ the cache is only used when built from the same reference
+        (when there is one). Unless the reference file is the one
+        indexed, the sequence of chrm is checked against its digest
+        on the first fetch from chrm """
+        if faidx.refgenome is None:
+            return True
+        if self.same_file is None:
+            try:
+                self.same_file = (self.stamp is not None and
+                                  ref_file_stamp(faidx.refgenome) == self.stamp)
+            except OSError:
+                self.same_file = False
+        if self.same_file:
+            return True
+        if chrm not in self.chrm2valid:
+            try:
+                valid = (chrm in self.chrm2digest and
+                         ref_chrm_digest(faidx.refgenome, chrm) == self.chrm2digest[chrm])
+            except SequenceRetrievalError:
+                valid = False
+            if not valid:
+                err_warn('CDS sequence cache %s was built from another reference (%s), ignored.' % (self.fh.name, chrm))
+            self.chrm2valid[chrm] = valid
+        return self.chrm2valid[chrm]
+
+    def fetch(self, t):
+
+        """ CDS sequence of t, None if not cached """
+        if not self._check_reference(t.chrm):
+            return None
+        pos = self.idx.get(cds_seq_key(t))
+        if pos is None:
+            return None
+        slen, = struct.unpack_from('<I', self.mm, pos)
+        return zlib.decompress(self.mm[pos+4:pos+4+slen]).decode('ascii')
+
+    @staticmethod
+    def write(fn, tpts):
+
+        """ splice the CDS of transcripts tpts from faidx.refgenome """
+        chrm2digest = {}
+        for chrm in set(t.chrm for t in tpts):
+            try:
+                chrm2digest[chrm] = ref_chrm_digest(faidx.refgenome, chrm)
+            except SequenceRetrievalError: # absent in the reference
+                pass
+        fp = '\n'.join([ref_file_stamp(faidx.refgenome)]+
+                       ['%s\t%s' % (c, chrm2digest[c]) for c in sorted(chrm2digest)])
+        fp = fp.encode('utf-8')
+        key2pos = {}
+        with open(fn, 'wb') as fh:
+            fh.write(_cdsseq_header.pack(CDSSEQ_MAGIC, 0, len(fp)))
+            fh.write(fp)
+            for t in tpts:
+                key = cds_seq_key(t)
+                if key in key2pos:
+                    continue
+                try:
+                    t.ensure_seq()
+                except Exception:  # e.g. patch chromosomes absent in the reference
+                    continue
+                if not t.seq:
+                    continue
+                z = zlib.compress(t.seq.encode('ascii'))
+                key2pos[key] = fh.tell()
+                fh.write(struct.pack('<I', len(z)))
+                fh.write(z)
+
+            idx_pos = fh.tell()
+            NameIndex.write_entries(
+                fh, sorted((k.encode('utf-8'), [p]) for k, p in key2pos.items()), False)
+            fh.seek(0)
+            fh.write(_cdsseq_header.pack(CDSSEQ_MAGIC, idx_pos, len(fp)))
+
+        err_print('cached CDS sequences of %d transcripts in %s' % (len(key2pos), fn))
+
+def open_cds_seq(dbfn):
+
+    """ the CDS sequence cache of a database, None if absent """
+    fn = dbfn+'.cds_seq'
+    if os.path.exists(fn):
+        return CDSSeqDB(fn)
+    return None
+
+## dbSNP allele index (.dbsnp_idx), written by transvar index --dbsnp
+## the file starts with the magic, the version and the offset of the
+## chromosome directory at the end of the file. The records of a
+## chromosome are in file order and stored as parallel arrays: the low
+## 16 bits of the positions, the rsIDs, the packed alleles and the start
+## of every 64kb bucket of positions in the other arrays, followed by a
+## text blob for the records that cannot be packed.
+## A packed allele is 2 bits of reference base, 2 bits of the number of
+## alternative bases less one, and 2 bits for each alternative base.
+## Other records (indels, mnv, non-rs ids) have DBSNPIDX_TEXT set and
+## the rsID replaced by the offset of "ID\tREF\tALT\n" in the blob.
+DBSNPIDX_MAGIC = b'TVSN'
+DBSNPIDX_VERSION = 1
+DBSNPIDX_TEXT = 0x8000
+_dbsnpidx_header = struct.Struct('<4sIQ')
+_dbsnpidx_chrm = struct.Struct('<HIIQQ')
+_dbsnp_base2code = {'A':0, 'C':1, 'G':2, 'T':3}
+_dbsnp_code2base = 'ACGT'
+
+def _dbsnp_pack_allele(rsid, ref, alt):
+
+    """ (rsid, packed allele) or None if the record needs the text blob """
+    if not rsid.startswith('rs') or not rsid[2:].isdigit() or int(rsid[2:]) >= 1<<32:
+        return None
+    if ref not in _dbsnp_base2code:
+        return None
+    alts = alt.split(',')
+    if len(alts) > 4 or any(a not in _dbsnp_base2code for a in alts):
+        return None
+    code = _dbsnp_base2code[ref] | (len(alts)-1) << 2
+    for i, a in enumerate(alts):
+        code |= _dbsnp_base2code[a] << (4+2*i)
+    return int(rsid[2:]), code
+
+def _dbsnp_unpack_allele(code):
+
+    nalt = ((code >> 2) & 3) + 1
+    return (_dbsnp_code2base[code & 3],
+            ','.join(_dbsnp_code2base[(code >> (4+2*i)) & 3] for i in range(nalt)))
+
+class DBSNPIndex():
+
+    """ mmapped dbSNP alleles, rows_at returns the same leading
+    fields (CHROM, POS, ID, REF, ALT) as a tabix query of the VCF """
+
+    def __init__(self, fn):
+
+        self.fh = open(fn, 'rb')
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        mv = memoryview(self.mm)
+        magic, version, off = _dbsnpidx_header.unpack_from(self.mm, 0)
+        if magic != DBSNPIDX_MAGIC or version != DBSNPIDX_VERSION:
+            err_die('%s is not a dbSNP index of this TransVar version, please rerun transvar index --dbsnp' % fn)
+
+        nchrm, = struct.unpack_from('<I', self.mm, off)
+        off += 4
+        self.chrm2arrays = {}
+        for i in range(nchrm):
+            nlen, n, nb, sec, bloblen = _dbsnpidx_chrm.unpack_from(self.mm, off)
+            off += _dbsnpidx_chrm.size
+            chrm = self.mm[off:off+nlen].decode('utf-8')
+            off += nlen
+            lows = mv[sec:sec+2*n].cast('H')
+            sec += 2*n + 2*(n%2)
+            rsids = mv[sec:sec+4*n].cast('I')
+            sec += 4*n
+            buckets = mv[sec:sec+4*(nb+1)].cast('I')
+            sec += 4*(nb+1)
+            alleles = mv[sec:sec+2*n].cast('H')
+            sec += 2*n
+            self.chrm2arrays[chrm] = (lows, rsids, buckets, alleles, sec)
+
+    def rows_at(self, chrm, pos):
+
+        """ the records starting at pos """
+        if chrm not in self.chrm2arrays:
+            return []
+        lows, rsids, buckets, alleles, blob = self.chrm2arrays[chrm]
+        b = pos >> 16
+        if pos <= 0 or b+1 >= len(buckets):
+            return []
+        low = pos & 0xffff
+        i = bisect_left(lows, low, buckets[b], buckets[b+1])
+        rows = []
+        spos = str(pos)
+        while i < buckets[b+1] and lows[i] == low:
+            code = alleles[i]
+            if code & DBSNPIDX_TEXT:
+                o = blob + rsids[i]
+                rsid, ref, alt = self.mm[o:self.mm.find(b'\n', o)].decode('utf-8').split('\t')
+            else:
+                ref, alt = _dbsnp_unpack_allele(code)
+                rsid = 'rs%d' % rsids[i]
+            rows.append([chrm, spos, rsid, ref, alt])
+            i += 1
+        return rows
+
+    @staticmethod
+    def write(vcf_fn, fn):
+
+        """ index a position-sorted dbSNP VCF, one chromosome in memory at a time """
+        directory = []
+        with open(fn, 'wb') as fh:
+            fh.write(_dbsnpidx_header.pack(DBSNPIDX_MAGIC, DBSNPIDX_VERSION, 0))
+
+            def _write_chrm(chrm, poss, rsids, alleles, blob):
+                sec = fh.tell()
+                nb = (poss[-1] >> 16) + 1 if poss else 0
+                buckets = array('I', [0]*(nb+1))
+                for p in poss:
+                    buckets[(p >> 16)+1] += 1
+                for b in range(nb):
+                    buckets[b+1] += buckets[b]
+                fh.write(array('H', [p & 0xffff for p in poss]).tobytes())
+                if len(poss) % 2:
+                    fh.write(b'\0\0')
+                fh.write(rsids.tobytes())
+                fh.write(buckets.tobytes())
+                fh.write(alleles.tobytes())
+                blob = b''.join(blob)
+                fh.write(blob)
+                directory.append((chrm, len(poss), nb, sec, len(blob)))
+
+            chrm = None
+            seen = set()
+            nrec = 0
+            for line in opengz(vcf_fn):
+                if line.startswith('#'):
+                    continue
+                fields = line.split('\t', 5)
+                pos = int(fields[1])
+                if fields[0] != chrm:
+                    if chrm is not None:
+                        _write_chrm(chrm, poss, rsids, alleles, blob)
+                    chrm = fields[0]
+                    if chrm in seen:
+                        err_die('%s is not sorted, chromosome %s is not contiguous' % (vcf_fn, chrm))
+                    seen.add(chrm)
+                    poss, rsids, alleles, blob, bloblen = array('I'), array('I'), array('H'), [], 0
+                elif pos < poss[-1]:
+                    err_die('%s is not sorted, at %s:%d' % (vcf_fn, chrm, pos))
+
+                poss.append(pos)
+                packed = _dbsnp_pack_allele(fields[2], fields[3], fields[4])
+                if packed is None:
+                    text = ('%s\t%s\t%s\n' % (fields[2], fields[3], fields[4])).encode('utf-8')
+                    rsids.append(bloblen)
+                    alleles.append(DBSNPIDX_TEXT)
+                    blob.append(text)
+                    bloblen += len(text)
+                else:
+                    rsids.append(packed[0])
+                    alleles.append(packed[1])
+                nrec += 1
+
+            if chrm is not None:
+                _write_chrm(chrm, poss, rsids, alleles, blob)
+
+            off = fh.tell()
+            fh.write(struct.pack('<I', len(directory)))
+            for chrm, n, nb, sec, bloblen in directory:
+                key = chrm.encode('utf-8')
+                fh.write(_dbsnpidx_chrm.pack(len(key), n, nb, sec, bloblen))
+                fh.write(key)
+            fh.seek(0)
+            fh.write(_dbsnpidx_header.pack(DBSNPIDX_MAGIC, DBSNPIDX_VERSION, off))
+
+        err_print('indexed %d dbSNP records of %d chromosomes in %s' % (nrec, len(directory), fn))
+
+def open_dbsnp_index(dbfn):
+
+    """ the allele index of a dbSNP VCF, None if absent """
+    fn = dbfn+'.dbsnp_idx'
+    if os.path.exists(fn):
+        return DBSNPIndex(fn)
+    return None
+
+## end of the region streamed by LocCursor, the maximum position of tabix
+LOC_SWEEP_END = 1<<29
+
+class LocCursor():
+
+    """ sweep-line over the .loc_idx of a TransVarDB for queries sorted
+    by coordinates. Transcripts are read once from a stream of the
+    chromosome as the queries advance and kept while they may still
+    overlap a query, i.e., dropped once they end before the query
+    beginning. A query that begins before the previous one falls back
+    to random access. The result (and its order) is that of read_loc_trnx.
+    """
+
+    def __init__(self, db):
+
+        self.db = db
+        # a separate handle, tabix iterators on the same handle interfere
+        self.loc_idx = tabix.open(db.dbfn+'.loc_idx')
+        self.chrm = None
+        self.qbeg = 0
+        self.stream = None
+        self.next_t = None
+        self.active = []
+        self.nrandom = 0
+
+    def _stream(self, chrm, beg):
+        for fields in tabix_query(self.loc_idx, chrm, beg, LOC_SWEEP_END):
+            yield self.db.parse_trnx_loc(fields)
+
+    def get(self, chrm, qbeg, qend):
+
+        """ transcripts with beg < qend and end >= qbeg """
+        if chrm != self.chrm:
+            self.chrm = chrm
+            self.stream = self._stream(chrm, qbeg)
+            self.next_t = next(self.stream, None)
+            self.active = []
+        elif qbeg < self.qbeg:  # out of order
+            self.nrandom += 1
+            return list(self.db.read_loc_trnx(chrm, qbeg, qend))
+
+        self.qbeg = qbeg
+        while self.next_t is not None and self.next_t.beg < qend:
+            self.active.append(self.next_t)
+            self.next_t = next(self.stream, None)
+
+        if any(t.end < qbeg for t in self.active):
+            self.active = [t for t in self.active if t.end >= qbeg]
+
+        return [t for t in self.active if t.beg < qend]
+
+## a TabixCursor restarts its stream, rather than reading through the
+## records in between, when a query begins this far beyond the stream
+TABIX_SWEEP_JUMP = 1<<16
+
+def vcf_interval(fields):
+    """ 0-based half-open interval of a VCF record, as tabix -p vcf """
+    beg = int(fields[1])-1
+    return beg, beg+len(fields[3])
+
+class TabixCursor():
+
+    """ merge-join of a tabix-indexed resource (e.g., dbSNP) with
+    queries sorted by coordinates. As LocCursor, records are read from
+    one stream of the chromosome and kept while they may still overlap
+    a query. The stream restarts at a query that begins before the
+    previous one or TABIX_SWEEP_JUMP bp beyond the stream, so that an
+    unsorted query costs one random access. The result (and its order)
+    is that of tabix_query.
+    """
+
+    def __init__(self, fn, interval):
+
+        self.fn = fn
+        self.interval = interval
+        # a separate handle, tabix iterators on the same handle interfere
+        self.index = tabix.open(fn)
+        self.chrm = None
+        self.qbeg = 0
+        self.stream = None
+        self.next_r = None
+        self.active = []
+        self.nrandom = 0
+        self.nrestart = 0
+
+    def _stream(self, chrm, beg):
+        for fields in tabix_query(self.index, chrm, beg, LOC_SWEEP_END):
+            beg, end = self.interval(fields)
+            yield beg, end, fields
+
+    def _restart(self, chrm, qbeg):
+        self.chrm = chrm
+        self.stream = self._stream(chrm, qbeg)
+        self.next_r = next(self.stream, None)
+        self.active = []
+        self.nrestart += 1
+
+    def get(self, chrm, qbeg, qend):
+
+        """ records overlapping [qbeg, qend] (1-based) """
+        qbeg = max(0, qbeg)
+        if chrm != self.chrm:
+            self._restart(chrm, qbeg)
+        elif qbeg < self.qbeg:  # out of order
+            self.nrandom += 1
+            self._restart(chrm, qbeg)
+        elif self.next_r is not None and self.next_r[0] < qbeg-TABIX_SWEEP_JUMP:
+            self._restart(chrm, qbeg)
+
+        self.qbeg = qbeg
+        while self.next_r is not None and self.next_r[0] < qend:
+            self.active.append(self.next_r)
+            self.next_r = next(self.stream, None)
+
+        if any(r[1] < qbeg for r in self.active):
+            self.active = [r for r in self.active if r[1] >= qbeg]
+
+        return [r[2] for r in self.active if r[0] < qend and r[1] >= qbeg]
+
 p_trxn_version=re.compile(r'(.*)\.(\d+)$')
 class TransVarDB():
 
     """ hold transcripts and genes
     In TransVar, transcripts are indexed in two ways to allow both access from name and from coordinates.
-    *.transvardb is ordered by gene name and index contains location to the first item
+    *.transvardb is ordered by gene name and index contains location to the first item,
+    it is either tab-delimited text (version 1) or binary (version 2, see TRANSVARDB_MAGIC)
     *.transvardb.loc_idx is a bed-like file ordered by coordinates
     Different from TransVarDB, FeatureDB is only indexed by coordinates.
     """
@@ -66,21 +984,44 @@ class TransVarDB():
 
         self.name2gene = {}
         self.idmap = {}
+        self.jobs = 1           # worker processes parsing the raw file, see index
         if dbfn is None: return
         dbfn = recheck_resource(dbfn)
         
         self.dbfn = dbfn
-        self.dbfh = open(self.dbfn, 'rt')
+        self.dbfh = open(self.dbfn, 'rb')
+        magic, version = _db_header.unpack(
+            self.dbfh.read(_db_header.size).ljust(_db_header.size, b'\0'))
+        if magic == TRANSVARDB_MAGIC:
+            self.dbversion = version
+            self.dbbeg = _db_header.size
+            self.dbmm = mmap.mmap(self.dbfh.fileno(), 0, access=mmap.ACCESS_READ)
+        else:                   # text .transvardb
+            self.dbfh.close()
+            self.dbversion = 1
+            self.dbbeg = 0
+            self.dbmm = None
+            self.dbfh = open(self.dbfn, 'rt')
 
         idxfn = dbfn+'.gene_idx'
-        self.gene_idx = load(open(idxfn, 'rb'))
+        self.gene_idx = load_name_index(idxfn)
 
         idxfn = dbfn+'.trxn_idx'
-        self.trnx_idx = load(open(idxfn, 'rb'))
+        self.trnx_idx = load_name_index(idxfn)
 
         self.alias_idx = None
         self.loc_idx = None
+        self.closest_idx = None
+        self.codon_idx = None
         self.source = source
+        self.seqdb = open_cds_seq(dbfn)
+
+        # in-memory mode, see parse_all
+        self.name2trnx = None
+        self.tindex = None
+
+        # sorted input, see enable_sweep
+        self.cursor = None
 
     ##########################
     # parsers for transvardb #
@@ -97,36 +1038,99 @@ class TransVarDB():
 
         parsing starts from dbfh current location
         """
-        for line in self.dbfh:
-            fields = line.strip('\n').split('\t')
-            if gname is not None and fields[0] != gname:
+        for t in self.iter_trnx():
+            if gname is not None and t.gene_name != gname:
                 break
-            t = Transcript()
-            t.gene_name = fields[0] # important when name == None
-            t.name = fields[1]
-            t.version = int(fields[2])
-            t.transcript_type = fields[3]
-            t.beg = int(fields[4])
-            t.end = int(fields[5])
-            t.chrm = fields[6]
-            t.strand = fields[7]
-            t.cds_beg = int(fields[8])
-            t.cds_end = int(fields[9])
-            t.exons = eval(fields[10])
-            if fields[11]:
-                t.aliases = fields[11].split(';')
-            t.gene_dbxref = fields[12]
-            t.source = self.source
             yield t
             if gname is None:
                 break
 
+    def iter_all_trnx(self):
+
+        """ iterate all the transcripts of .transvardb """
+        self.dbfh.seek(self.dbbeg)
+        for t in self.iter_trnx():
+            yield t
+
+    def iter_trnx(self):
+
+        """ iterate transcripts from dbfh current location
+        till the end of .transvardb """
+        if self.dbmm is None:
+            for line in self.dbfh:
+                yield self.parse_trnx_fields(line.strip('\n').split('\t'))
+        else:
+            pos = self.dbfh.tell()
+            while pos < len(self.dbmm):
+                t, pos = self.unpack_trnx(pos)
+                self.dbfh.seek(pos)
+                yield t
+
+    def unpack_trnx(self, pos):
+
+        """ unpack one transcript record of binary .transvardb
+        return the transcript and the location of the next record
+        """
+        (version, beg, end, cds_beg, cds_end,
+         nexons, slen) = _trnx_header.unpack_from(self.dbmm, pos)
+        pos += _trnx_header.size
+        fields = self.dbmm[pos:pos+slen].decode('utf-8').split('\t')
+        pos += slen
+        t = PackedTranscript(self.dbmm, pos, nexons)
+        t.gene_name = fields[0]
+        t.name = fields[1]
+        t.version = version
+        t.transcript_type = fields[2]
+        t.beg = beg
+        t.end = end
+        t.chrm = fields[3]
+        t.strand = fields[4]
+        t.cds_beg = cds_beg
+        t.cds_end = cds_end
+        if fields[5]:
+            t.aliases = fields[5].split(';')
+        t.gene_dbxref = fields[6]
+        t.source = self.source
+        t.seqdb = self.seqdb
+        return t, pos + nexons*8
+
+    def parse_trnx_fields(self, fields):
+
+        """ parse one line of the name-indexed transcript file
+        .transvardb file
+        """
+        t = Transcript()
+        t.gene_name = fields[0] # important when name == None
+        t.name = fields[1]
+        t.version = int(fields[2])
+        t.transcript_type = fields[3]
+        t.beg = int(fields[4])
+        t.end = int(fields[5])
+        t.chrm = fields[6]
+        t.strand = fields[7]
+        t.cds_beg = int(fields[8])
+        t.cds_end = int(fields[9])
+        t.exons = parse_exons(fields[10])
+        if fields[11]:
+            t.aliases = fields[11].split(';')
+        t.gene_dbxref = fields[12]
+        t.source = self.source
+        t.seqdb = self.seqdb
+        return t
+
     def parse_trnx_loc(self, fields):
 
         """ parse location-indexed transcript file
         .transvardb.loc_idx file
         return only 1 line
+
+        the location index of a binary .transvardb only has
+        chrm, beg, end, gene name, transcript name and the
+        location of the transcript record
         """
+        if len(fields) == 6:
+            return self.unpack_trnx(int(fields[5]))[0]
+
         t = Transcript()
         t.chrm = fields[0]
         t.beg = int(fields[1])
@@ -138,24 +1142,27 @@ class TransVarDB():
         t.strand = fields[7]
         t.cds_beg = int(fields[8])
         t.cds_end = int(fields[9])
-        t.exons = eval(fields[10])
+        t.exons = parse_exons(fields[10])
         if fields[11]:
             t.aliases = fields[11].split(';')
         t.gene_dbxref = fields[12]
         t.source = self.source
+        t.seqdb = self.seqdb
         return t
 
-    def parse_all(self, name2gene, name2trnx):
+    def parse_all(self):
 
-        """ parse the whole location-indexed transcript file
-        .transvardb.loc_idx file
-        this is for in-memory processing
+        """ parse the whole name-indexed transcript file
+        .transvardb file
+        this is for in-memory processing, after which transcripts
+        are retrieved from self.name2gene, self.name2trnx and the
+        location index self.tindex instead of from the files
         """
 
-        self.dbfh.seek(0)
-        for line in self.dbfh:
-            fields = line.strip('\n').split('\t')
-            t = parse_trnx_loc(fields)
+        name2gene = {}
+        name2trnx = {}
+        tindex = TIntervalIndex()
+        for t in self.iter_all_trnx():
             if t.gene_name in name2gene:
                 g = name2gene[t.gene_name]
             else:
@@ -165,7 +1172,12 @@ class TransVarDB():
             if t.name not in name2trnx:
                 name2trnx[t.name] = []
             name2trnx[t.name].append(t)
+            tindex.insert(t)
 
+        tindex.build()
+        self.name2gene = name2gene
+        self.name2trnx = name2trnx
+        self.tindex = tindex
 
     ########################################################
     # retrieve transcripts by gene name or transcript name #
@@ -214,14 +1226,30 @@ class TransVarDB():
     def get_by_gene(self, name):
 
         """ get by gene name """
-        if name in self.gene_idx:
-            pos = self.gene_idx[name]
-            self.dbfh.seek(pos)
-            g = Gene(name)
-            for t in self.parse_trnx(gname=name):
-                g.link_t(t)
+        if self.tindex is not None:
+            if name in self.name2gene:
+                yield self.name2gene[name]
+            return
+
+        g = None
+        for t in self.read_gene_trnx(name):
+            if g is None:
+                g = Gene(name)
+            g.link_t(t)
+
+        if g is not None:
             yield g
 
+    def read_gene_trnx(self, name):
+
+        """ read the transcripts of a gene from .transvardb """
+        pos = self.gene_idx.get(name)
+        if pos is None:
+            return []
+
+        self.dbfh.seek(pos)
+        return self.parse_trnx(gname=name)
+
     def get_by_trnx(self, name, strictversion = False):
 
         """ read in a gene by transcript name 
@@ -234,15 +1262,11 @@ class TransVarDB():
         else:
             version = None # no version info
 
-        if name not in self.trnx_idx:
-            return None
+        if self.tindex is not None:
+            return self._get_by_trnx_mem(name, version, strictversion)
 
-        poses = self.trnx_idx[name] # transcript ID might not be unique
         g = None
-        for pos in poses:
-            self.dbfh.seek(pos)
-            t = next(self.parse_trnx(), None)
-
+        for t in self.read_trnx(name):
             if t is None:
                 return None
             elif g is None:
@@ -257,6 +1281,35 @@ class TransVarDB():
 
         return g
 
+    def read_trnx(self, name):
+
+        """ read the transcripts of a transcript name from .transvardb
+        transcript ID might not be unique """
+        poses = self.trnx_idx.get(name)
+        if poses is None:
+            return []
+
+        return [self._read_trnx_at(pos) for pos in poses]
+
+    def _get_by_trnx_mem(self, name, version, strictversion):
+
+        """ in-memory version of get_by_trnx, the shared transcripts
+        keep their link to the full gene """
+        if name not in self.name2trnx:
+            return None
+
+        g = None
+        for t in self.name2trnx[name]:
+            if g is None:
+                g = Gene(t.gene_name)
+            if (strictversion and
+                version is not None and
+                t.version != version):
+                continue
+            g.tpts.append(t)
+
+        return g
+
     def get_by_alias(self, alias):
 
         """ read a gene by alias of transcripts """
@@ -300,15 +1353,74 @@ class TransVarDB():
     def get_by_loc(self, chrm, beg, end=None, flanking=0):
 
         """ get transcript if between begin and end """
-        self._ensure_loc_idx()
+        if self.tindex is not None:
+            for t in self.tindex.get_transcripts(chrm, beg, end, flanking):
+                yield t
+            return
+
         if not end: end = beg
         chrm = normalize_chrm(chrm)
-        for fields in self._iloc_query(chrm,beg-flanking,end+flanking):
+        if self.cursor is not None:
+            for t in self.cursor.get(chrm, max(1, int(beg)-flanking), int(end)+flanking):
+                yield t
+            return
+
+        for t in self.read_loc_trnx(chrm, beg-flanking, end+flanking):
+            yield t
+
+    def enable_sweep(self):
+
+        """ for coordinate-sorted queries (e.g., a sorted VCF), answer
+        get_by_loc from a LocCursor, unnecessary in the in-memory mode """
+        if self.tindex is None and self.cursor is None:
+            self.cursor = LocCursor(self)
+
+    def read_loc_trnx(self, chrm, beg, end):
+
+        """ read the transcripts overlapping [beg, end] through .loc_idx """
+        for fields in self._iloc_query(chrm, beg, end):
             yield self.parse_trnx_loc(fields)
 
+    def get_codon_index(self):
+
+        """ the CodonIndex, None for databases indexed by older TransVar """
+        if self.codon_idx is None:
+            idx_fn = self.dbfn+'.codon_idx'
+            if not os.path.exists(idx_fn):
+                return None
+            self.codon_idx = CodonIndex(idx_fn)
+        return self.codon_idx
+
+    def _ensure_closest_idx(self):
+
+        """ databases indexed by older TransVar have no .closest_idx,
+        return False for those """
+        if self.closest_idx is None:
+            idx_fn = self.dbfn+'.closest_idx'
+            if not os.path.exists(idx_fn):
+                return False
+            self.closest_idx = ClosestIndex(idx_fn)
+        return True
+
+    def fingerprint(self):
+        """ fingerprint of the database and its index files """
+        import glob
+        return ';'.join('%s=%s' % (os.path.basename(fn), file_fingerprint(fn))
+                        for fn in sorted(glob.glob(self.dbfn+'*')))
+
+    def _read_trnx_at(self, pos):
+        self.dbfh.seek(pos)
+        return next(self.parse_trnx(), None)
+
     def get_closest_upstream(self, chrm, pos):
+        if self.tindex is not None:
+            return self.tindex.get_closest_transcripts_upstream(chrm, pos)
         pos = int(pos)
         chrm = normalize_chrm(chrm)
+        if self._ensure_closest_idx():
+            loc = self.closest_idx.upstream(chrm, pos)
+            return None if loc is None else self._read_trnx_at(loc)
+
         s = 50000
         for p in range(pos, -1, -s):
             fs = [f for f in self._iloc_query(chrm, p-s, p) if int(f[2])<pos]
@@ -318,8 +1430,14 @@ class TransVarDB():
         return None
 
     def get_closest_downstream(self, chrm, pos):
+        if self.tindex is not None:
+            return self.tindex.get_closest_transcripts_downstream(chrm, pos)
         pos = int(pos)
         chrm = normalize_chrm(chrm)
+        if self._ensure_closest_idx():
+            loc = self.closest_idx.downstream(chrm, pos)
+            return None if loc is None else self._read_trnx_at(loc)
+
         s = 50000
         chrmlen = faidx.refgenome.chrm2len(chrm)
         for p in range(pos, chrmlen, s):
@@ -338,19 +1456,74 @@ class TransVarDB():
     # index transcripts from raw files ##
     #####################################
 
-    def index(self, raw_fns):
+    def index(self, raw_fns, sql=False, jobs=1):
 
         # each class that subclassed TransVarDB should have parse_raw
+        self.jobs = jobs
         self.parse_raw(*raw_fns)
         # results are stored in self.name2gene and self.idmap
         
         # set cds_beg and cds_end
         set_cds_boundary(self.name2gene)
 
+        if sql:
+            dbfn = raw_fns[0]+'.transvardb.sqlite'
+            self.write_sql(dbfn)
+        else:
+            dbfn = raw_fns[0]+'.transvardb'
+            self.write_db(dbfn)
+
+        ## .cds_seq - spliced CDS sequences
+        if faidx.refgenome:
+            CDSSeqDB.write(dbfn+'.cds_seq', [t for name in sorted(self.name2gene.keys())
+                                            for t in self.name2gene[name].tpts])
+
+    def write_sql(self, dbfn):
+
+        """ write self.name2gene and self.idmap to a SQLite
+        database, see TransVarSQLDB """
+        import sqlite3
+
+        if os.path.exists(dbfn):
+            os.remove(dbfn)
+        conn = sqlite3.connect(dbfn)
+        conn.executescript(SQL_SCHEMA)
+        for name in sorted(self.name2gene.keys()):
+            g = self.name2gene[name]
+            for t in g.tpts:
+                t.gene_name = g.name
+                cur = conn.execute(
+                    'INSERT INTO transcripts (gene_name, name, version, transcript_type, '
+                    'chrm, tx_beg, tx_end, strand, cds_beg, cds_end, gene_dbxref, bin) '
+                    'VALUES (?,?,?,?,?,?,?,?,?,?,?,?)',
+                    (g.name, t.name, t.version, t.transcript_type, t.chrm, t.beg, t.end,
+                     t.strand, t.cds_beg, t.cds_end, g.dbxref, reg2bin(t.beg-1, t.end)))
+                tid = cur.lastrowid
+                conn.executemany('INSERT INTO exons VALUES (?,?,?)',
+                                 [(tid, beg, end) for beg, end in t.exons])
+                conn.executemany('INSERT INTO aliases VALUES (?,?)',
+                                 [(alias, tid) for alias in t.aliases])
+
+        for map_name, mapping in self.idmap.items():
+            conn.executemany('INSERT INTO idmaps VALUES (?,?,?)',
+                             [(map_name, k, v) for k, vs in mapping.items() for v in vs])
+
+        conn.executescript(SQL_INDICES)
+        conn.commit()
+        conn.close()
+
+    def write_db(self, dbfn, dbversion=TRANSVARDB_VERSION):
+
+        """ write self.name2gene and self.idmap to dbfn
+        and its indices in the given .transvardb format version """
+
         ## .transvardb
         names = sorted(self.name2gene.keys())
-        dbfn = raw_fns[0]+'.transvardb'
-        dbfh = open(dbfn, 'wt')
+        if dbversion >= 2:
+            dbfh = open(dbfn, 'wb')
+            dbfh.write(_db_header.pack(TRANSVARDB_MAGIC, dbversion))
+        else:
+            dbfh = open(dbfn, 'wt')
         gene_idx = {}
         trnx_idx = {}
         # alias_idx = {}          # hold transcript aliases
@@ -359,8 +1532,8 @@ class TransVarDB():
             g = self.name2gene[name]
             for t in g.tpts:
                 t.gene_name = g.name
-                tpts.append((t.chrm, t.beg, t.end, t))
                 pos = dbfh.tell()
+                tpts.append((t.chrm, t.beg, t.end, t, pos))
                 if g.name not in gene_idx: # first location, each gene record one position
                     gene_idx[g.name] = pos
 
@@ -375,21 +1548,37 @@ class TransVarDB():
                 #     else:
                 #         alias_idx[alias] = [pos]
 
-                dbfh.write('%s\t%s\t%d\t%s\t%d\t%d\t%s\t%s\t%d\t%d\t%s\t%s\t%s\n' %
-                           (g.name, t.name, t.version, t.transcript_type, t.beg, t.end, t.chrm,
-                            t.strand, t.cds_beg, t.cds_end, t.exons, ';'.join(t.aliases), g.dbxref))
+                if dbversion >= 2:
+                    sblock = '\t'.join([g.name, t.name, t.transcript_type, t.chrm,
+                                        t.strand, ';'.join(t.aliases), g.dbxref]).encode('utf-8')
+                    exons = [p for exon in t.exons for p in exon]
+                    dbfh.write(_trnx_header.pack(t.version, t.beg, t.end, t.cds_beg, t.cds_end,
+                                                 len(t.exons), len(sblock)))
+                    dbfh.write(sblock)
+                    dbfh.write(struct.pack('<%di' % len(exons), *exons))
+                else:
+                    dbfh.write('%s\t%s\t%d\t%s\t%d\t%d\t%s\t%s\t%d\t%d\t%s\t%s\t%s\n' %
+                               (g.name, t.name, t.version, t.transcript_type, t.beg, t.end, t.chrm,
+                                t.strand, t.cds_beg, t.cds_end, t.exons, ';'.join(t.aliases), g.dbxref))
+        dbfh.close()
 
         ############################################
         ## .gene_idx - index gene name
         ############################################
         idxfn = dbfn+'.gene_idx'
-        dump(gene_idx, open(idxfn, 'wb'), 2)
+        if dbversion >= 2:
+            NameIndex.write(idxfn, gene_idx, False)
+        else:
+            dump(gene_idx, open(idxfn, 'wb'), 2)
 
         ############################################
         ## .trxn_idx - index transcript name
         ############################################
         idxfn = dbfn+'.trxn_idx'
-        dump(trnx_idx, open(idxfn, 'wb'), 2)
+        if dbversion >= 2:
+            NameIndex.write(idxfn, trnx_idx, True)
+        else:
+            dump(trnx_idx, open(idxfn, 'wb'), 2)
 
         ############################################
         ## .?.idmap_idx - mappings to gene names
@@ -408,89 +1597,343 @@ class TransVarDB():
         ############################################
         idxfn = dbfn+'.loc_idx'
         tpts.sort()
-        s = ''
-        for chrm, beg, end, t in tpts:
-            s += '%s\t%d\t%d\t%s\t%s\t%d\t%s\t%s\t%d\t%d\t%s\t%s\t%s\n' % (
-                t.chrm, t.beg, t.end, t.gene_name, t.name, t.version, t.transcript_type,
-                t.strand, t.cds_beg, t.cds_end, t.exons, ';'.join(t.aliases), t.gene.dbxref)
 
-        ## call external tabix
-        with open(idxfn, 'wb') as fh:
-            p = subprocess.Popen(bgzip_path, stdout=fh, stdin=subprocess.PIPE)
-            p.communicate(input=s.encode('utf-8'))
+        ## streamed into bgzip and tabix indexed in-process
+        def loc_lines():
+            for chrm, beg, end, t, pos in tpts:
+                if dbversion >= 2:  # the rest is read from .transvardb
+                    yield '%s\t%d\t%d\t%s\t%s\t%d\n' % (
+                        t.chrm, t.beg, t.end, t.gene_name, t.name, pos)
+                else:
+                    yield '%s\t%d\t%d\t%s\t%s\t%d\t%s\t%s\t%d\t%d\t%s\t%s\t%s\n' % (
+                        t.chrm, t.beg, t.end, t.gene_name, t.name, t.version, t.transcript_type,
+                        t.strand, t.cds_beg, t.cds_end, t.exons, ';'.join(t.aliases), t.gene.dbxref)
+        write_tabix(idxfn, loc_lines(), 'bed')
+
+        ############################################
+        ## .closest_idx - closest transcripts of
+        ## intergenic sites
+        ############################################
+        idxfn = dbfn+'.closest_idx'
+        ClosestIndex.write(idxfn, [(chrm, beg, end, pos) for chrm, beg, end, t, pos in tpts])
+
+        ############################################
+        ## .codon_idx - codons at coding positions
+        ############################################
+        idxfn = dbfn+'.codon_idx'
+        CodonIndex.write(idxfn, [t for chrm, beg, end, t, pos in tpts])
+
+## UCSC binning scheme, as used by tabix, on 0-based half-open intervals
+def reg2bin(beg, end):
+
+    end -= 1
+    if beg>>14 == end>>14: return 4681 + (beg>>14)
+    if beg>>17 == end>>17: return 585 + (beg>>17)
+    if beg>>20 == end>>20: return 73 + (beg>>20)
+    if beg>>23 == end>>23: return 9 + (beg>>23)
+    if beg>>26 == end>>26: return 1 + (beg>>26)
+    return 0
+
+def reg2bins(beg, end):
+
+    """ bins that may hold intervals overlapping [beg, end) """
+    end -= 1
+    bins = [0]
+    for shift, offset in [(26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)]:
+        bins.extend(range(offset+(beg>>shift), offset+(end>>shift)+1))
+    return bins
+
+SQL_SCHEMA = """
+CREATE TABLE transcripts (
+    id INTEGER PRIMARY KEY,
+    gene_name TEXT, name TEXT, version INTEGER, transcript_type TEXT,
+    chrm TEXT, tx_beg INTEGER, tx_end INTEGER, strand TEXT,
+    cds_beg INTEGER, cds_end INTEGER, gene_dbxref TEXT, bin INTEGER);
+CREATE TABLE exons (transcript_id INTEGER, exon_beg INTEGER, exon_end INTEGER);
+CREATE TABLE aliases (alias TEXT, transcript_id INTEGER);
+CREATE TABLE idmaps (map_name TEXT, key TEXT, value TEXT);
+"""
+
+SQL_INDICES = """
+CREATE INDEX transcripts_gene_name ON transcripts (gene_name);
+CREATE INDEX transcripts_name ON transcripts (name);
+CREATE INDEX transcripts_bin ON transcripts (chrm, bin);
+CREATE INDEX transcripts_beg ON transcripts (chrm, tx_beg);
+CREATE INDEX transcripts_end ON transcripts (chrm, tx_end);
+CREATE INDEX exons_transcript_id ON exons (transcript_id);
+CREATE INDEX aliases_alias ON aliases (alias);
+CREATE INDEX idmaps_key ON idmaps (map_name, key);
+"""
+
+_sql_trnx_columns = ('id, gene_name, name, version, transcript_type, chrm, tx_beg, tx_end, '
+                     'strand, cds_beg, cds_end, gene_dbxref')
+
+## transcripts at the same location come in the order of .loc_idx
+_sql_loc_order = 'tx_beg, tx_end, name, id'
+
+class SQLIdMap():
+
+    """ one idmap of TransVarSQLDB, used as TransVarDB.idmap """
+
+    def __init__(self, conn, map_name):
+        self.conn = conn
+        self.map_name = map_name
+
+    def __len__(self):
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM idmaps WHERE map_name=?', (self.map_name,)).fetchone()[0]
+
+    def __contains__(self, key):
+        return self.conn.execute(
+            'SELECT 1 FROM idmaps WHERE map_name=? AND key=? LIMIT 1',
+            (self.map_name, key)).fetchone() is not None
+
+    def __getitem__(self, key):
+        return [v for v, in self.conn.execute(
+            'SELECT value FROM idmaps WHERE map_name=? AND key=? ORDER BY rowid',
+            (self.map_name, key))]
+
+class TransVarSQLDB(TransVarDB):
+
+    """ transcripts in one SQLite file (.transvardb.sqlite) built by
+    transvar index --sql, in place of .transvardb and its indices
+    transcripts - one row per transcript, bin is the UCSC bin of the
+                  transcript for location queries
+    exons       - exons of each transcript
+    aliases     - transcript aliases
+    idmaps      - mappings to gene names or transcript IDs
+    the database is opened read-only so that worker processes can
+    read it concurrently
+    """
+
+    def __init__(self, dbfn=None, source=None):
+
+        self.name2gene = {}
+        self.idmap = {}
+        self.jobs = 1           # worker processes parsing the raw file, see index
+        if dbfn is None: return
+        dbfn = recheck_resource(dbfn)
+        if not os.path.exists(dbfn):
+            err_die("Missing %s. Consider rerunning the transvar index command with --sql" % dbfn)
+
+        import sqlite3
+        try:
+            from urllib.parse import quote
+        except ImportError:
+            from urllib import quote
+        self.dbfn = dbfn
+        self.conn = sqlite3.connect('file:%s?mode=ro' % quote(os.path.abspath(dbfn)), uri=True)
+        self.source = source
+        self.seqdb = open_cds_seq(dbfn)
+
+        # in-memory mode, see parse_all
+        self.name2trnx = None
+        self.tindex = None
+        self.cursor = None
+
+    def enable_sweep(self):
+        # the bin queries of the SQL backend do not stream
+        pass
+
+    def get_codon_index(self):
+        # transvar index --sql writes no codon table
+        return None
+
+    def load_idmap(self, map_name):
+
+        """ return the idmap of the given name, None if absent """
+        if self.conn.execute('SELECT 1 FROM idmaps WHERE map_name=? LIMIT 1',
+                             (map_name,)).fetchone() is None:
+            return None
+        return SQLIdMap(self.conn, map_name)
+
+    def _make_trnx(self, rows):
+
+        """ make transcripts from rows of _sql_trnx_columns """
+        if not rows:
+            return []
+
+        tid2exons = {}
+        for tid, beg, end in self.conn.execute(
+                'SELECT transcript_id, exon_beg, exon_end FROM exons '
+                'WHERE transcript_id IN (%s) ORDER BY transcript_id, exon_beg' %
+                ','.join(str(row[0]) for row in rows)):
+            if tid in tid2exons:
+                tid2exons[tid].append((beg, end))
+            else:
+                tid2exons[tid] = [(beg, end)]
+
+        tid2aliases = {}
+        for alias, tid in self.conn.execute(
+                'SELECT alias, transcript_id FROM aliases '
+                'WHERE transcript_id IN (%s) ORDER BY rowid' %
+                ','.join(str(row[0]) for row in rows)):
+            if tid in tid2aliases:
+                tid2aliases[tid].append(alias)
+            else:
+                tid2aliases[tid] = [alias]
+
+        tpts = []
+        for row in rows:
+            t = Transcript()
+            (tid, t.gene_name, t.name, t.version, t.transcript_type, t.chrm,
+             t.beg, t.end, t.strand, t.cds_beg, t.cds_end, t.gene_dbxref) = row
+            t.exons = tid2exons.get(tid, [])
+            t.aliases = tid2aliases.get(tid, [])
+            t.source = self.source
+            t.seqdb = self.seqdb
+            tpts.append(t)
+
+        return tpts
+
+    def _query_trnx(self, where, params):
+        return self._make_trnx(self.conn.execute(
+            'SELECT %s FROM transcripts WHERE %s' % (_sql_trnx_columns, where), params).fetchall())
+
+    def iter_all_trnx(self):
+
+        """ iterate all the transcripts in the order of .transvardb """
+        last_id = 0
+        while True:
+            tpts = self._query_trnx('id > ? ORDER BY id LIMIT 1000', (last_id,))
+            if not tpts:
+                break
+            for t in tpts:
+                yield t
+            last_id += len(tpts)
+
+    def read_gene_trnx(self, name):
+        return self._query_trnx('gene_name=? ORDER BY id', (name,))
+
+    def read_trnx(self, name):
+        return self._query_trnx('name=? ORDER BY id', (name,))
 
-        subprocess.check_call([tabix_path, '-p', 'bed', idxfn])
+    def get_by_alias(self, alias):
+
+        """ read a gene by alias of transcripts """
+        name2gene = {}
+        for t in self._query_trnx(
+                'id IN (SELECT transcript_id FROM aliases WHERE alias=?) ORDER BY id', (alias,)):
+            if t.gene_name in name2gene:
+                g = name2gene[t.gene_name]
+            else:
+                g = Gene(t.gene_name)
+                name2gene[g.name] = g
+            g.link_t(t)
+
+        for g in name2gene.values():
+            yield g
+
+    def read_loc_trnx(self, chrm, beg, end):
+
+        """ same overlap criterion as the tabix query on .loc_idx """
+        beg = max(1, beg)
+        bins = reg2bins(beg-1, end)
+        return self._query_trnx(
+            'chrm=? AND bin IN (%s) AND tx_beg<? AND tx_end>=? ORDER BY %s' % (
+                ','.join(map(str, bins)), _sql_loc_order), (chrm, end, beg))
+
+    def get_closest_upstream(self, chrm, pos):
+        if self.tindex is not None:
+            return self.tindex.get_closest_transcripts_upstream(chrm, pos)
+        tpts = self._query_trnx(
+            'chrm=? AND tx_end<? ORDER BY tx_end DESC, %s LIMIT 1' % _sql_loc_order,
+            (normalize_chrm(chrm), int(pos)))
+        return tpts[0] if tpts else None
+
+    def get_closest_downstream(self, chrm, pos):
+        if self.tindex is not None:
+            return self.tindex.get_closest_transcripts_downstream(chrm, pos)
+        tpts = self._query_trnx(
+            'chrm=? AND tx_beg>? ORDER BY %s LIMIT 1' % _sql_loc_order,
+            (normalize_chrm(chrm), int(pos)))
+        return tpts[0] if tpts else None
+
+def _feature_key_(line):
+    # ties are broken by the whole line, as sort -k 1,1 -k 2,2n does
+    fields = line.split('\t', 2)
+    return (fields[0], int(fields[1]), line)
 
 class FeatureDB():
 
-    def parse_bed(self, bed_fn, db_fn):
+    def parse_bed(self, bed_fn):
 
         """ bed format indexing takes only the first four columns,
         the annotation is the fourth column
         """
-        bed_fh = opengz(bed_fn)
-        with open(db_fn+'.presort', 'wt') as outfile:
-            for line in bed_fh:
-                fields = line.strip('\n').split('\t')
-                if len(fields) < 4:
-                    continue
-                outfile.write('%s\t%s\t%s\t%s\n' % (
-                    normalize_chrm(fields[0]), fields[1], fields[2], fields[3]))
+        for line in opengz(bed_fn):
+            fields = line.strip('\n').split('\t')
+            if len(fields) < 4:
+                continue
+            yield '%s\t%s\t%s\t%s\n' % (
+                normalize_chrm(fields[0]), fields[1], fields[2], fields[3])
 
-    def parse_gff(self, gff_fn, db_fn):
+    def parse_gff(self, gff_fn):
 
         """ GFF: seqname, source, feature, start, end, score, strand, frame, attribute
         indexing made a bed file with seqname, start, end, feature
         """
-        gff_fh = opengz(gff_fn)
-        with open(db_fn+'.presort', 'wt') as outfile:
-            for line in gff_fh:
-                fields = line.strip('\n').split('\t')
-                if len(fields) < 4:
-                    continue
-                outfile.write('%s\t%s\t%s\t%s\n' % (
-                    normalize_chrm(fields[0]), fields[3], fields[4], fields[2]))
+        for line in opengz(gff_fn):
+            fields = line.strip('\n').split('\t')
+            if len(fields) < 4:
+                continue
+            yield '%s\t%s\t%s\t%s\n' % (
+                normalize_chrm(fields[0]), fields[3], fields[4], fields[2])
 
-    def parse_vcf(self, vcf_fn, db_fn):
+    def parse_vcf(self, vcf_fn):
 
         """ VCF: #CHROM, POS, ID, REF, ALT, QUAL, FILTER, INF,
         indexing made a bed file with CHROM, POS, POS+len(REF), ID|REF|ALT """
-        vcf_fh = opengz(vcf_fn)
-        with open(db_fn+'.presort', 'wt') as outfile:
-            for line in vcf_fh:
-                if line.startswith('#'):
-                    continue
-                fields = line.strip('\n').split('\t')
-                if len(fields) < 7:
-                    continue
-                outfile.write('%s\t%s\t%d\t%s|%s|%s\n' % (
-                    normalize_chrm(fields[0]), fields[1], int(fields[1])+len(fields[3]),
-                    fields[2],fields[3],fields[4]))
+        for line in opengz(vcf_fn):
+            if line.startswith('#'):
+                continue
+            fields = line.strip('\n').split('\t')
+            if len(fields) < 7:
+                continue
+            yield '%s\t%s\t%d\t%s|%s|%s\n' % (
+                normalize_chrm(fields[0]), fields[1], int(fields[1])+len(fields[3]),
+                fields[2],fields[3],fields[4])
 
     def index(self, fn, raw_format, is_sorted):
         db_fn = fn+'.featuredb'
         if raw_format == 'bed':
-            self.parse_bed(fn, db_fn)
+            lines = self.parse_bed(fn)
         elif raw_format == 'vcf':
-            self.parse_vcf(fn, db_fn)
+            lines = self.parse_vcf(fn)
         elif raw_format == 'gff':
-            self.parse_gff(fn, db_fn)
+            lines = self.parse_gff(fn)
         else:
             raise Exception('Unknown format, must be a bug.\n')
 
-        if is_sorted:
-            subprocess.check_call(['mv', db_fn+'.presort', db_fn+'.sort'])
-        else:
-            with open(db_fn+'.sort', 'wt') as outfile:
-                subprocess.check_call(['sort', '-T', os.path.dirname(os.path.abspath(db_fn)),
-                                       '-k', '1,1', '-k', '2,2n', db_fn+'.presort'], stdout=outfile)
-        with open(db_fn, 'wt') as outfile:
-            subprocess.check_call([bgzip_path, '-c', db_fn+'.sort'], stdout=outfile)
-        subprocess.check_call([tabix_path, '-p', 'bed', db_fn])
+        ## sorted by chromosome and start, larger input
+        ## spills sorted runs next to the database
+        if not is_sorted:
+            lines = external_sort(lines, _feature_key_,
+                                  os.path.dirname(os.path.abspath(db_fn)))
+        write_tabix(db_fn, lines, 'bed')
+
+def convert_transvardb(dbfn, dbversion=TRANSVARDB_VERSION):
 
-        # clean
-        subprocess.check_call(['rm', '-f', db_fn+'.presort'])
-        subprocess.check_call(['rm', '-f', db_fn+'.sort'])
+    """ rewrite an existing .transvardb and its name and location
+    indices in the given format version, idmaps are kept as is """
+
+    db = TransVarDB(dbfn)
+    for t in db.iter_all_trnx():
+        t.exons = t.exons       # unpack before dbfn is overwritten
+        if t.gene_name in db.name2gene:
+            g = db.name2gene[t.gene_name]
+        else:
+            g = Gene(t.gene_name)
+            db.name2gene[g.name] = g
+        g.link_t(t)
+
+    if db.dbmm is not None:
+        db.dbmm.close()
+    db.dbfh.close()
+    db.gene_idx = None          # release the name indices to be overwritten
+    db.trnx_idx = None
+    db.write_db(db.dbfn, dbversion)
+    err_print('converted %s to .transvardb version %d' % (db.dbfn, dbversion))
 
 def set_cds_boundary(name2gene):
 
@@ -532,6 +1975,95 @@ def index_idmap(idmap_fn, idx_fh):
 
     return
 
+## bytes of a GTF/GFF (in whole lines) parsed by a worker at a time,
+## see iter_gff_records
+GFF_CHUNK_SIZE = 1<<22
+
+## the GTF features read by EnsemblDB and GENCODEDB
+GTF_FEATURES = set(['gene', 'transcript', 'exon', 'CDS'])
+
+## the attributes read by each parser, with jobs > 1 only these are
+## sent back from the workers (see iter_gff_records)
+ENSEMBL_GTF_KEYS = set(['gene_id', 'gene_name', 'gene_biotype',
+                        'transcript_id', 'transcript_biotype', 'protein_id'])
+GENCODE_GTF_KEYS = set(['gene_id', 'gene_name', 'gene_type',
+                        'transcript_id', 'transcript_type', 'protein_id'])
+
+## the GFF3 features and attributes read by RefSeqDB
+REFSEQ_GFF_FEATURES = set(['region', 'gene', 'mRNA', 'ncRNA', 'rRNA', 'tRNA', 'exon', 'CDS'])
+REFSEQ_GFF_KEYS = set(['ID', 'Parent', 'Name', 'product', 'chromosome', 'map',
+                       'pseudo', 'Dbxref', 'ncrna_class', 'protein_id'])
+
+def gtf_attributes(attr):
+    return dict(re.findall(r'\s*([^";]*) "([^"]*)";', attr))
+
+def gff3_attributes(attr):
+    return dict([_.split('=') for _ in attr.split(';')])
+
+def _parse_gff_lines_(lines, attr_parser, features):
+
+    recs = []
+    for line in lines:
+        if line.startswith('#'): continue
+        fields = line.strip('\n').split('\t')
+        if len(fields) < 9: continue
+        if features is not None and fields[2] not in features: continue
+        recs.append((fields, attr_parser(fields[8])))
+    return recs
+
+def _parse_gff_chunk_(args):
+
+    """ the records of a chunk of lines in a worker, made compact for
+    the trip back to the parent: the attribute column is dropped, only
+    the attributes in keys are kept and equal strings (column values,
+    attribute names, IDs repeated over the lines of a transcript) are
+    the same object, so that they are pickled once per chunk """
+    chunk, attr_parser, features, keys = args
+    strs = {}
+    recs = []
+    for fields, info in _parse_gff_lines_(chunk.split('\n'), attr_parser, features):
+        recs.append(([strs.setdefault(x, x) for x in fields[:8]],
+                     dict((strs.setdefault(k, k), strs.setdefault(v, v))
+                          for k, v in info.items() if k in keys)))
+    return recs
+
+def iter_gff_records(fn, attr_parser, features=None, keys=None, jobs=1):
+
+    """ (fields, attributes) of the records of a GTF/GFF in file order,
+    records of other features than features (if given) are skipped.
+    With jobs > 1, chunks of lines are read as blocks of text, split and
+    their attributes parsed in worker processes, at most 2*jobs chunks
+    are in flight so that the memory does not grow with the file. The
+    workers only send back the first 8 columns and the attributes in keys """
+    fh = opengz(fn)
+    if jobs <= 1:
+        for rec in _parse_gff_lines_(fh, attr_parser, features):
+            yield rec
+        return
+
+    import multiprocessing
+    from collections import deque
+    pool = multiprocessing.Pool(jobs)
+    pending = deque()
+    try:
+        while True:
+            chunk = fh.read(GFF_CHUNK_SIZE)
+            if chunk and not chunk.endswith('\n'):
+                chunk += fh.readline()
+            if chunk:
+                pending.append(pool.apply_async(_parse_gff_chunk_, ((chunk, attr_parser, features, keys),)))
+            if pending and (len(pending) >= 2*jobs or not chunk):
+                for rec in pending.popleft().get():
+                    yield rec
+            elif not chunk:
+                break
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
 class EnsemblDB(TransVarDB):
 
     def __init__(self, dbfn=None):
@@ -548,8 +2080,6 @@ class EnsemblDB(TransVarDB):
         The result is stored to self.name2gene
         """
 
-        gtf_fh = opengz(gtf_fn)
-
         ## the following is a workaround
         if (gtf_fn.startswith('Mus_musculus.NCBIM37')):
             return self.parse_raw0(gtf_fn)
@@ -561,11 +2091,8 @@ class EnsemblDB(TransVarDB):
         geneID_to_geneName = {}
         proteinID_to_transcriptID = {}
         
-        for i, line in enumerate(gtf_fh):
-            if line.startswith('#'): continue
-            fields = line.strip('\n').split('\t')
-            info = dict(re.findall(r'\s*([^";]*) "([^"]*)";', fields[8]))
-            # info = dict([_.split('=') for _ in fields[8].split(';')])
+        for fields, info in iter_gff_records(gtf_fn, gtf_attributes, GTF_FEATURES,
+                                             ENSEMBL_GTF_KEYS, self.jobs):
             if fields[2] == 'gene':
                 gene_id = info['gene_id']
                 if gene_id not in id2ent:
@@ -762,7 +2289,6 @@ class RefSeqDB(TransVarDB):
     def parse_raw(self, gff_fn):
 
         id2ent = {}
-        gff_fh = opengz(gff_fn)
         reg = None
         cnt = 0
 
@@ -772,13 +2298,8 @@ class RefSeqDB(TransVarDB):
         proteinID_to_transcriptID = {}
         # TODO: HRPD and MIM
         
-        for line in gff_fh:
-            if line.startswith('#'): continue
-            fields = line.strip('\n').split('\t')
-            if (len(fields) < 9):
-                continue
-            # print line.strip()
-            info = dict([_.split('=') for _ in fields[8].split(';')])
+        for fields, info in iter_gff_records(gff_fn, gff3_attributes, REFSEQ_GFF_FEATURES,
+                                             REFSEQ_GFF_KEYS, self.jobs):
             if fields[2] == 'region':
                 if 'chromosome' in info:
                     reg = Region(info['chromosome'], int(fields[3]), int(fields[4]))
@@ -980,14 +2501,11 @@ class GENCODEDB(TransVarDB):
 
     def parse_raw(self, gencode_fn):
 
-        gtf_fh = opengz(gencode_fn)
         id2ent = {}
         cnt = 0
         
-        for line in gtf_fh:
-            if line.startswith('#'): continue
-            fields = line.strip('\n').split('\t')
-            info = dict(re.findall(r'\s*([^";]*) "([^"]*)";', fields[8]))
+        for fields, info in iter_gff_records(gencode_fn, gtf_attributes, GTF_FEATURES,
+                                             GENCODE_GTF_KEYS, self.jobs):
             if fields[2] == 'gene':
                 gene_name = info['gene_name'].upper()
                 gid = info['gene_id']
@@ -1163,34 +2681,50 @@ def main_index(args):
     3) reference;
     4) alias to gene/transcripts
     """
+    # references, also used for caching the CDS sequences
+    if args.reference and args.reference != "_DEF_":
+        if not args.reference.endswith('.2bit'):
+            from . import config
+            config.samtools_faidx(args.reference)
+            if args.twobit:
+                twobit_fn = re.sub(r'(\.(fa|fasta|fna))?(\.gz)?$', '', args.reference)+'.2bit'
+                err_print('Packing %s into %s' % (args.reference, twobit_fn))
+                faidx.write_twobit(args.reference, twobit_fn)
+        faidx.init_refgenome(args.reference)
+    elif args.twobit:
+        err_die('--twobit packs the fasta given by --reference')
+
     # gene / transcripts
     if args.ensembl:
         db = EnsemblDB()
-        db.index([args.ensembl])
+        db.index([args.ensembl], args.sql, args.jobs)
 
     if args.ccds:
         db = CCDSDB()
-        db.index([args.ccds])
+        db.index([args.ccds], args.sql, args.jobs)
 
     if args.refseq:
         db = RefSeqDB()
-        db.index([args.refseq])
+        db.index([args.refseq], args.sql, args.jobs)
 
     if args.aceview:
         db = AceViewDB()
-        db.index([args.aceview])
+        db.index([args.aceview], args.sql, args.jobs)
 
     if args.gencode:
         db = GENCODEDB()
-        db.index([args.gencode])
+        db.index([args.gencode], args.sql, args.jobs)
 
     if args.kg:
         db = UCSCKnownGeneDB()
-        db.index([args.kg, args.alias])
+        db.index([args.kg, args.alias], args.sql, args.jobs)
 
     if args.ucsc:
         db = UCSCRefGeneDB()
-        db.index([args.ucsc])
+        db.index([args.ucsc], args.sql, args.jobs)
+
+    if args.convert:
+        convert_transvardb(args.convert)
 
     # features
     if args.gff:
@@ -1205,6 +2739,18 @@ def main_index(args):
         db = FeatureDB()
         db.index(args.vcf, 'vcf', args.sorted)
 
+    if args.dbsnp:
+        dbsnp_fn = args.dbsnp
+        if dbsnp_fn == '_DEF_':
+            from .config import read_config
+            config = read_config()
+            rv = args.refversion or (config.get('DEFAULT', 'refversion')
+                                     if 'refversion' in config.defaults() else 'hg19')
+            dbsnp_fn = get_config(config, 'dbsnp', rv)
+        if dbsnp_fn:
+            dbsnp_fn = recheck_resource(dbsnp_fn)
+            DBSNPIndex.write(dbsnp_fn, dbsnp_fn+'.dbsnp_idx')
+
     if args.idmap:
         if args.output is None:
             err_die("Please provide output through -o.")
@@ -1221,10 +2767,6 @@ def main_index(args):
     #     uniprot2multi_ids = parser.parse_uniprot_mapping(args.uniprot)
     #     dump(uniprot2multi_ids, open(args.uniprot+'.idx','wb'), 2)
 
-    # references
-    if args.reference and args.reference != "_DEF_":
-        from . import config
-        config.samtools_faidx(args.reference)
 
 def main():
 
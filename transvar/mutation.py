@@ -30,6 +30,7 @@ SOFTWARE.
 import re, sys, argparse
 from .utils import *
 from .record import *
+from . import record
 from .err import *
 
 def _parse_gdna_mutation(s):
@@ -374,11 +375,13 @@ def vcf_parse_mutation(args, at='g'):
             sys.stderr.write("\rProcessed %d records\033[K" % nrec)
         nrec += 1
 
+        # the header goes to the annotation output (e.g., --outfile),
+        # with --jobs this is run by the feeder thread of the pool
         if line.startswith('##'):
-            sys.stdout.write(line)
+            record.output.write(line.rstrip('\n'))
             continue
         if line.startswith('#CHROM'):
-            sys.stdout.write(line.strip()+'\t'+print_header_s()+'\n')
+            record.output.write(line.strip()+'\t'+print_header_s())
             continue
 
         fields = line.strip().split('\t')
@@ -726,11 +726,7 @@ class Record():
 
         s = op+'\t' if op else ''
         s += self.formats(args)
-
-        try:
-            print(s)
-        except IOError:
-            sys.exit(1)
+        output.write(s)
 
     def formats(self, args): # format string
 
@@ -763,6 +759,136 @@ class Record():
 
         return s
 
+class OutputSink():
+
+    """ where the annotation output goes
+    lines are collected and written in blocks of about bufsize bytes,
+    bufsize=0 writes every line through. With threaded, the blocks are
+    written by a background thread. With bgzip, the output is BGZF
+    compressed. fh defaults to the sys.stdout at the time of writing.
+    """
+
+    def __init__(self, fh=None, bufsize=0, threaded=False, bgzip=False):
+
+        self.fh = fh
+        self.bufsize = bufsize
+        self.bgzf = None
+        if bgzip:
+            if fh is None:
+                fh = sys.stdout.buffer
+            self.bgzf = BGZFWriter(fh)
+        self.lines = []
+        self.size = 0
+        self.error = None
+        self.queue = None
+        if threaded:
+            import threading
+            try:
+                import queue
+            except ImportError:
+                import Queue as queue
+            self.queue = queue.Queue(8)
+            self.thread = threading.Thread(target=self._writer)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _write_block(self, block):
+        if self.bgzf is not None:
+            self.bgzf.write(block.encode('utf-8'))
+        elif self.fh is None:
+            sys.stdout.write(block)
+        else:
+            self.fh.write(block)
+
+    def _writer(self):
+        while True:
+            block = self.queue.get()
+            if block is None:
+                break
+            if self.error is None:
+                try:
+                    self._write_block(block)
+                except IOError as e:
+                    self.error = e
+
+    def write(self, s):
+        """ write one line (without the new line) """
+        self.lines.append(s)
+        self.size += len(s)+1
+        if self.size >= self.bufsize:
+            self.flush_lines()
+
+    def write_block(self, block):
+        """ write a string of complete lines """
+        if block:
+            self.lines.append(block[:-1])
+            self.size += len(block)
+            if self.size >= self.bufsize:
+                self.flush_lines()
+
+    def flush_lines(self):
+        if not self.lines:
+            return
+        block = '\n'.join(self.lines)+'\n'
+        self.lines = []
+        self.size = 0
+        if self.queue is not None:
+            self.queue.put(block)
+        else:
+            try:
+                self._write_block(block)
+            except IOError as e:
+                self.error = e
+        if self.error is not None:
+            sys.exit(1)
+
+    def close(self):
+
+        self.flush_lines()
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+        try:
+            if self.bgzf is not None:
+                self.bgzf.close()
+            elif self.fh is None:
+                sys.stdout.flush()
+            elif self.fh is not sys.stdout:
+                self.fh.close()
+        except IOError as e:
+            self.error = e
+        if self.error is not None:
+            sys.exit(1)
+
+## the sink of format_records and Record.format, by default
+## every line is written through to sys.stdout
+output = OutputSink()
+
+def set_output(sink):
+    """ install sink as the annotation output, return the old one """
+    global output
+    old = output
+    output = sink
+    return old
+
+def open_output(args):
+
+    """ set up the output sink from the command line,
+    --outfile (bgzip compressed if ending with .gz),
+    --outbuf and --outthread """
+
+    fh = None
+    bgzip = False
+    if args.outfile and args.outfile != '-':
+        if args.outfile.endswith('.gz'):
+            fh = open(args.outfile, 'wb')
+            bgzip = True
+        else:
+            fh = open(args.outfile, 'w')
+    set_output(OutputSink(fh, args.outbuf*1024, args.outthread, bgzip))
+    return output
+
 def format_one(r, rs, qop, args):
     if not args.oneline:
         r.format(qop, args)
@@ -779,10 +905,7 @@ def format_records(records, qop, args):
         if args.oneline:
             s = qop+'\t' if qop else ''
             s += '\t|||\t'.join([r.formats(args) for r in records])
-            try:
-                print(s)
-            except IOError:
-                sys.exit(1)
+            output.write(s)
         else:
             for r in records:
                 r.format(qop, args)
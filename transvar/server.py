@@ -0,0 +1,263 @@
+"""
+The MIT License
+
+Copyright (c) 2015
+The University of Texas MD Anderson Cancer Center
+Wanding Zhou, Tenghui Chen, Ken Chen (kchen3@mdanderson.org)
+
+Permission is hereby granted, free of charge, to any person obtaining
+a copy of this software and associated documentation files (the
+"Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish,
+distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+
+""" transvar serve: answer annotation requests over HTTP from a
+warm AnnoDB, either on a local TCP port or on a Unix socket
+
+    GET  /panno?i=PIK3CA:p.E545K&aa3=1     one or more (repeated i) queries
+    POST /ganno?noheader=1                 the body is a mutation list (as -l)
+    GET  /stats                            requests and latency per command,
+                                           reference cache hits and misses
+
+the response is the output of the corresponding command line, the
+latency of the request (ms) is in the X-TransVar-Latency header
+"""
+
+import os, sys, io, copy, time, signal, threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urlparse import urlparse, parse_qs
+
+from .err import *
+from .config import read_config
+from .annodb import AnnoDB
+from .record import OutputSink, print_header
+from .mutation import list_parse_mutation
+from . import record
+from . import anno
+from . import codonsearch
+from . import faidx
+
+## options that a request may set, by the type of their value
+REQUEST_FLAGS = ['longest', 'longestcoding', 'strictversion', 'aa3', 'oneline',
+                 'gseq', 'haplotype', 'pp', 'ppp', 'noheader', 'skipheader', 'ignore']
+REQUEST_INTS = ['seqmax', 'nc', 'aacontext', 'prombeg', 'promend',
+                'g', 'p', 'n', 'r', 'a', 't', 'm']
+REQUEST_STRS = ['d', 'o']
+
+COMMANDS = ['ganno', 'canno', 'panno', 'codonsearch']
+
+class RequestError(Exception):
+    pass
+
+class AnnoServer():
+
+    """ holds the AnnoDB and answers the requests,
+    AnnoDB (file handles of the indices, the reference, the output
+    sink) is not thread safe, the annotation of requests is serialized
+    while the connections are served concurrently """
+
+    def __init__(self, args):
+
+        self.args = args
+        self.db = AnnoDB(args, read_config())
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def request_args(self, params):
+
+        args = copy.copy(self.args)
+        args.i = None
+        args.l = None
+        args.vcf = None
+        args.suspend = False
+        args.jobs = 1
+        for k, vs in params.items():
+            v = vs[-1]
+            if k in REQUEST_FLAGS:
+                setattr(args, k, v.lower() not in ('0', 'false', 'no'))
+            elif k in REQUEST_INTS:
+                try:
+                    setattr(args, k, int(v))
+                except ValueError:
+                    raise RequestError('invalid_integer_%s=%s' % (k, v))
+            elif k in REQUEST_STRS:
+                setattr(args, k, v)
+            elif k != 'i':
+                raise RequestError('unknown_option_%s' % k)
+        return args
+
+    def annotate(self, cmd, params, body):
+
+        """ run one request, return the output as a string """
+        args = self.request_args(params)
+        queries = params.get('i', [])
+        if not queries and not body:
+            raise RequestError('no_query')
+
+        buf = io.StringIO()
+        with self.lock:
+            out = record.set_output(OutputSink(buf, bufsize=1<<16))
+            try:
+                if cmd == 'codonsearch':
+                    self._codonsearch(args, queries, body)
+                else:
+                    self._anno(args, cmd[0], queries, body)
+                record.output.flush_lines()
+            finally:
+                record.set_output(out)
+
+        return buf.getvalue()
+
+    def _anno(self, args, at, queries, body):
+
+        if not args.noheader:
+            record.output.write(print_header(args))
+        for q in queries:
+            args.i = q
+            anno.main_one(args, self.db, at)
+        if body:
+            args.i = None
+            args.l = io.StringIO(body)
+            anno.main_list(args, self.db, at, list_parse_mutation(args, at))
+
+    def _codonsearch(self, args, queries, body):
+
+        for q in queries:
+            args.i = q
+            codonsearch.main_one(args, self.db)
+            args.noheader = True
+        if body:
+            args.i = None
+            args.l = io.StringIO(body)
+            codonsearch.main_list(args, self.db)
+
+    def record_latency(self, cmd, latency):
+
+        with self.stats_lock:
+            if cmd not in self.stats:
+                self.stats[cmd] = [0, 0.0, 0.0]
+            s = self.stats[cmd]
+            s[0] += 1
+            s[1] += latency
+            s[2] = max(s[2], latency)
+
+    def format_stats(self):
+
+        lines = ['command\trequests\tmean_latency_ms\tmax_latency_ms']
+        with self.stats_lock:
+            for cmd in sorted(self.stats):
+                n, total, mx = self.stats[cmd]
+                lines.append('%s\t%d\t%.3f\t%.3f' % (cmd, n, total/n, mx))
+        if faidx.refgenome is not None:
+            with self.lock:
+                lines.append('')
+                lines.append('reference_cache\thits\tmisses\tevictions')
+                lines.append('blocks\t%d\t%d\t%d' % faidx.refgenome.cache_stats())
+        return '\n'.join(lines)+'\n'
+
+class AnnoRequestHandler(BaseHTTPRequestHandler):
+
+    def _respond(self, code, text, latency=None):
+
+        data = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        if latency is not None:
+            self.send_header('X-TransVar-Latency', '%.3f' % latency)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, body):
+
+        t0 = time.time()
+        url = urlparse(self.path)
+        cmd = url.path.strip('/')
+        if cmd == 'stats':
+            self._respond(200, self.server.anno.format_stats())
+            return
+
+        if cmd not in COMMANDS:
+            self._respond(404, 'unknown_command_%s\n' % cmd)
+            return
+
+        try:
+            text = self.server.anno.annotate(cmd, parse_qs(url.query, keep_blank_values=True), body)
+            code = 200
+        except RequestError as e:
+            text, code = str(e)+'\n', 400
+        except (Exception, SystemExit) as e:
+            text, code = 'Error=%s\n' % str(e), 500
+
+        latency = (time.time()-t0)*1000
+        self.server.anno.record_latency(cmd, latency)
+        self._respond(code, text, latency)
+        err_print('%s %s %d %.3f ms' % (self.command, self.path, code, latency))
+
+    def do_GET(self):
+        self._handle(None)
+
+    def do_POST(self):
+        n = int(self.headers.get('Content-Length', 0))
+        self._handle(self.rfile.read(n).decode('utf-8') if n > 0 else None)
+
+    def address_string(self):
+        # client address of a Unix socket is empty
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_request(self, code='-', size='-'):
+        # logged with the latency in _handle
+        pass
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def main_serve(args):
+
+    anno_server = AnnoServer(args)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, AnnoRequestHandler)
+        err_print('serving on unix socket %s' % args.socket)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), AnnoRequestHandler)
+        err_print('serving on http://%s:%d' % (args.host, server.server_address[1]))
+
+    server.anno = anno_server
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
@@ -32,9 +32,18 @@ from . import faidx
 from .record import *
 from .utils import *
 from collections import deque
+from bisect import bisect_left, bisect_right
+from array import array
 import operator
 from functools import reduce
 
+## numpy is optional, the batch coordinate conversions
+## fall back to array('i') and bisect without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def complement(base):
 
     return {
@@ -215,6 +224,128 @@ class NonCoding():
 #     else:
 #         return tnuc2gnuc(np, tnuc_pos.pos) + tnuc_pos.tpos
 
+class CDSPositions():
+
+    """ genomic positions of the CDS bases in transcript order
+    behaves as the list [gpos of cDNA position 1, gpos of 2, ...]
+    but only keeps the cumulative offsets of the CDS segments of
+    the exons, conversions bisect over the segments
+    """
+
+    def __init__(self, t):
+
+        self.strand = t.strand
+        self.starts = []        # cDNA index (0-based) of each segment
+        self.firsts = []        # genomic position of the first base of each segment
+        self.bounds = []        # key to bisect for gpos, see search
+        n = 0
+        if t.strand == '+':
+            for beg, end in t.exons:
+                beg = max(beg, t.cds_beg)
+                end = min(t.cds_end, end)
+                if beg <= end:
+                    self.starts.append(n)
+                    self.firsts.append(beg)
+                    self.bounds.append(end)
+                    n += end-beg+1
+        else:
+            for beg, end in reversed(t.exons):
+                beg = max(beg, t.cds_beg)
+                end = min(t.cds_end, end)
+                if beg <= end:
+                    self.starts.append(n)
+                    self.firsts.append(end)
+                    self.bounds.append(-beg)
+                    n += end-beg+1
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def _get(self, i):
+        k = bisect_right(self.starts, i) - 1
+        if self.strand == '+':
+            return self.firsts[k] + (i - self.starts[k])
+        else:
+            return self.firsts[k] - (i - self.starts[k])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._get(_) for _ in range(self.n)[i]]
+        if i < 0:
+            i += self.n
+        if i < 0 or i >= self.n:
+            raise IndexError('CDS position out of range')
+        return self._get(i)
+
+    def __iter__(self):
+        for k, start in enumerate(self.starts):
+            size = (self.starts[k+1] if k+1 < len(self.starts) else self.n) - start
+            if self.strand == '+':
+                for gpos in range(self.firsts[k], self.firsts[k]+size):
+                    yield gpos
+            else:
+                for gpos in range(self.firsts[k], self.firsts[k]-size, -1):
+                    yield gpos
+
+    def _numpy_arrays(self):
+        if not hasattr(self, '_nparrays'):
+            self._nparrays = (numpy.array(self.starts, dtype=numpy.int64),
+                              numpy.array(self.firsts, dtype=numpy.int64),
+                              numpy.array(self.bounds, dtype=numpy.int64))
+        return self._nparrays
+
+    def get_many(self, indices):
+
+        """ genomic positions of a batch of 0-based cDNA indices,
+        indices are assumed to be in [0, len(self)) """
+        if numpy is None:
+            return array('i', [self._get(i) for i in indices])
+
+        starts, firsts, bounds = self._numpy_arrays()
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        k = numpy.searchsorted(starts, indices, 'right') - 1
+        if self.strand == '+':
+            return firsts[k] + (indices - starts[k])
+        else:
+            return firsts[k] - (indices - starts[k])
+
+    def search_many(self, gposs):
+
+        """ search() on a batch of genomic positions """
+        if numpy is None:
+            return array('i', [self.search(gpos) for gpos in gposs])
+
+        starts, firsts, bounds = self._numpy_arrays()
+        gposs = numpy.asarray(gposs, dtype=numpy.int64)
+        if len(starts) == 0:
+            return numpy.zeros(len(gposs), dtype=numpy.int64)
+        if self.strand == '+':
+            k = numpy.searchsorted(bounds, gposs, 'left')
+            kk = numpy.minimum(k, len(starts)-1)
+            i = starts[kk] + numpy.maximum(0, gposs - firsts[kk])
+        else:
+            k = numpy.searchsorted(bounds, -gposs, 'left')
+            kk = numpy.minimum(k, len(starts)-1)
+            i = starts[kk] + numpy.maximum(0, firsts[kk] - gposs)
+        return numpy.where(k == len(starts), self.n, i)
+
+    def search(self, gpos):
+
+        """ the first index whose genomic position is at or beyond gpos
+        in transcript direction, i.e., np[i] >= gpos on '+' strand
+        and np[i] <= gpos on '-' strand, len(self) if none """
+        if self.strand == '+':
+            k = bisect_left(self.bounds, gpos)
+            if k == len(self.bounds):
+                return self.n
+            return self.starts[k] + max(0, gpos - self.firsts[k])
+        else:
+            k = bisect_left(self.bounds, -gpos)
+            if k == len(self.bounds):
+                return self.n
+            return self.starts[k] + max(0, self.firsts[k] - gpos)
+
 def tnuc_region_in_exon(np, beg, end):
     """ region in tnuc positions """
 
@@ -271,6 +402,7 @@ class Transcript():
         self.aliases = []
         self.version = 255
         self.source = ''
+        self.seqdb = None       # CDS sequence cache, see localdb.CDSSeqDB
 
     def __lt__(self, other):
         return self.name < other.name
@@ -359,6 +491,9 @@ class Transcript():
         potential reason include patch chromosomes
         """
         if self.seq: return
+        if self.seqdb is not None:
+            self.seq = self.seqdb.fetch(self)
+            if self.seq: return
         if not faidx.refgenome:
             err_die("please provide reference through --ref [reference fasta].")
 
@@ -386,18 +521,7 @@ class Transcript():
         return self == self.gene.std_tpt
 
     def position_array(self):
-        if self.strand == "+":
-            np = []
-            for beg, end in self.exons:
-                np += list(range(max(beg, self.cds_beg),
-                            min(self.cds_end, end)+1))
-        else:
-            np = []
-            for beg, end in reversed(self.exons):
-                np += list(range(min(self.cds_end, end),
-                            max(beg, self.cds_beg)-1,-1))
-
-        return np
+        return CDSPositions(self)
 
     def tnuc_range2gnuc_range(self, tbeg, tend):
 
@@ -456,6 +580,37 @@ class Transcript():
         else:
             return self._tnuc2gnuc(tnuc_pos.pos) + tnuc_pos.tpos
 
+    def tnuc2gnuc_many(self, tnuc_poss, tnuc_offsets=None):
+
+        """ batch version of tnuc2gnuc
+        tnuc_poss are 1-based cDNA positions (Pos.pos), tnuc_offsets
+        the optional intronic offsets (Pos.tpos), returns the genomic
+        positions as a numpy array (array('i') without numpy)
+        """
+        self.ensure_position_array()
+        n = len(self.np)
+        tnuc_poss = [n if p < 0 else p for p in tnuc_poss]
+        for p in tnuc_poss:
+            if p > n or p == 0:
+                raise IncompatibleTranscriptError(
+                    'invalid_cDNA_position_%d;expect_[0_%d]' % (p, n))
+
+        gnuc_poss = self.np.get_many([p-1 for p in tnuc_poss])
+        if tnuc_offsets is None:
+            return gnuc_poss
+
+        if numpy is not None:
+            tnuc_offsets = numpy.asarray(tnuc_offsets, dtype=numpy.int64)
+            if self.strand == '-':
+                return gnuc_poss - tnuc_offsets
+            else:
+                return gnuc_poss + tnuc_offsets
+
+        if self.strand == '-':
+            return array('i', [g-o for g, o in zip(gnuc_poss, tnuc_offsets)])
+        else:
+            return array('i', [g+o for g, o in zip(gnuc_poss, tnuc_offsets)])
+
     def tnuc_resolve_pos(self, tnuc_pos_q):
         """ resolve tnuc_pos_q.pos in case it is negative (point to the cds length) """
         if tnuc_pos_q.pos < 0:
@@ -511,13 +666,10 @@ class Transcript():
         cpos is taa_pos
         """
         self.ensure_seq()
+        self.ensure_position_array()
+        np = self.np
         cpos = int(cpos)
         if self.strand == "+":
-            np = []
-            for beg, end in self.exons:
-                np += list(range(max(beg, self.cds_beg),
-                            min(self.cds_end, end)+1))
-            assert len(np) == len(self.seq)
 
             ni = cpos*3
             if ni <= len(np):
@@ -532,12 +684,6 @@ class Transcript():
             else:
                 raise IncompatibleTranscriptError('invalid_cDNA_position_%d;expect_[0_%d]' % (ni, len(np)))
         else:
-            np = []
-            for beg, end in reversed(self.exons):
-                np += list(range(min(self.cds_end, end),
-                            max(beg, self.cds_beg)-1,-1))
-            assert len(np) == len(self.seq)
-
             ni = cpos*3
             if ni <= len(np):
                 codon        = Codon()
@@ -669,7 +815,9 @@ class Transcript():
             c.locs = np[c.index*3-3:c.index*3]
             return c, p
 
-        for i, pos in enumerate(np):
+        i = np.search(gpos)
+        if i < len(np):
+            pos = np[i]
             if gpos == pos:
                 c = self._init_codon_(i//3+1)
                 c.seq    = self.seq[i-i%3:i-i%3+3]
@@ -714,7 +862,9 @@ class Transcript():
             c.locs = np[:3]
             return c, p
 
-        for i, pos in enumerate(np):
+        i = np.search(gpos)
+        if i < len(np):
+            pos = np[i]
             if gpos == pos:
                 c = self._init_codon_(i//3+1)
                 c.seq = self.seq[i-i%3:i-i%3+3]
@@ -801,6 +951,90 @@ class Transcript():
         else:
             return self._gpos2codon_n(gpos, self.np, intronic_policy)
 
+    def gpos2codon_many(self, gposs, intronic_policy='closer'):
+
+        """ batch version of gpos2codon without creating Codon and Pos
+        returns two arrays, the cDNA positions (Pos.pos) and the intronic
+        offsets (Pos.tpos), the codon index is (pos+2)//3
+        """
+        self.ensure_position_array()
+        if intronic_policy == 'g_greater':
+            intronic_policy = 'c_greater' if self.strand == '+' else 'c_smaller'
+
+        if intronic_policy == 'g_smaller':
+            intronic_policy = 'c_smaller' if self.strand == '+' else 'c_greater'
+
+        if intronic_policy not in ('closer', 'c_smaller', 'c_greater'):
+            raise Exception('unknown_intronic_policy')
+
+        np = self.np
+        n = len(np)
+        if numpy is None:
+            tposs = array('i')
+            toffs = array('i')
+            for gpos in gposs:
+                p = self._gpos2tnuc_one(int(gpos), np, intronic_policy)
+                tposs.append(p[0])
+                toffs.append(p[1])
+            return tposs, toffs
+
+        gposs = numpy.asarray(gposs, dtype=numpy.int64)
+        i = numpy.minimum(np.search_many(gposs), n-1)
+        nxt = np.get_many(i)
+        prv = np.get_many(numpy.maximum(i-1, 0))
+        d_prv = numpy.abs(gposs-prv)
+        d_nxt = numpy.abs(gposs-nxt)
+        if intronic_policy == 'closer':
+            smaller = d_prv < d_nxt
+        else:
+            smaller = numpy.full(len(gposs), intronic_policy == 'c_smaller')
+
+        exact = nxt == gposs
+        tposs = numpy.where(exact, i+1, numpy.where(smaller, i, i+1))
+        toffs = numpy.where(exact, 0, numpy.where(smaller, d_prv, -d_nxt))
+
+        # upstream and downstream of the CDS
+        below = gposs < self.cds_beg
+        above = gposs > self.cds_end
+        if self.strand == '+':
+            tposs = numpy.where(below, 1, numpy.where(above, n, tposs))
+            toffs = numpy.where(below, gposs-self.cds_beg,
+                                numpy.where(above, gposs-self.cds_end, toffs))
+        else:
+            tposs = numpy.where(below, n, numpy.where(above, 1, tposs))
+            toffs = numpy.where(below, self.cds_beg-gposs,
+                                numpy.where(above, self.cds_end-gposs, toffs))
+
+        return tposs, toffs
+
+    def _gpos2tnuc_one(self, gpos, np, intronic_policy):
+
+        """ (Pos.pos, Pos.tpos) of gpos2codon, without the Codon """
+        n = len(np)
+        if self.strand == '+':
+            if gpos < self.cds_beg:
+                return 1, gpos-self.cds_beg
+            if gpos > self.cds_end:
+                return n, gpos-self.cds_end
+        else:
+            if gpos < self.cds_beg:
+                return n, self.cds_beg-gpos
+            if gpos > self.cds_end:
+                return 1, self.cds_end-gpos
+
+        i = min(np.search(gpos), n-1)
+        nxt = np[i]
+        if nxt == gpos:
+            return i+1, 0
+
+        d_prv = abs(gpos-np[i-1])
+        d_nxt = abs(gpos-nxt)
+        if ((intronic_policy == 'closer' and d_prv < d_nxt) or
+            intronic_policy == 'c_smaller'):
+            return i, d_prv
+        else:
+            return i+1, -d_nxt
+
     def intronic_lean(self, p, direc):
 
         self.ensure_position_array()
@@ -1137,89 +1371,122 @@ def gnuc_del_id(chrm, beg, end, args, gnuc_delseq=None):
 
     return '%sdel%s' % (gnuc_posstr, gnuc_delrep)
 
+## indels are rolled by comparing the reference with itself shifted by
+## the indel length, ROLL_CHUNK bases at first, doubled after every
+## chunk that matches throughout (e.g., inside a long repeat)
+ROLL_CHUNK = 32
+
+def _common_prefix_len(a, b):
+
+    """ length of the common prefix of a and b, of the same length,
+    from the leading zero bytes of their XOR as big integers """
+    x = int.from_bytes(a.encode(), 'big') ^ int.from_bytes(b.encode(), 'big')
+    return len(a) - (x.bit_length()+7)//8
+
+def _common_suffix_len(a, b):
+
+    x = int.from_bytes(a.encode(), 'little') ^ int.from_bytes(b.encode(), 'little')
+    return len(a) - (x.bit_length()+7)//8
+
+def _roll_left(fetch, nmax, period):
+
+    """ number of bases (at most nmax) a sequence of the period rolls
+    to the left, fetch(k, n) gives the n+period bases ending at the
+    k-th base from the start of the rolling, N never matches """
+    k = 0
+    n = ROLL_CHUNK
+    while k < nmax and period > 0:
+        n = min(n, nmax-k)
+        s = fetch(k, n)
+        a = s[period:]
+        b = s[:n]
+        m = _common_suffix_len(a, b)
+        i = a.rfind('N', n-m)
+        if i >= 0:
+            m = n-1-i
+        k += m
+        if m < n:
+            break
+        n *= 2
+
+    return k
+
+def _roll_right(fetch, nmax, period):
+
+    """ number of bases (at most nmax) a sequence of the period rolls
+    to the right, fetch(k, n) gives the period+n bases starting at the
+    k-th base from the start of the rolling, N never matches """
+    k = 0
+    n = ROLL_CHUNK
+    while k < nmax and period > 0:
+        n = min(n, nmax-k)
+        s = fetch(k, n)
+        a = s[period:]
+        b = s[:n]
+        m = _common_prefix_len(a, b)
+        i = a.find('N', 0, m)
+        if i >= 0:
+            m = i
+        k += m
+        if m < n:
+            break
+        n *= 2
+
+    return k
+
 def gnuc_roll_left_del(chrm, beg, end):
 
     """ beg and end are 1st and last base in the deleted sequence """
 
-    sb = faidx.SeqBuf(chrm, beg)
-    while True:
-        if beg <= 1:
-            break
-        left_base = sb.get_base(chrm, beg-1)
-        rightmost = sb.get_base(chrm, end)
-        if left_base == 'N' or rightmost == 'N':
-            break
-        if left_base != rightmost:
-            break
-        beg -= 1
-        end -= 1
+    dlen = end-beg+1
+    k = _roll_left(lambda k, n: faidx.getseq(chrm, beg-k-n, end-k),
+                   beg-1, dlen)
 
-    return beg, end
+    return beg-k, end-k
 
 def gnuc_roll_right_del(chrm, beg, end):
 
     """ beg and end are 1st and last base in the deleted sequence """
 
-    sb = faidx.SeqBuf(chrm, end)
     chrmlen = faidx.refgenome.chrm2len(chrm)
-    while True:
-        # check end of chromosome
-        if end + 1 >= chrmlen:
-            break
-
-        right_base = sb.get_base(chrm, end+1)
-        leftmost = sb.get_base(chrm, beg)
-        if right_base == 'N' or leftmost == 'N':
-            break
-        if right_base != leftmost:
-            break
-        beg += 1
-        end += 1
+    dlen = end-beg+1
+    k = _roll_right(lambda k, n: faidx.getseq(chrm, beg+k, end+k+n),
+                    chrmlen-end, dlen)
 
-    return beg, end
+    return beg+k, end+k
 
 def gnuc_roll_left_ins(chrm, pos, gnuc_insseq):
 
     """ pos is where insertion occur after """
 
-    sb = faidx.SeqBuf(chrm, pos)
-    _gnuc_insseq_ = deque(gnuc_insseq)
-    while True:
-        if pos <= 1:
-            break
-        left_base = sb.get_base(chrm, pos)
-        rightmost = _gnuc_insseq_[-1]
-        if left_base == 'N' or rightmost == 'N':
-            break
-        if left_base != rightmost:
-            break
-        _gnuc_insseq_.pop()
-        _gnuc_insseq_.appendleft(left_base)
-        pos -= 1
+    ilen = len(gnuc_insseq)
+    def fetch(k, n):
+        # reference up to pos followed by the inserted sequence
+        hi = min(pos, pos-k+ilen)
+        return faidx.getseq(chrm, pos-k-n+1, hi) + gnuc_insseq[:pos-k+ilen-hi]
+
+    k = _roll_left(fetch, pos-1, ilen)
+    if k > 0:
+        hi = min(pos, pos-k+ilen)
+        gnuc_insseq = faidx.getseq(chrm, pos-k+1, hi) + gnuc_insseq[:pos-k+ilen-hi]
 
-    return pos, ''.join(_gnuc_insseq_)
+    return pos-k, gnuc_insseq
 
 def gnuc_roll_right_ins(chrm, pos, gnuc_insseq):
 
     """ pos is where insertion occur after """
 
-    sb = faidx.SeqBuf(chrm, pos)
     chrmlen = faidx.refgenome.chrm2len(chrm)
-    _gnuc_insseq_ = deque(gnuc_insseq)
-    while True:
-        if pos + 1 >= chrmlen:
-            break
-        right_base = sb.get_base(chrm, pos+1)
-        leftmost = _gnuc_insseq_[0]
-        if right_base == 'N' or leftmost == 'N':
-            break
-        if right_base != leftmost:
-            break
-        _gnuc_insseq_.popleft()
-        _gnuc_insseq_.append(right_base)
-        pos += 1
+    ilen = len(gnuc_insseq)
+    def fetch(k, n):
+        # the inserted sequence followed by reference after pos
+        return gnuc_insseq[k:] + faidx.getseq(chrm, max(pos+1, pos+k-ilen+1), pos+k+n)
+
+    k = _roll_right(fetch, chrmlen-pos, ilen)
+    if k > 0:
+        gnuc_insseq = gnuc_insseq[k:] + faidx.getseq(chrm, max(pos+1, pos+k-ilen+1), pos+k)
 
-    return pos, ''.join(_gnuc_insseq_)
+    return pos+k, gnuc_insseq
 
 class Gene():
 
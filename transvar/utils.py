@@ -27,7 +27,8 @@ SOFTWARE.
 
 """
 from __future__ import division
-import sys
+import sys, itertools
+from bisect import bisect_left, bisect_right
 from .err import *
 from . import tabix
 
@@ -162,47 +163,48 @@ def printseq(seq, args):
     else:
         return seq
 
-class THash():
+class TIntervalIndex():
 
-    def __init__(self):
+    """ in-memory location index of transcripts
+    transcripts of each chromosome are kept in a sorted array (by begin)
+    together with the running maximum of the ends, so that overlap
+    queries are a bisect plus a scan over the hits. A second array
+    sorted by end serves the closest upstream queries.
+    The order of transcripts and the overlap criterion follow the
+    tabix query on .transvardb.loc_idx
+    """
 
-        self.key2transcripts = {}
-        self.binsize = 100000
+    def __init__(self):
 
-    def add_transcript_by_key(self, k, t):
-        if k in self.key2transcripts:
-            self.key2transcripts[k].append(t)
-        else:
-            self.key2transcripts[k] = [t]
+        self.chrm2tpts = {}
+        self.chrm2begs = {}
+        self.chrm2maxends = {}
+        self.chrm2ends = {}
+        self.chrm2endorder = {}
 
     def insert(self, t):
         chrm = normalize_chrm(t.chrm)
-        for ki in range(t.cds_beg//self.binsize, t.cds_end//self.binsize+1):
-            k = (chrm, ki)
-            self.add_transcript_by_key(k, t)
-        # k1 = (chrm, t.cds_beg // self.binsize)
-        # k2 = (chrm, t.cds_end // self.binsize)
-        # if k1 == k2:
-        #     self.add_transcript_by_key(k1, t)
-        # else:
-        #     self.add_transcript_by_key(k1, t)
-        #     self.add_transcript_by_key(k2, t)
-
-    def get_transcripts_cds(self, chrm, beg, end=None, flanking=0):
-
-        """ get transcript if between CDS beginning and end """
-        if not end: end = beg
-        chrm = normalize_chrm(chrm)
-        kbeg = int(beg) // self.binsize
-        kend = int(end) // self.binsize
-        ts = []
-        for ki in range(kbeg, kend+1):
-            k = (chrm, ki)
-            if k in self.key2transcripts:
-                for t in self.key2transcripts[k]:
-                    if t.cds_beg-flanking <= end and t.cds_end+flanking >= beg:
-                        ts.append(t)
-        return ts
+        if chrm in self.chrm2tpts:
+            self.chrm2tpts[chrm].append(t)
+        else:
+            self.chrm2tpts[chrm] = [t]
+
+    def build(self):
+        """ sort the inserted transcripts, call after all the insertions """
+
+        for chrm, tpts in self.chrm2tpts.items():
+            tpts.sort(key=lambda t: (t.beg, t.end, t))
+            self.chrm2begs[chrm] = [t.beg for t in tpts]
+            maxends = []
+            maxend = -1
+            for t in tpts:
+                maxend = max(maxend, t.end)
+                maxends.append(maxend)
+            self.chrm2maxends[chrm] = maxends
+            # among equal ends, the first in location order comes last
+            endorder = sorted(range(len(tpts)), key=lambda i: (tpts[i].end, -i))
+            self.chrm2endorder[chrm] = endorder
+            self.chrm2ends[chrm] = [tpts[i].end for i in endorder]
 
     def get_transcripts(self, chrm, beg, end=None, flanking=0):
 
@@ -210,82 +212,44 @@ class THash():
 
         if not end: end = beg
         chrm = normalize_chrm(chrm)
-        kbeg = int(beg) // self.binsize
-        kend = int(end) // self.binsize
+        if chrm not in self.chrm2tpts:
+            return []
+
+        tpts = self.chrm2tpts[chrm]
+        maxends = self.chrm2maxends[chrm]
+        qbeg = max(1, int(beg) - flanking)
+        qend = int(end) + flanking
         ts = []
-        for ki in range(kbeg, kend+1):
-            k = (chrm, ki)
-            # print ki, kbeg, kend, k
-            if k in self.key2transcripts:
-                for t in self.key2transcripts[k]:
-                    if t.beg-flanking <= end and t.end+flanking >= beg:
-                        ts.append(t)
+        i = bisect_left(self.chrm2begs[chrm], qend) - 1
+        while i >= 0 and maxends[i] >= qbeg:
+            if tpts[i].end >= qbeg:
+                ts.append(tpts[i])
+            i -= 1
+        ts.reverse()
 
         return ts
 
     def get_closest_transcripts_upstream(self, chrm, pos):
+        """ transcript with the greatest end before pos """
         pos = int(pos)
         chrm = normalize_chrm(chrm)
-        for ki in range(pos//self.binsize, -1, -1):
-            k = (chrm, ki)
-            if k in self.key2transcripts:
-                tpts = [t for t in self.key2transcripts[k] if t.end < pos]
-                if tpts:
-                    tpts.sort(key=lambda t: t.end, reverse=True)
-                    return tpts[0]
-        return None
+        if chrm not in self.chrm2tpts:
+            return None
+        i = bisect_left(self.chrm2ends[chrm], pos) - 1
+        if i < 0:
+            return None
+        return self.chrm2tpts[chrm][self.chrm2endorder[chrm][i]]
 
     def get_closest_transcripts_downstream(self, chrm, pos):
+        """ transcript with the smallest begin after pos """
         pos = int(pos)
         chrm = normalize_chrm(chrm)
-        for ki in range(pos//self.binsize, MAXCHRMLEN//self.binsize, 1):
-            k = (chrm, ki)
-            if k in self.key2transcripts:
-                tpts = [t for t in self.key2transcripts[k] if t.beg > pos]
-                if tpts:
-                    tpts.sort(key=lambda t: t.beg)
-                    return tpts[0]
-        return None
-
-    # def get_closest_transcripts(self, chrm, beg, end):
-
-    #     """ closest transcripts upstream and downstream """
-    #     return (self.get_closest_transcripts_upstream(chrm, beg),
-    #             self.get_closest_transcripts_downstream(chrm, end))
-
-    # def __init__(self):
-    #     # chrm => bin => list of transcripts
-    #     self.chrm2bin = {}
-    #     self.bins = 3000
-    #     self.binsize = 100000
-
-    # def insert(self, tpt):
-
-    #     if tpt.chrm not in self.chrm2bin:
-    #         self.chrm2bin[tpt.chrm] = [[]]*self.bins
-    #     else:
-    #         bin1 = self.chrm2bin[tpt.chrm][tpt.cds_beg//self.binsize]
-    #         bin2 = self.chrm2bin[tpt.chrm][tpt.cds_end//self.binsize]
-    #         if bin1 == bin2:
-    #             bin1.append(tpt)
-    #         else:
-    #             bin1.append(tpt)
-    #             bin2.append(tpt)
-
-    # def get_transcripts(self,chrm, pos, std):
-    #     pos = int(pos)
-    #     if chrm not in self.chrm2bin:
-    #         return []
-
-    #     tpts = []
-    #     for tpt in self.chrm2bin[chrm][pos // self.binsize]:
-    #         if tpt.cds_beg <= pos and tpt.cds_end >= pos:
-    #             if std and tpt != tpt.gene.std_tpt:
-    #                 continue
-    #             tpts.append(tpt)
-
-    #     return tpts
-
+        if chrm not in self.chrm2tpts:
+            return None
+        i = bisect_right(self.chrm2begs[chrm], pos)
+        if i >= len(self.chrm2tpts[chrm]):
+            return None
+        return self.chrm2tpts[chrm][i]
 
 # class THash():
 
@@ -400,6 +364,105 @@ def opengz(fn):
 
     return fh
 
+## BGZF blocks hold at most 64kb, the uncompressed input of a
+## block is kept below that so that the compressed block fits
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00'
+            b'\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+class BGZFWriter():
+
+    """ writes BGZF (blocked gzip), i.e., the format of bgzip,
+    readable by zcat and indexable by tabix """
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.buf = bytearray()
+
+    def write(self, data):
+        self.buf += data
+        while len(self.buf) >= BGZF_BLOCK_SIZE:
+            self._write_block(bytes(self.buf[:BGZF_BLOCK_SIZE]))
+            del self.buf[:BGZF_BLOCK_SIZE]
+
+    def _write_block(self, data):
+        import zlib, struct
+        c = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        cdata = c.compress(data) + c.flush()
+        self.fh.write(struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6,
+                                  66, 67, 2, len(cdata)+25))
+        self.fh.write(cdata)
+        self.fh.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+    def flush(self):
+        if self.buf:
+            self._write_block(bytes(self.buf))
+            self.buf = bytearray()
+        self.fh.flush()
+
+    def close(self):
+        self.flush()
+        self.fh.write(BGZF_EOF)
+        self.fh.close()
+
+def write_tabix(fn, lines, preset='bed'):
+
+    """ bgzip the position-sorted lines into fn and build fn.tbi,
+    both in-process """
+    w = BGZFWriter(open(fn, 'wb'))
+    for line in lines:
+        w.write(line.encode('utf-8'))
+    w.close()
+    try:
+        tabix.index(fn, preset)
+    except tabix.TabixError as e:
+        err_die('tabix indexing failed on %s (%s)' % (fn, e))
+
+## number of lines sorted in memory by external_sort,
+## larger input is spilled to temporary runs
+SORT_RUN_SIZE = 1000000
+
+def _read_run_(fn, key, start):
+
+    with open(fn, 'rt') as fh:
+        for i, line in enumerate(fh):
+            yield (key(line), start+i, line)
+
+def external_sort(lines, key, tmpdir, run_size=SORT_RUN_SIZE):
+
+    """ stable sort of lines by key, like sort -T tmpdir, runs of
+    run_size lines are sorted in memory and spilled to tmpdir, then
+    merged, generates the sorted lines """
+    import heapq, tempfile, os
+    lines = iter(lines)
+    runs = []
+    try:
+        start = 0
+        while True:
+            chunk = list(itertools.islice(lines, run_size))
+            if not chunk:
+                break
+            run = [(key(line), start+i, line) for i, line in enumerate(chunk)]
+            run.sort()
+            if len(chunk) < run_size and not runs:
+                # fits in memory
+                for k, i, line in run:
+                    yield line
+                return
+            fd, fn = tempfile.mkstemp(prefix='transvar_sort.', dir=tmpdir)
+            runs.append((fn, start))
+            with os.fdopen(fd, 'wt') as fh:
+                for k, i, line in run:
+                    fh.write(line)
+            start += len(chunk)
+
+        for k, i, line in heapq.merge(*[_read_run_(fn, key, s) for fn, s in runs]):
+            yield line
+    finally:
+        for fn, s in runs:
+            if os.path.exists(fn):
+                os.remove(fn)
+
 def double_trim(seq1, seq2):
 
     # trim head